@@ -0,0 +1,121 @@
+import asyncio
+import time
+
+from telemetry import LANE_IN_USE, LANE_QUEUE_DEPTH, LANE_REJECTED, LANE_WAIT_SECONDS
+
+
+class LaneFull(Exception):
+    pass
+
+
+class LaneTimeout(Exception):
+    pass
+
+
+class Lane:
+    """Admission to one class of upstream work, e.g. interactive chat or bulk ingestion.
+
+    At most ``limit`` callers hold a slot at once. Up to ``queue_size`` more
+    may wait for one; past that, ``acquire`` fails fast with ``LaneFull``, and
+    a caller that waits longer than ``timeout`` seconds gets ``LaneTimeout``.
+    Lanes do not share slots, so a backlog in one cannot hold up the others.
+    """
+
+    def __init__(self, name, limit, queue_size, timeout=None):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(limit)
+        self.waiting = 0
+        self.in_use = 0
+
+    def is_full(self):
+        return self.semaphore.locked() and self.waiting >= self.queue_size
+
+    async def acquire(self, bounded=True):
+        # Work already accepted, such as the batches of a running ingest, passes bounded=False
+        # so it waits for a slot however long the queue is
+        if bounded and self.is_full():
+            LANE_REJECTED.labels(self.name, "full").inc()
+            raise LaneFull(self.name)
+
+        start = time.perf_counter()
+        self.waiting += 1
+        LANE_QUEUE_DEPTH.labels(self.name).set(self.waiting)
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.timeout if bounded else None)
+        except asyncio.TimeoutError:
+            LANE_REJECTED.labels(self.name, "timeout").inc()
+            raise LaneTimeout(self.name)
+        finally:
+            self.waiting -= 1
+            LANE_QUEUE_DEPTH.labels(self.name).set(self.waiting)
+            LANE_WAIT_SECONDS.labels(self.name).observe(time.perf_counter() - start)
+
+        self.in_use += 1
+        LANE_IN_USE.labels(self.name).set(self.in_use)
+        return Slot(self)
+
+    def release(self):
+        self.in_use -= 1
+        LANE_IN_USE.labels(self.name).set(self.in_use)
+        self.semaphore.release()
+
+    async def run(self, awaitable, bounded=True):
+        slot = await self.acquire(bounded)
+        try:
+            return await awaitable
+        finally:
+            slot.release()
+
+    def stats(self):
+        return {"limit": self.limit, "queue_size": self.queue_size, "in_use": self.in_use, "waiting": self.waiting}
+
+
+class Slot:
+    def __init__(self, lane):
+        self.lane = lane
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.lane.release()
+
+    def hold(self, chunks):
+        return HeldStream(self, chunks)
+
+
+class HeldStream:
+    """Streams ``chunks`` and gives the slot back when the stream ends.
+
+    The slot is released when the stream finishes, fails or is closed. It is
+    also released if the response is dropped before streaming starts, e.g.
+    when the client disconnects first, since an async generator that never
+    started would never run its ``finally``.
+    """
+
+    def __init__(self, slot, chunks):
+        self.slot = slot
+        self.chunks = chunks.__aiter__()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.chunks.__anext__()
+        except BaseException:
+            self.slot.release()
+            raise
+
+    async def aclose(self):
+        try:
+            if hasattr(self.chunks, "aclose"):
+                await self.chunks.aclose()
+        finally:
+            self.slot.release()
+
+    def __del__(self):
+        self.slot.release()
@@ -1,84 +1,382 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Depends
+from fastapi import FastAPI, File, UploadFile, HTTPException, Depends, Query, BackgroundTasks
 from pydantic import BaseModel
-from openai import OpenAI
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from fastapi.concurrency import run_in_threadpool
 from dotenv import load_dotenv
 import json
-import psycopg2
+import base64
+import asyncio
+import time
+import asyncpg
 import os
 import uuid
-from psycopg2.extras import RealDictCursor
-from typing import List, Optional
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
-from langchain_chroma import Chroma
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain.chains import create_history_aware_retriever, create_retrieval_chain
-from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain_core.messages import HumanMessage, AIMessage
-from azure.storage.blob import BlobClient
-from azure.identity import DefaultAzureCredential
-from azure.keyvault.secrets import SecretClient
-import chromadb
+import hashlib
+import html
+import tempfile
+import functools
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import List, Literal, Optional
+from datetime import datetime
+from azure.core.exceptions import ResourceNotFoundError
+from settings import Settings
+from telemetry import span, observe, timed_stream, setup_tracing, StatsCollector, CHUNKS_SKIPPED
+from streaming import stream_tokens
+from admission import Lane, LaneFull, LaneTimeout
+from prometheus_client import REGISTRY, CONTENT_TYPE_LATEST, generate_latest
 
 load_dotenv()
 
-keyVaultName = os.environ["KEY_VAULT_NAME"]
-KVUri = f"https://{keyVaultName}.vault.azure.net"
-
-credential = DefaultAzureCredential()
-client = SecretClient(vault_url=KVUri, credential=credential)
-
-DB_NAME = client.get_secret('PROJ-DB-NAME').value
-DB_USER = client.get_secret('PROJ-DB-USER').value
-DB_PASSWORD = client.get_secret('PROJ-DB-PASSWORD').value
-DB_HOST = client.get_secret('PROJ-DB-HOST').value
-DB_PORT = client.get_secret('PROJ-DB-PORT').value
-OPENAI_API_KEY = client.get_secret('PROJ-OPENAI-API-KEY').value
-AZURE_STORAGE_SAS_URL = client.get_secret('PROJ-AZURE-STORAGE-SAS-URL').value
-AZURE_STORAGE_CONTAINER = client.get_secret('PROJ-AZURE-STORAGE-CONTAINER').value
-CHROMADB_HOST = client.get_secret('PROJ-CHROMADB-HOST').value
-CHROMADB_PORT = client.get_secret('PROJ-CHROMADB-PORT').value
-
-
-DB_CONFIG = {
-    "dbname": DB_NAME,
-    "user": DB_USER,
-    "password": DB_PASSWORD,
-    "host": DB_HOST,
-    "port": DB_PORT,
-}
+# Secrets are fetched from Key Vault at startup, concurrently, falling back to
+# the environment / .env and then SETTINGS_FILE
+settings = Settings(
+    vault_name=os.environ.get("KEY_VAULT_NAME"),
+    settings_file=os.environ.get("SETTINGS_FILE", "settings.json"),
+    ttl=int(os.environ.get("SETTINGS_TTL", 3600)),
+)
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+# Connection pool sizing
+DB_POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", 1))
+DB_POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", 10))
+DB_POOL_ACQUIRE_TIMEOUT = float(os.environ.get("DB_POOL_ACQUIRE_TIMEOUT", 5))
+DB_COMMAND_TIMEOUT = float(os.environ.get("DB_COMMAND_TIMEOUT", 30))
 
 model = "gpt-3.5-turbo"
 
+LOAD_CHAT_PAGE_SIZE = int(os.environ.get("LOAD_CHAT_PAGE_SIZE", 50))
+LOAD_CHAT_MAX_PAGE_SIZE = int(os.environ.get("LOAD_CHAT_MAX_PAGE_SIZE", 200))
+SEARCH_PAGE_SIZE = int(os.environ.get("SEARCH_PAGE_SIZE", 20))
+SEARCH_MAX_OFFSET = int(os.environ.get("SEARCH_MAX_OFFSET", 1000))
+# ts_headline marks matches with these private-use characters; they become <mark> tags once the snippet is escaped
+SNIPPET_START, SNIPPET_STOP = "\ue000", "\ue001"
+
+# Chunks retrieved per RAG question unless the request overrides it
+RAG_TOP_K = int(os.environ.get("RAG_TOP_K", 5))
+
+# When to skip the question-rewriting LLM call: "heuristic" also skips it for
+# questions that look self-contained, "no_history" only on the first question
+RAG_REWRITE_MODE = os.environ.get("RAG_REWRITE_MODE", "heuristic")
+RAG_REWRITE_MIN_WORDS = int(os.environ.get("RAG_REWRITE_MIN_WORDS", 6))
+RAG_REWRITE_HISTORY_TURNS = int(os.environ.get("RAG_REWRITE_HISTORY_TURNS", 6))
+RAG_REWRITE_CACHE_SIZE = int(os.environ.get("RAG_REWRITE_CACHE_SIZE", 1024))
+RAG_REWRITE_CACHE_TTL = int(os.environ.get("RAG_REWRITE_CACHE_TTL", 600))
+
+# Open per-document Chroma collections, and cached retrieval results
+VECTOR_STORE_CACHE_SIZE = int(os.environ.get("VECTOR_STORE_CACHE_SIZE", 256))
+RETRIEVAL_CACHE_SIZE = int(os.environ.get("RETRIEVAL_CACHE_SIZE", 2048))
+RETRIEVAL_CACHE_TTL = int(os.environ.get("RETRIEVAL_CACHE_TTL", 300))
+
+# Token budget for the history sent to the model; older turns are summarized
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", 3000))
+HISTORY_RECENT_MESSAGES = int(os.environ.get("HISTORY_RECENT_MESSAGES", 6))
+
+# Fold a chat's append log into its snapshot once it holds this many messages
+CHAT_COMPACT_EVERY = int(os.environ.get("CHAT_COMPACT_EVERY", 20))
+
+# Worker processes for CPU-bound PDF parsing
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", 2))
+# Pages handed to a worker at a time, and chunks embedded per Chroma insert
+PDF_PAGES_PER_TASK = int(os.environ.get("PDF_PAGES_PER_TASK", 10))
+INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", 64))
+INGEST_MAX_INFLIGHT_BATCHES = int(os.environ.get("INGEST_MAX_INFLIGHT_BATCHES", 4))
+# A document still "processing" with no checkpoint for this many seconds was left by a worker that died; uploads may claim it again
+INGEST_CLAIM_TIMEOUT = int(os.environ.get("INGEST_CLAIM_TIMEOUT", 600))
+
+# Uploads are read and staged to blob storage in blocks of this size, with a few blocks in flight,
+# and spooled to a local file for the parser workers
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", 4 * 1024 * 1024))
+UPLOAD_MAX_CONCURRENCY = int(os.environ.get("UPLOAD_MAX_CONCURRENCY", 4))
+PDF_SPOOL_DIR = os.environ.get("PDF_SPOOL_DIR", "pdf_store")
+
+# Chunk embeddings are cached on disk, keyed by chunk text hash and embedding model
+EMBEDDING_CACHE_DIR = os.environ.get("EMBEDDING_CACHE_DIR", "embedding_cache")
+
+# Embedding requests are sized by tokens and paced to the account's rate limits; see embedding_scheduler.py
+EMBEDDING_BATCH_TOKENS = int(os.environ.get("EMBEDDING_BATCH_TOKENS", 20000))
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", 256))
+EMBEDDING_MAX_CONCURRENCY = int(os.environ.get("EMBEDDING_MAX_CONCURRENCY", 4))
+EMBEDDING_TOKENS_PER_MINUTE = int(os.environ.get("EMBEDDING_TOKENS_PER_MINUTE", 1_000_000))
+EMBEDDING_REQUESTS_PER_MINUTE = int(os.environ.get("EMBEDDING_REQUESTS_PER_MINUTE", 3000))
+EMBEDDING_MAX_RETRIES = int(os.environ.get("EMBEDDING_MAX_RETRIES", 6))
+
+# Finished answers of /chat/ and /rag_chat/ can be replayed for repeated questions: "off", "exact",
+# or "semantic" to also match questions whose embedding is within RESPONSE_CACHE_SIMILARITY
+RESPONSE_CACHE_MODE = os.environ.get("RESPONSE_CACHE_MODE", "off")
+RESPONSE_CACHE_SIMILARITY = float(os.environ.get("RESPONSE_CACHE_SIMILARITY", 0.95))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", 3600))
+RESPONSE_CACHE_CONTEXT_MESSAGES = int(os.environ.get("RESPONSE_CACHE_CONTEXT_MESSAGES", 2))
+
+# Admission lanes in front of OpenAI and Chroma. "interactive" holds a slot per /chat/ and /rag_chat/
+# stream, and requests past the queue get a 429 (or a 503 after waiting the timeout). "bulk" holds a
+# slot per ingest batch being embedded and written, and /upload_pdf/ gets a 429 while its queue is full.
+LANE_INTERACTIVE_LIMIT = int(os.environ.get("LANE_INTERACTIVE_LIMIT", 32))
+LANE_INTERACTIVE_QUEUE = int(os.environ.get("LANE_INTERACTIVE_QUEUE", 64))
+LANE_INTERACTIVE_TIMEOUT = float(os.environ.get("LANE_INTERACTIVE_TIMEOUT", 10))
+LANE_BULK_LIMIT = int(os.environ.get("LANE_BULK_LIMIT", 4))
+LANE_BULK_QUEUE = int(os.environ.get("LANE_BULK_QUEUE", 64))
+
+# After the first token, streamed text is sent in pieces of up to this many characters or milliseconds
+STREAM_COALESCE_CHARS = int(os.environ.get("STREAM_COALESCE_CHARS", 64))
+STREAM_COALESCE_MS = float(os.environ.get("STREAM_COALESCE_MS", 50))
+
 # VECTOR_DB_DIR = "chromadb"
 # os.makedirs(VECTOR_DB_DIR, exist_ok=True)
 
-llm = ChatOpenAI(model=model, api_key=OPENAI_API_KEY)
+# Heavy clients are built on first use (and warmed up in the background at startup)
+# so the app can serve requests before LangChain, Chroma and OpenAI are loaded.
+# Handlers get them with ``await get_x.aget()``, which builds in a thread, and
+# ``get_x.peek()`` returns a client only if it already exists
+lazy_services = []
 
-# LangChain setup
-embedding_function = OpenAIEmbeddings(api_key=OPENAI_API_KEY)
-chroma_client = chromadb.HttpClient(host=CHROMADB_HOST, port=CHROMADB_PORT)
-collection = chroma_client.get_or_create_collection("langchain")
-vectorstore = Chroma(
-            client=chroma_client,
-            collection_name="langchain",
-            embedding_function=embedding_function,
-)
+lanes = {
+    "interactive": Lane("interactive", LANE_INTERACTIVE_LIMIT, LANE_INTERACTIVE_QUEUE, LANE_INTERACTIVE_TIMEOUT),
+    "bulk": Lane("bulk", LANE_BULK_LIMIT, LANE_BULK_QUEUE),
+}
+
+def lazy(factory):
+    lock = threading.Lock()
+    instance = []
+
+    @functools.wraps(factory)
+    def get():
+        if not instance:
+            with lock:
+                if not instance:
+                    instance.append(factory())
+        return instance[0]
+
+    async def aget():
+        # The event loop never waits on imports, client setup or the warm-up holding the lock
+        return instance[0] if instance else await run_in_threadpool(get)
+
+    get.aget = aget
+    get.peek = lambda: instance[0] if instance else None
+    get.reset = instance.clear
+    lazy_services.append(get)
+    return get
+
+@lazy
+def get_openai_client():
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(api_key=settings.get("OPENAI_API_KEY"))
+
+@lazy
+def get_llm():
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(model=model, api_key=settings.get("OPENAI_API_KEY"), stream_usage=True)
+
+@lazy
+def get_embedding_function():
+    from langchain_openai import OpenAIEmbeddings
+    from langchain.storage import LocalFileStore
+    from embedding_cache import CachedEmbeddings
+    from embedding_scheduler import EmbeddingScheduler
+    # Retries are left to the scheduler, which backs off for every caller at once
+    openai_embeddings = OpenAIEmbeddings(api_key=settings.get("OPENAI_API_KEY"), max_retries=0)
+    scheduler = EmbeddingScheduler(
+        openai_embeddings,
+        max_batch_tokens=EMBEDDING_BATCH_TOKENS,
+        max_batch_size=EMBEDDING_BATCH_SIZE,
+        max_concurrency=EMBEDDING_MAX_CONCURRENCY,
+        tokens_per_minute=EMBEDDING_TOKENS_PER_MINUTE,
+        requests_per_minute=EMBEDDING_REQUESTS_PER_MINUTE,
+        max_retries=EMBEDDING_MAX_RETRIES,
+    )
+    return CachedEmbeddings(scheduler, LocalFileStore(EMBEDDING_CACHE_DIR), model=openai_embeddings.model)
+
+@lazy
+def get_document_index():
+    import chromadb
+    from document_index import DocumentIndex
+    chroma_client = chromadb.HttpClient(host=settings.get("CHROMADB_HOST"), port=settings.get("CHROMADB_PORT"))
+    # Each document's chunks live in their own collection; see migrate_collections.py
+    return DocumentIndex(
+        chroma_client,
+        get_embedding_function(),
+        collection_cache_size=VECTOR_STORE_CACHE_SIZE,
+        cache_size=RETRIEVAL_CACHE_SIZE,
+        cache_ttl=RETRIEVAL_CACHE_TTL,
+    )
+
+@lazy
+def get_rag_pipeline():
+    from rag_chain import RAGPipeline
+    # Prompts and chains are assembled once and shared by every /rag_chat/ request
+    return RAGPipeline(
+        get_llm(),
+        get_document_index(),
+        mode=RAG_REWRITE_MODE,
+        min_words=RAG_REWRITE_MIN_WORDS,
+        history_turns=RAG_REWRITE_HISTORY_TURNS,
+        cache_size=RAG_REWRITE_CACHE_SIZE,
+        cache_ttl=RAG_REWRITE_CACHE_TTL,
+    )
+
+async def embed_query(text):
+    return await (await get_embedding_function.aget()).aembed_query(text)
+
+@lazy
+def get_response_cache():
+    from response_cache import ResponseCache
+    return ResponseCache(
+        embed=embed_query,
+        mode=RESPONSE_CACHE_MODE,
+        similarity=RESPONSE_CACHE_SIMILARITY,
+        max_bytes=RESPONSE_CACHE_MAX_BYTES,
+        ttl=RESPONSE_CACHE_TTL,
+        context_messages=RESPONSE_CACHE_CONTEXT_MESSAGES,
+    )
+
+@lazy
+def get_history_manager():
+    from history import HistoryManager
+    return HistoryManager(
+        get_llm(),
+        model,
+        budget=HISTORY_TOKEN_BUDGET,
+        recent_messages=HISTORY_RECENT_MESSAGES,
+        load_summary=load_summary,
+        save_summary=save_summary,
+    )
+
+def warm_up():
+    for get in lazy_services:
+        try:
+            get()
+        except Exception as e:
+            # Left for the first request to retry and report
+            print(f"Warm-up of {get.__name__} failed: {e}")
+
+@lazy
+def get_blob_client_class():
+    # Imported by lifespan, in a thread, since get_blob_client is called from handlers
+    if settings.get("AZURE_STORAGE_SAS_URL").startswith("file://"):
+        # A local directory instead of a storage account, see local_blob.py
+        from local_blob import LocalBlobClient
+        return LocalBlobClient
+    from azure.storage.blob.aio import BlobClient
+    return BlobClient
+
+def get_blob_client(blob_path):
+    blob_client_class = get_blob_client_class()
+    if settings.get("AZURE_STORAGE_SAS_URL").startswith("file://"):
+        root = settings.get("AZURE_STORAGE_SAS_URL").removeprefix("file://")
+        return blob_client_class(os.path.join(root, settings.get("AZURE_STORAGE_CONTAINER")), blob_path)
+    storage_resource_uri, token = settings.get("AZURE_STORAGE_SAS_URL").split('?', 1)
+    blob_sas_url = f"{storage_resource_uri}/{settings.get('AZURE_STORAGE_CONTAINER')}/{blob_path}?{token}"
+    return blob_client_class.from_blob_url(blob_sas_url)
+
+# Chats are stored as a JSON snapshot plus an append blob of newer messages, one per line
+def get_log_path(file_path):
+    return file_path.removesuffix(".json") + ".log.jsonl"
+
+# Rolling summary of the turns that no longer fit the history budget
+def get_summary_path(chat_id):
+    return f"chat_logs/{chat_id}.summary.json"
+
+async def load_summary(chat_id):
+    async with get_blob_client(get_summary_path(chat_id)) as blob_client:
+        try:
+            downloader = await blob_client.download_blob()
+        except ResourceNotFoundError:
+            return None
+        return json.loads(await downloader.readall())
+
+async def save_summary(chat_id, summary):
+    async with get_blob_client(get_summary_path(chat_id)) as blob_client:
+        await blob_client.upload_blob(json.dumps(summary, ensure_ascii=False), overwrite=True)
+
+# Serializes appends and compaction of the same chat within this worker
+chat_locks = defaultdict(asyncio.Lock)
+
+db_pool = None
+pdf_executor = None
+
+# Background PDF ingestion, keyed by pdf_uuid
+ingest_jobs = {}
+ingest_tasks = set()
+pool_stats = {"acquired": 0, "timeouts": 0, "wait_seconds_total": 0.0, "wait_seconds_max": 0.0}
+
+async def refresh_settings():
+    # Re-read secrets every SETTINGS_TTL seconds; rotated values rebuild the clients on next use
+    while True:
+        await asyncio.sleep(settings.ttl)
+        try:
+            if await run_in_threadpool(settings.refresh):
+                for get in lazy_services:
+                    get.reset()
+        except Exception as e:
+            print(f"Settings refresh failed, keeping cached values: {e}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global db_pool, pdf_executor
+    await run_in_threadpool(settings.refresh)
+    blob_client_class = asyncio.create_task(get_blob_client_class.aget())
+    db_pool = await asyncpg.create_pool(
+        database=settings.get("DB_NAME"),
+        user=settings.get("DB_USER"),
+        # Looked up per new connection, so a rotated password is picked up
+        password=lambda: settings.get("DB_PASSWORD"),
+        host=settings.get("DB_HOST"),
+        port=int(settings.get("DB_PORT")),
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        command_timeout=DB_COMMAND_TIMEOUT,
+    )
+    await blob_client_class
+    # "spawn" keeps workers from re-running this module's startup code
+    pdf_executor = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    background = [
+        asyncio.create_task(run_in_threadpool(warm_up)),
+        asyncio.create_task(refresh_settings()),
+    ]
+    try:
+        yield
+    finally:
+        for task in background + list(ingest_tasks):
+            task.cancel()
+        pdf_executor.shutdown(wait=False, cancel_futures=True)
+        await db_pool.close()
+
+app = FastAPI(lifespan=lifespan)
+setup_tracing(app)
+
+UPLOAD_REJECTED = {"status_code": 429, "headers": {"Retry-After": "30"}}
 
-storage_account_sas_url = AZURE_STORAGE_SAS_URL
-storage_container_name = AZURE_STORAGE_CONTAINER
-storage_resource_uri = storage_account_sas_url.split('?')[0]
-token = storage_account_sas_url.split('?')[1]
+class UploadAdmission:
+    """Turns uploads away while the bulk lane is full, before their body is read.
 
-app = FastAPI()
+    FastAPI reads the multipart body before the handler or its dependencies
+    run, so a check in /upload_pdf/ itself only answers once the whole file
+    has been received. A plain ASGI middleware, unlike @app.middleware, adds
+    nothing to the streaming chat responses.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] == "/upload_pdf/" and lanes["bulk"].is_full():
+            response = JSONResponse({"detail": "Too many documents are being indexed, please retry later."}, **UPLOAD_REJECTED)
+            await response(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
+
+app.add_middleware(UploadAdmission)
 
 # Request models
+# "text" streams raw text; "sse" and "ndjson" stream framed deltas and a final frame with usage and timings
+StreamFormat = Literal["text", "sse", "ndjson"]
+
 class ChatRequest(BaseModel):
     messages: List[dict]
+    chat_id: Optional[str] = None
+    stream_format: StreamFormat = "text"
 
 class SaveChatRequest(BaseModel):
     chat_id: str
@@ -88,78 +386,398 @@ class SaveChatRequest(BaseModel):
     pdf_path: Optional[str] = None
     pdf_uuid: Optional[str] = None
 
+class AppendChatRequest(BaseModel):
+    chat_id: str
+    messages: List[dict]
+
 class DeleteChatRequest(BaseModel):
     chat_id: str
 
 class RAGChatRequest(BaseModel):
     messages: List[dict]
     pdf_uuid: str
+    k: int = RAG_TOP_K
+    chat_id: Optional[str] = None
+    stream_format: StreamFormat = "text"
 
-# Dependency to manage database connection
-def get_db():
-    conn = psycopg2.connect(**DB_CONFIG)
+# Dependency to borrow a connection from the pool
+@asynccontextmanager
+async def borrow_db():
+    start = time.perf_counter()
+    try:
+        conn = await db_pool.acquire(timeout=DB_POOL_ACQUIRE_TIMEOUT)
+    except asyncio.TimeoutError:
+        pool_stats["timeouts"] += 1
+        raise HTTPException(status_code=503, detail="Database is busy, please retry.")
+
+    waited = time.perf_counter() - start
+    pool_stats["acquired"] += 1
+    pool_stats["wait_seconds_total"] += waited
+    pool_stats["wait_seconds_max"] = max(pool_stats["wait_seconds_max"], waited)
     try:
         yield conn
     finally:
-        conn.close()
+        await db_pool.release(conn)
+
+async def get_db():
+    async with borrow_db() as conn:
+        yield conn
+
+def read_pool_stats():
+    return {
+        "size": db_pool.get_size(),
+        "idle": db_pool.get_idle_size(),
+        "min_size": db_pool.get_min_size(),
+        "max_size": db_pool.get_max_size(),
+        **pool_stats,
+    }
+
+@app.get("/pool_stats/")
+async def get_pool_stats():
+    return read_pool_stats()
+
+# The stats kept around the app are published on /metrics next to the stage timings
+REGISTRY.register(StatsCollector("db_pool", read_pool_stats, gauges=("size", "idle", "min_size", "max_size", "wait_seconds_max")))
+def built_stats(get, read):
+    # Only clients that already exist are reported, so a scrape never builds one
+    def stats():
+        instance = get.peek()
+        return read(instance) if instance is not None else None
+    return stats
+
+REGISTRY.register(StatsCollector("rag_rewrite", built_stats(get_rag_pipeline, lambda pipeline: pipeline.rewriter.stats)))
+REGISTRY.register(StatsCollector("retrieval_cache", built_stats(get_document_index, lambda index: index.stats)))
+REGISTRY.register(StatsCollector("embedding_cache", built_stats(get_embedding_function, lambda embeddings: embeddings.stats()), gauges=("hit_rate",)))
+REGISTRY.register(StatsCollector("response_cache", built_stats(get_response_cache, lambda cache: cache.read_stats()), gauges=("entries", "bytes", "hit_rate")))
+REGISTRY.register(StatsCollector("embedding_scheduler", built_stats(get_embedding_function, lambda embeddings: embeddings.underlying.stats), gauges=("in_flight",)))
+
+@app.get("/metrics")
+async def metrics():
+    return Response(generate_latest(REGISTRY), media_type=CONTENT_TYPE_LATEST)
+
+async def lookup_response(endpoint, messages, pdf_uuid=None, options=()):
+    # Returns (cached response, ticket to record a new one); both are None when caching does not apply
+    if RESPONSE_CACHE_MODE == "off" or not messages or messages[-1].get("role") != "user":
+        return None, None
+    question = messages[-1].get("content")
+    # Answers from a document that is still being indexed would go stale
+    job = ingest_jobs.get(pdf_uuid)
+    if not isinstance(question, str) or job and job["status"] == "processing":
+        return None, None
+    try:
+        return await (await get_response_cache.aget()).lookup(endpoint, model, question, messages[:-1], pdf_uuid=pdf_uuid, options=options)
+    except Exception as e:
+        # e.g. the question could not be embedded; answer without the cache
+        print(e)
+        return None, None
+
+def replay_response(endpoint, cached, stream_format, start):
+    # Same stream and frames as a generated answer; only the X-Cache header tells them apart
+    from response_cache import replay
+    timing = {}
+    return stream_tokens(
+        timed_stream(f"{endpoint}_cached", replay(cached), start, timing),
+        stream_format, timing, dict(cached.usage),
+        max_delay=STREAM_COALESCE_MS / 1000, max_chars=STREAM_COALESCE_CHARS, headers={"X-Cache": "hit"},
+    )
+
+async def admit(lane):
+    try:
+        return await lanes[lane].acquire()
+    except LaneFull:
+        raise HTTPException(status_code=429, detail="Too many requests in progress, please retry.", headers={"Retry-After": "1"})
+    except LaneTimeout:
+        raise HTTPException(status_code=503, detail="Timed out waiting for capacity, please retry.", headers={"Retry-After": "5"})
+
+def invalidate_responses(pdf_uuid):
+    # A cache that was never built holds nothing to invalidate
+    cache = get_response_cache.peek()
+    if cache is not None and pdf_uuid:
+        cache.invalidate(pdf_uuid)
 
 @app.post("/chat/")
 async def chat(request: ChatRequest):
+    start = time.perf_counter()
+    # Cached answers are replayed without taking a slot
+    cached, ticket = await lookup_response("chat", request.messages)
+    if cached is not None:
+        return replay_response("chat", cached, request.stream_format, start)
+
+    slot = await admit("interactive")
     try:
-        stream = client.chat.completions.create(
-            model=model,
-            messages=request.messages,
-            stream=True,
-        )
+        with span("chat.history"):
+            messages = await (await get_history_manager.aget()).fit(request.messages, request.chat_id)
+        with span("chat.request"):
+            openai_client = await get_openai_client.aget()
+            stream = await openai_client.chat.completions.create(
+                model=model,
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True},
+            )
 
         # if you don't want to stream the output
         # set the stream parameter to False in above function
         # and uncommnet the belowing line
         # return {"reply": response.choices[0].message.content}
 
+        usage = {}
+        timing = {}
+
         # Function to send out the stream data
-        def stream_response():
-            for chunk in stream:
-                delta = chunk.choices[0].delta.content
-                if delta:
-                    yield delta
+        async def stream_response():
+            try:
+                async for chunk in stream:
+                    # The last chunk carries usage and no choices
+                    if chunk.usage:
+                        usage.update(chunk.usage.model_dump(include={"prompt_tokens", "completion_tokens", "total_tokens"}))
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+            finally:
+                # Closing the connection makes OpenAI stop generating if the client went away
+                await stream.close()
+
+        chunks = stream_response()
+        if ticket is not None:
+            chunks = (await get_response_cache.aget()).record(ticket, chunks, usage)
 
         # Use StreamingResponse to return
-        return StreamingResponse(stream_response(), media_type="text/plain")
+        return stream_tokens(
+            timed_stream("chat", chunks, start, timing),
+            request.stream_format, timing, usage,
+            max_delay=STREAM_COALESCE_MS / 1000, max_chars=STREAM_COALESCE_CHARS, slot=slot,
+        )
     
     except Exception as e:
+        slot.release()
         raise HTTPException(status_code=500, detail=str(e))
+    except BaseException:
+        slot.release()
+        raise
+
+def encode_cursor(last_update, chat_id):
+    raw = f"{last_update.isoformat()}|{chat_id}"
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        last_update, chat_id = raw.split("|", 1)
+        return datetime.fromisoformat(last_update), chat_id
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
 
 @app.get("/load_chat/")
-async def load_chat(db: psycopg2.extensions.connection = Depends(get_db)):
+async def load_chat(
+    limit: int = Query(LOAD_CHAT_PAGE_SIZE, ge=1, le=LOAD_CHAT_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    updated_since: Optional[datetime] = None,
+    db: asyncpg.Connection = Depends(get_db),
+):
+    # Metadata only, newest first; messages are fetched per chat from /chat/{chat_id}/messages.
+    # With updated_since, only chats changed at or after that time are listed, for incremental sync
+    try:
+        conditions = []
+        args = []
+        if cursor:
+            last_update, chat_id = decode_cursor(cursor)
+            args += [last_update, chat_id]
+            conditions.append(f"(last_update, id) < (${len(args) - 1}, ${len(args)})")
+        if updated_since:
+            args.append(updated_since.replace(tzinfo=None))
+            conditions.append(f"last_update >= ${len(args)}")
+        args.append(limit + 1)
+
+        with span("load_chat.query"):
+            rows = await db.fetch(
+                f"""
+                SELECT id, name, pdf_name, pdf_path, pdf_uuid, last_update, message_count FROM advanced_chats
+                {"WHERE " + " AND ".join(conditions) if conditions else ""}
+                ORDER BY last_update DESC, id DESC LIMIT ${len(args)}
+                """,
+                *args,
+            )
+
+        # One extra row tells us whether another page exists
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1]["last_update"], rows[-1]["id"])
+
+        records = [
+            {
+                "id": row["id"], "chat_name": row["name"], "pdf_name": row["pdf_name"], "pdf_path": row["pdf_path"], "pdf_uuid": row["pdf_uuid"],
+                "last_update": row["last_update"].isoformat(), "message_count": row["message_count"],
+            }
+            for row in rows
+        ]
+        return {"chats": records, "next_cursor": next_cursor}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
+
+def highlight(snippet):
+    # Message text is escaped first, so only the <mark> tags added here are markup
+    return html.escape(snippet).replace(SNIPPET_START, "<mark>").replace(SNIPPET_STOP, "</mark>")
+
+@app.get("/search_chats/")
+async def search_chats(
+    q: str = Query(..., min_length=1),
+    limit: int = Query(SEARCH_PAGE_SIZE, ge=1, le=LOAD_CHAT_MAX_PAGE_SIZE),
+    offset: int = Query(0, ge=0, le=SEARCH_MAX_OFFSET),
+    db: asyncpg.Connection = Depends(get_db),
+):
+    # Matching messages, best first, with the matched words wrapped in <mark> tags and the rest HTML-escaped.
+    # Matches come from the GIN index, and snippets are only built for the page returned
+    try:
+        with span("search_chats.query"):
+            rows = await db.fetch(
+                """
+                WITH query AS (SELECT websearch_to_tsquery('english', $1) AS q),
+                hits AS (
+                    SELECT m.chat_id, m.seq, m.role, m.content, ts_rank_cd(m.content_tsv, query.q) AS rank
+                    FROM chat_messages m, query
+                    WHERE m.content_tsv @@ query.q
+                    ORDER BY rank DESC, m.chat_id, m.seq
+                    LIMIT $2 OFFSET $3
+                )
+                SELECT hits.chat_id, c.name, hits.seq, hits.role, hits.rank,
+                       ts_headline('english', translate(hits.content, $4, ''), query.q, $5) AS snippet
+                FROM hits JOIN advanced_chats c ON c.id = hits.chat_id, query
+                ORDER BY hits.rank DESC, hits.chat_id, hits.seq
+                """,
+                q, limit + 1, offset, SNIPPET_START + SNIPPET_STOP,
+                f"StartSel={SNIPPET_START}, StopSel={SNIPPET_STOP}, MaxFragments=2, MaxWords=30, MinWords=10",
+            )
+
+        # One extra row tells us whether another page exists
+        next_offset = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            if offset + limit <= SEARCH_MAX_OFFSET:
+                next_offset = offset + limit
+
+        results = [
+            {"chat_id": row["chat_id"], "chat_name": row["name"], "seq": row["seq"], "role": row["role"], "rank": row["rank"], "snippet": highlight(row["snippet"])}
+            for row in rows
+        ]
+        return {"results": results, "next_offset": next_offset}
+
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
+
+@app.get("/chat/{chat_id}/messages")
+async def load_chat_messages(chat_id: str, db: asyncpg.Connection = Depends(get_db)):
     try:
-        with db.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("SELECT id, name, file_path, pdf_name, pdf_path, pdf_uuid FROM advanced_chats ORDER BY last_update DESC")
-            rows = cursor.fetchall()
+        result = await db.fetchrow("SELECT file_path, log_count FROM advanced_chats WHERE id = $1", chat_id)
+        if not result:
+            raise HTTPException(status_code=404, detail="Chat not found")
+        file_path = result["file_path"]
 
-        records = []
-        for row in rows:
-            chat_id, name, file_path, pdf_name, pdf_path, pdf_uuid= row["id"], row["name"], row["file_path"], row["pdf_name"], row["pdf_path"], row["pdf_uuid"]
+        # Messages still in the append log have to be merged with the snapshot
+        if result["log_count"]:
+            with span("load_chat.download", merged=True):
+                return await read_chat_messages(file_path)
 
-            blob_sas_url = f"{storage_resource_uri}/{storage_container_name}/{file_path}?{token}"
-            blob_client = BlobClient.from_blob_url(blob_sas_url)
+        blob_client = get_blob_client(file_path)
+        try:
+            with span("load_chat.download", merged=False):
+                downloader = await blob_client.download_blob()
+        except ResourceNotFoundError:
+            await blob_client.close()
+            raise HTTPException(status_code=404, detail="Chat transcript not found")
 
-            if blob_client.exists():
-                blob_data = blob_client.download_blob().readall()
-                messages = json.loads(blob_data)
-                records.append({"id": chat_id, "chat_name": name, "messages": messages, "pdf_name":pdf_name, "pdf_path":pdf_path, "pdf_uuid":pdf_uuid})
-            # if os.path.exists(file_path):
-            #     with open(file_path, "r", encoding="utf-8") as f:
-            #         messages = json.load(f)
-            #     records.append({"id": chat_id, "chat_name": name, "messages": messages, "pdf_name":pdf_name, "pdf_path":pdf_path, "pdf_uuid":pdf_uuid})
+        # Stream the transcript as stored instead of buffering it in memory
+        async def stream_blob():
+            try:
+                async for chunk in downloader.chunks():
+                    yield chunk
+            finally:
+                await blob_client.close()
 
-        return records
+        return StreamingResponse(stream_blob(), media_type="application/json")
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
+async def read_blob_text(blob_path):
+    async with get_blob_client(blob_path) as blob_client:
+        try:
+            downloader = await blob_client.download_blob()
+        except ResourceNotFoundError:
+            return None
+        return (await downloader.readall()).decode("utf-8")
+
+async def read_chat_messages(file_path):
+    snapshot = await read_blob_text(file_path)
+    log = await read_blob_text(get_log_path(file_path))
+    messages = json.loads(snapshot) if snapshot else []
+    if log:
+        messages.extend(json.loads(line) for line in log.splitlines() if line)
+    return messages
+
+async def compact_chat(chat_id):
+    # The merged transcript is written under a new name and the row is switched to it in one UPDATE,
+    # so a compaction that fails part way leaves either the old snapshot and log or the new snapshot,
+    # never the log folded in twice. Blobs left behind are collected by garbage_collect.py
+    async with chat_locks[chat_id]:
+        async with db_pool.acquire() as db:
+            row = await db.fetchrow("SELECT file_path, log_count FROM advanced_chats WHERE id = $1", chat_id)
+            if not row or not row["log_count"]:
+                return
+
+            file_path = row["file_path"]
+            log_path = get_log_path(file_path)
+            log = await read_blob_text(log_path)
+            if not log:
+                return
+            folded = [json.loads(line) for line in log.splitlines() if line]
+            snapshot = await read_blob_text(file_path)
+            messages = (json.loads(snapshot) if snapshot else []) + folded
+
+            compacted_path = f"chat_logs/{chat_id}.{uuid.uuid4().hex[:12]}.json"
+            async with get_blob_client(compacted_path) as blob_client:
+                await blob_client.upload_blob(json.dumps(messages, ensure_ascii=False, indent=4), overwrite=True)
+            # Not switched if the chat was saved or appended to by another worker in the meantime
+            switched = await db.fetchval(
+                """
+                UPDATE advanced_chats SET file_path = $2, log_count = 0
+                WHERE id = $1 AND file_path = $3 AND log_count = $4 RETURNING id
+                """,
+                chat_id, compacted_path, file_path, row["log_count"],
+            )
+            for blob_path in ([file_path, log_path] if switched else [compacted_path]):
+                async with get_blob_client(blob_path) as blob_client:
+                    if await blob_client.exists():
+                        await blob_client.delete_blob()
+
+# Messages are also kept one row each in chat_messages, whose GIN index backs /search_chats/
+def message_rows(chat_id, messages, start=0):
+    rows = []
+    for seq, message in enumerate(messages, start):
+        content = message.get("content", "")
+        if not isinstance(content, str):
+            content = json.dumps(content, ensure_ascii=False)
+        rows.append((chat_id, seq, message.get("role", ""), content))
+    return rows
+
+async def index_messages(db, chat_id, messages, start=0):
+    # Rows that did not change are left alone, so resaving a transcript only re-indexes what was edited
+    await db.executemany(
+        """
+        INSERT INTO chat_messages (chat_id, seq, role, content) VALUES ($1, $2, $3, $4)
+        ON CONFLICT (chat_id, seq) DO UPDATE SET role = EXCLUDED.role, content = EXCLUDED.content
+        WHERE chat_messages.role IS DISTINCT FROM EXCLUDED.role OR chat_messages.content IS DISTINCT FROM EXCLUDED.content
+        """,
+        message_rows(chat_id, messages, start),
+    )
+
 @app.post("/save_chat/")
-async def save_chat(request: SaveChatRequest, db: psycopg2.extensions.connection = Depends(get_db)):
+async def save_chat(request: SaveChatRequest, db: asyncpg.Connection = Depends(get_db)):
     try:
         file_path = f"chat_logs/{request.chat_id}.json"
         # os.makedirs("chat_logs", exist_ok=True)
@@ -168,64 +786,130 @@ async def save_chat(request: SaveChatRequest, db: psycopg2.extensions.connection
         # with open(file_path, "w", encoding="utf-8") as f:
         #     json.dump(request.messages, f, ensure_ascii=False, indent=4)
 
-        blob_sas_url = f"{storage_resource_uri}/{storage_container_name}/{file_path}?{token}"
-        blob_client = BlobClient.from_blob_url(blob_sas_url)
         messages_data = json.dumps(request.messages, ensure_ascii=False, indent=4)
-        blob_client.upload_blob(messages_data, overwrite=True)
-        
-        # Insert or update database record
-        with db.cursor() as cursor:
-            cursor.execute(
-                """
-                INSERT INTO advanced_chats (id, name, file_path, last_update, pdf_path, pdf_name, pdf_uuid)
-                VALUES (%s, %s, %s, CURRENT_TIMESTAMP, %s, %s, %s)
-                ON CONFLICT (id)
-                DO UPDATE SET name = EXCLUDED.name, file_path = EXCLUDED.file_path, last_update = CURRENT_TIMESTAMP, pdf_path = EXCLUDED.pdf_path, pdf_name = EXCLUDED.pdf_name, pdf_uuid = EXCLUDED.pdf_uuid
-                """,
-                (request.chat_id, request.chat_name, file_path, request.pdf_path, request.pdf_name, request.pdf_uuid),
-            )
-        db.commit()
+        async with chat_locks[request.chat_id]:
+            async with get_blob_client(file_path) as blob_client:
+                await blob_client.upload_blob(messages_data, overwrite=True)
+
+            # The full transcript replaces anything still in the append log
+            async with get_blob_client(get_log_path(file_path)) as blob_client:
+                if await blob_client.exists():
+                    await blob_client.delete_blob()
+
+            # Insert or update database record
+            async with db.transaction():
+                await db.execute(
+                    """
+                    INSERT INTO advanced_chats (id, name, file_path, last_update, pdf_path, pdf_name, pdf_uuid, message_count, log_count)
+                    VALUES ($1, $2, $3, CURRENT_TIMESTAMP, $4, $5, $6, $7, 0)
+                    ON CONFLICT (id)
+                    DO UPDATE SET name = EXCLUDED.name, file_path = EXCLUDED.file_path, last_update = CURRENT_TIMESTAMP, pdf_path = EXCLUDED.pdf_path, pdf_name = EXCLUDED.pdf_name, pdf_uuid = EXCLUDED.pdf_uuid, message_count = EXCLUDED.message_count, log_count = 0
+                    """,
+                    request.chat_id, request.chat_name, file_path, request.pdf_path, request.pdf_name, request.pdf_uuid, len(request.messages),
+                )
+                await db.execute("DELETE FROM chat_messages WHERE chat_id = $1 AND seq >= $2", request.chat_id, len(request.messages))
+                await index_messages(db, request.chat_id, request.messages)
         return {"message": "Chat saved successfully"}
     
     except Exception as e:
-        db.rollback()
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
 
-@app.post("/delete_chat/")
-async def delete_chat(request: DeleteChatRequest, db: psycopg2.extensions.connection = Depends(get_db)):
+@app.post("/append_chat/")
+async def append_chat(request: AppendChatRequest, background_tasks: BackgroundTasks, db: asyncpg.Connection = Depends(get_db)):
     try:
-        # Retrieve the file path before deleting the record
-        file_path = None
-        with db.cursor() as cursor:
-            cursor.execute("SELECT file_path, pdf_path FROM advanced_chats WHERE id = %s", (request.chat_id,))
-            result = cursor.fetchone()
-            if result:
-                file_path = result[0]
-                pdf_path = result[1]
-            else:
+        async with chat_locks[request.chat_id]:
+            chat = await db.fetchrow("SELECT file_path, message_count FROM advanced_chats WHERE id = $1", request.chat_id)
+            if not chat or not chat["file_path"]:
                 raise HTTPException(status_code=404, detail="Chat not found")
+            file_path = chat["file_path"]
+            # Chats saved before message_count was kept have 0 until backfill_search.py has run;
+            # their transcript is counted once so the new messages are indexed after the old ones
+            known_count = chat["message_count"] or len(await read_chat_messages(file_path))
+
+            # Only the new messages are written, as compact JSON lines
+            delta = "".join(
+                json.dumps(message, ensure_ascii=False, separators=(",", ":")) + "\n"
+                for message in request.messages
+            )
+            async with get_blob_client(get_log_path(file_path)) as blob_client:
+                try:
+                    await blob_client.append_block(delta.encode("utf-8"))
+                except ResourceNotFoundError:
+                    await blob_client.create_append_blob()
+                    await blob_client.append_block(delta.encode("utf-8"))
+
+            async with db.transaction():
+                counts = await db.fetchrow(
+                    """
+                    UPDATE advanced_chats
+                    SET last_update = CURRENT_TIMESTAMP, message_count = GREATEST(message_count, $3) + $2, log_count = log_count + $2
+                    WHERE id = $1 RETURNING message_count, log_count
+                    """,
+                    request.chat_id, len(request.messages), known_count,
+                )
+                await index_messages(db, request.chat_id, request.messages, start=counts["message_count"] - len(request.messages))
+            log_count = counts["log_count"]
+
+        if log_count >= CHAT_COMPACT_EVERY:
+            background_tasks.add_task(compact_chat, request.chat_id)
+
+        return {"message": "Chat appended successfully"}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
-        # Delete the record from the database
-        with db.cursor() as cursor:
-            cursor.execute("DELETE FROM advanced_chats WHERE id = %s", (request.chat_id,))
-        db.commit()
+
+async def release_document(db, pdf_uuid, pdf_path):
+    # Several chats can share a document since uploads are deduplicated by content; its vectors,
+    # blob and row only go once the last chat referencing it is deleted. Anything missed here
+    # (e.g. two chats on the same document deleted concurrently) is collected by garbage_collect.py
+    referenced = await db.fetchval(
+        "SELECT EXISTS (SELECT 1 FROM advanced_chats WHERE pdf_uuid = $1 OR pdf_path = $2)", pdf_uuid, pdf_path
+    )
+    job = ingest_jobs.get(pdf_uuid)
+    if referenced or job and job["status"] == "processing":
+        return set()
+
+    document = await db.fetchrow("DELETE FROM pdf_documents WHERE pdf_uuid = $1 RETURNING pdf_path", pdf_uuid)
+    if pdf_uuid:
+        ingest_jobs.pop(pdf_uuid, None)
+        try:
+            await (await get_document_index.aget()).adelete(pdf_uuid)
+        except Exception as e:
+            # The rows are already gone; the vectors are left for garbage_collect.py
+            print(f"Deleting the vectors of {pdf_uuid} failed: {e}")
+        invalidate_responses(pdf_uuid)
+    return {pdf_path, document and document["pdf_path"]}
+
+@app.post("/delete_chat/")
+async def delete_chat(request: DeleteChatRequest, db: asyncpg.Connection = Depends(get_db)):
+    try:
+        # Delete the record and get back the blob paths it pointed to
+        result = await db.fetchrow(
+            "DELETE FROM advanced_chats WHERE id = $1 RETURNING file_path, pdf_path, pdf_uuid", request.chat_id
+        )
+        if result:
+            file_path = result["file_path"]
+            pdf_path = result["pdf_path"]
+        else:
+            raise HTTPException(status_code=404, detail="Chat not found")
 
         # Delete the associated file, if it exists
         # if file_path and os.path.exists(file_path):
         #     os.remove(file_path)
-        
-        if file_path:
-            blob_sas_url = f"{storage_resource_uri}/{storage_container_name}/{file_path}?{token}"
-            blob_client = BlobClient.from_blob_url(blob_sas_url)
-            if blob_client.exists():
-                blob_client.delete_blob()
-
-        if pdf_path:
-            blob_sas_url = f"{storage_resource_uri}/{storage_container_name}/{pdf_path}?{token}"
-            blob_client = BlobClient.from_blob_url(blob_sas_url)
-            if blob_client.exists():
-                blob_client.delete_blob()
+
+        blob_paths = [file_path, get_log_path(file_path), get_summary_path(request.chat_id)]
+        if pdf_path or result["pdf_uuid"]:
+            blob_paths.extend(await release_document(db, result["pdf_uuid"], pdf_path))
+
+        for blob_path in blob_paths:
+            if blob_path:
+                async with get_blob_client(blob_path) as blob_client:
+                    if await blob_client.exists():
+                        await blob_client.delete_blob()
 
         return {"message": "Chat deleted successfully"}
 
@@ -233,125 +917,325 @@ async def delete_chat(request: DeleteChatRequest, db: psycopg2.extensions.connec
         # Reraise known exceptions
         raise
     except Exception as e:
-        db.rollback()
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
     
 
+async def spool_upload(file, blob_client, spool):
+    # A single pass over the upload hashes it, stages it to blob storage block by block and
+    # writes it to the spool file; memory stays bounded by the blocks in flight
+    hasher = hashlib.sha256()
+    block_ids = []
+    staging = set()
+    try:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            hasher.update(chunk)
+            await run_in_threadpool(spool.write, chunk)
+            block_id = base64.b64encode(f"{len(block_ids):08d}".encode("ascii")).decode("ascii")
+            block_ids.append(block_id)
+            staging.add(asyncio.create_task(blob_client.stage_block(block_id, chunk)))
+            if len(staging) >= UPLOAD_MAX_CONCURRENCY:
+                done, staging = await asyncio.wait(staging, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()
+        await asyncio.gather(*staging)
+    except BaseException:
+        for task in staging:
+            task.cancel()
+        raise
+    return hasher.hexdigest(), block_ids
+
+async def index_chunks(pdf_uuid, chunks):
+    # Ids are derived from the document hash, so re-ingesting a document overwrites its chunks.
+    # Batches of accepted uploads wait for a bulk slot however long the queue is.
+    index = await get_document_index.aget()
+    await lanes["bulk"].run(
+        index.aadd_texts(
+            pdf_uuid,
+            [text for text, _, _ in chunks],
+            ids=[f"{pdf_uuid}-{page}-{seq}" for _, page, seq in chunks],
+            metadatas=[{"pdf_uuid": pdf_uuid, "page": page} for _, page, _ in chunks],
+        ),
+        bounded=False,
+    )
+    ingest_jobs[pdf_uuid]["chunks_indexed"] += len(chunks)
+
+async def save_checkpoint(pdf_uuid, pages, chunks):
+    # Pages whose chunks are all in Chroma; re-ingesting the document skips them
+    async with db_pool.acquire() as db:
+        await db.execute(
+            """
+            UPDATE pdf_documents SET pages_indexed = pages_indexed || $2::int[], chunk_count = chunk_count + $3, claimed_at = CURRENT_TIMESTAMP
+            WHERE pdf_uuid = $1
+            """,
+            pdf_uuid, pages, chunks,
+        )
+
+async def ingest_pdf(pdf_uuid, file_path):
+    from pdf_processing import count_pages, load_and_split_pages
+    from chunking import Deduplicator, fingerprint_all
+    job = ingest_jobs[pdf_uuid]
+    # Repeated chunks, e.g. boilerplate on every page, are embedded once per document
+    dedup = Deduplicator()
+    loop = asyncio.get_running_loop()
+    parses = []
+    writes = set()
+    try:
+        async with db_pool.acquire() as db:
+            # A count left over from before checkpoints were kept is not trusted
+            row = await db.fetchrow(
+                """
+                UPDATE pdf_documents SET chunk_count = CASE WHEN cardinality(pages_indexed) = 0 THEN 0 ELSE chunk_count END
+                WHERE pdf_uuid = $1 RETURNING pages_indexed, chunk_count
+                """,
+                pdf_uuid,
+            )
+        indexed = set(row["pages_indexed"]) if row else set()
+        job["chunks_indexed"] = row["chunk_count"] if row else 0
+        if indexed:
+            # Checkpointed pages are not parsed again, but the rest of the document must still
+            # be deduplicated against the chunks they already put in Chroma
+            texts = await (await get_document_index.aget()).atexts(pdf_uuid, sorted(indexed))
+            for exact, signature in await loop.run_in_executor(pdf_executor, fingerprint_all, texts):
+                dedup.remember(exact, signature)
+
+        pages = await loop.run_in_executor(pdf_executor, count_pages, file_path)
+        job["pages_total"] = pages
+
+        # Page ranges are parsed in parallel; chunks are indexed in batches as ranges finish,
+        # so /rag_chat/ can already answer from the part of the document that is indexed.
+        # Ranges checkpointed by an earlier, failed run are not parsed again.
+        ranges = [(start, min(start + PDF_PAGES_PER_TASK, pages)) for start in range(0, pages, PDF_PAGES_PER_TASK)]
+        ranges = [(start, stop) for start, stop in ranges if not indexed.issuperset(range(start, stop))]
+        job["pages_done"] = pages - sum(stop - start for start, stop in ranges)
+
+        async def parse(start, stop):
+            return start, stop, await loop.run_in_executor(pdf_executor, load_and_split_pages, file_path, start, stop)
+
+        # Chunks of each parsed range still to be written, and how many it has
+        remaining = {}
+        totals = {}
+
+        async def write(batch):
+            await index_chunks(pdf_uuid, batch)
+            for _, page, _ in batch:
+                start = page - page % PDF_PAGES_PER_TASK
+                remaining[start] -= 1
+                if remaining[start] == 0:
+                    await save_checkpoint(pdf_uuid, list(range(start, totals[start][0])), totals[start][1])
+
+        async def submit(batch):
+            # Up to INGEST_MAX_INFLIGHT_BATCHES batches are embedded and written at once,
+            # so embedding one batch overlaps with writing another to Chroma
+            nonlocal writes
+            writes.add(asyncio.create_task(write(batch)))
+            while len(writes) >= INGEST_MAX_INFLIGHT_BATCHES:
+                done, writes = await asyncio.wait(writes, return_when=asyncio.FIRST_COMPLETED)
+                errors = [task.exception() for task in done]
+                if any(errors):
+                    raise next(error for error in errors if error)
+
+        parses = [asyncio.create_task(parse(start, stop)) for start, stop in ranges]
+        pending = []
+        for future in asyncio.as_completed(parses):
+            start, stop, (pages_done, chunks, timings, stripped) = await future
+            observe("ingest.parse", timings["parse"])
+            observe("ingest.split", timings["split"])
+            job["pages_done"] += pages_done
+            job["lines_stripped"] += stripped
+            kept = [(text, page, seq) for text, page, seq, exact, signature in chunks if not dedup.is_duplicate(exact, signature)]
+            job["chunks_skipped"] = dedup.stats["exact"] + dedup.stats["near"]
+            remaining[start] = len(kept)
+            totals[start] = (stop, len(kept))
+            if not kept:
+                await save_checkpoint(pdf_uuid, list(range(start, stop)), 0)
+            pending.extend(kept)
+            while len(pending) >= INGEST_BATCH_SIZE:
+                batch, pending = pending[:INGEST_BATCH_SIZE], pending[INGEST_BATCH_SIZE:]
+                await submit(batch)
+        if pending:
+            await submit(pending)
+        for task in asyncio.as_completed(writes):
+            await task
+
+        job["status"] = "done"
+        for reason, count in dedup.stats.items():
+            CHUNKS_SKIPPED.labels(reason).inc(count)
+    except Exception as e:
+        print(e)
+        job["status"] = "failed"
+        job["error"] = str(e)
+        for task in parses + list(writes):
+            task.cancel()
+        await asyncio.gather(*parses, *writes, return_exceptions=True)
+    finally:
+        await run_in_threadpool(os.remove, file_path)
+        async with db_pool.acquire() as db:
+            # chunk_count is kept up to date by the checkpoints
+            await db.execute("UPDATE pdf_documents SET status = $2 WHERE pdf_uuid = $1", pdf_uuid, job["status"])
+
+async def register_document(db, pdf_uuid, pdf_path, pdf_name):
+    # Claims the document for ingestion in one statement, so of two workers uploading the same new PDF
+    # only one indexes it. Returns False if it is already indexed or another ingestion holds it;
+    # otherwise marks it processing and opens its job at /ingest/{pdf_uuid}
+    claimed = await db.fetchval(
+        """
+        INSERT INTO pdf_documents (pdf_uuid, pdf_path, pdf_name, status, claimed_at)
+        VALUES ($1, $2, $3, 'processing', CURRENT_TIMESTAMP)
+        ON CONFLICT (pdf_uuid)
+        DO UPDATE SET pdf_path = EXCLUDED.pdf_path, pdf_name = EXCLUDED.pdf_name, status = 'processing', claimed_at = CURRENT_TIMESTAMP
+        WHERE pdf_documents.status <> 'done' AND (
+            pdf_documents.status <> 'processing' OR pdf_documents.claimed_at IS NULL
+            OR pdf_documents.claimed_at < CURRENT_TIMESTAMP - make_interval(secs => $4)
+        )
+        RETURNING pdf_uuid
+        """,
+        pdf_uuid, pdf_path, pdf_name, INGEST_CLAIM_TIMEOUT,
+    )
+    if not claimed:
+        return False
+    invalidate_responses(pdf_uuid)
+    ingest_jobs[pdf_uuid] = {"status": "processing", "pages_total": None, "pages_done": 0, "chunks_indexed": 0, "chunks_skipped": 0, "lines_stripped": 0, "error": None}
+    return True
+
+async def abandon_document(pdf_uuid, error):
+    # Gives up a claim whose ingestion never started, so the next upload can claim it again
+    ingest_jobs[pdf_uuid].update(status="failed", error=str(error))
+    async with borrow_db() as db:
+        await db.execute("UPDATE pdf_documents SET status = $2 WHERE pdf_uuid = $1", pdf_uuid, "failed")
+
 @app.post("/upload_pdf/")
 async def upload_pdf(file: UploadFile = File(...)):
+    # No connection is held while the body streams to storage; one is borrowed once it is staged
 
     if file.content_type != "application/pdf":
         raise HTTPException(status_code=400, detail="Only PDF files are allowed.")
+    if lanes["bulk"].is_full():
+        # The lane filled up while the body was being received
+        raise HTTPException(detail="Too many documents are being indexed, please retry later.", **UPLOAD_REJECTED)
 
+    upload_id = uuid.uuid4().hex
+    file_path = f"pdf_store/{upload_id}_{file.filename}"
+    os.makedirs(PDF_SPOOL_DIR, exist_ok=True)
+    spool = tempfile.NamedTemporaryFile(dir=PDF_SPOOL_DIR, suffix=".pdf", delete=False)
     try:
-        pdf_uuid = str(uuid.uuid4())
-        file_path = f"pdf_store/{pdf_uuid}_{file.filename}"
-        os.makedirs("pdf_store", exist_ok=True)
-
-        with open(file_path, "wb") as f:
-            f.write(await file.read())
-        blob_sas_url = f"{storage_resource_uri}/{storage_container_name}/{file_path}?{token}"
-        blob_client = BlobClient.from_blob_url(blob_sas_url)
-        blob_client.upload_blob(file_path, overwrite=True)
-
-        # Load and process PDF
-        loader = PyPDFLoader(file_path)
-        documents = loader.load()
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50)
-        texts = text_splitter.split_documents(documents)
-
-        # Add to ChromaDB
-        vectorstore.add_texts(
-            [doc.page_content for doc in texts], 
-            ids=[str(uuid.uuid4()) for _ in texts],
-            metadatas=[{"pdf_uuid": pdf_uuid} for _ in texts]    
-        )
+        async with get_blob_client(file_path) as blob_client:
+            with spool, span("upload.receive"):
+                pdf_uuid, block_ids = await spool_upload(file, blob_client, spool)
 
-        os.remove(file_path)
+            # Documents are keyed by content, so re-uploading the same PDF reuses its index entries.
+            # The document is claimed before its blob is committed; blocks staged for a duplicate
+            # are never committed, and Azure discards them.
+            async with borrow_db() as db:
+                claimed = await register_document(db, pdf_uuid, file_path, file.filename)
+                existing = None if claimed else await db.fetchrow("SELECT pdf_path, status FROM pdf_documents WHERE pdf_uuid = $1", pdf_uuid)
+            if not claimed:
+                await run_in_threadpool(os.remove, spool.name)
+                return {"message": "File already uploaded", "pdf_path": existing and existing["pdf_path"], "pdf_uuid": pdf_uuid, "deduplicated": True}
 
-        return {"message": "File uploaded successfully", "pdf_path": file_path, "pdf_uuid":pdf_uuid}
+            try:
+                with span("upload.commit"):
+                    await blob_client.commit_block_list(block_ids)
+            except Exception as e:
+                await abandon_document(pdf_uuid, e)
+                raise
+
+        # Parsing, embedding and indexing continue after the response; progress is at /ingest/{pdf_uuid}
+        task = asyncio.create_task(ingest_pdf(pdf_uuid, spool.name))
+        ingest_tasks.add(task)
+        task.add_done_callback(ingest_tasks.discard)
+
+        return {"message": "File uploaded successfully", "pdf_path": file_path, "pdf_uuid":pdf_uuid, "deduplicated": False}
     except Exception as e:
         print(e)
+        if os.path.exists(spool.name):
+            await run_in_threadpool(os.remove, spool.name)
+        if isinstance(e, HTTPException):
+            raise
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
 
 
-@app.post("/rag_chat/")
-async def rag_chat(request: RAGChatRequest):
+@app.get("/ingest/{pdf_uuid}")
+async def get_ingest_status(pdf_uuid: str):
+    job = ingest_jobs.get(pdf_uuid)
+    if job is not None:
+        return {"pdf_uuid": pdf_uuid, **job}
 
-    retriever = vectorstore.as_retriever(
-            search_kwargs={"k": 5, "filter": {"pdf_uuid": request.pdf_uuid}}
-        )
-    
-    ### Contextualize question ###
-    contextualize_q_system_prompt = (
-        "Given a chat history and the latest user question "
-        "which might reference context in the chat history, "
-        "formulate a standalone question which can be understood "
-        "without the chat history. Do NOT answer the question, "
-        "just reformulate it if needed and otherwise return it as is."
-    )
-    contextualize_q_prompt = ChatPromptTemplate.from_messages(
-        [
-            ("system", contextualize_q_system_prompt),
-            MessagesPlaceholder("chat_history"),
-            ("human", "{input}"),
-        ]
-    )
-    history_aware_retriever = create_history_aware_retriever(
-        llm, retriever, contextualize_q_prompt
-    )
+    # Jobs from before the last restart are only known by their final state
+    async with db_pool.acquire() as db:
+        row = await db.fetchrow("SELECT status, chunk_count FROM pdf_documents WHERE pdf_uuid = $1", pdf_uuid)
+    if row is None:
+        raise HTTPException(status_code=404, detail="No ingestion job for this document")
+    return {"pdf_uuid": pdf_uuid, "status": row["status"], "pages_total": None, "pages_done": None, "chunks_indexed": row["chunk_count"], "chunks_skipped": None, "lines_stripped": None, "error": None}
 
+@app.get("/response_cache_stats/")
+async def get_response_cache_stats():
+    return (await get_response_cache.aget()).read_stats()
 
-    ### Answer question ###
-    system_prompt = (
-        "You are an assistant for question-answering tasks. "
-        "Use the following pieces of retrieved context to answer "
-        "the question. If you don't know the answer, say that you "
-        "don't know. Use three sentences maximum and keep the "
-        "answer concise."
-        "\n\n"
-        "{context}"
-    )
-    qa_prompt = ChatPromptTemplate.from_messages(
-        [
-            ("system", system_prompt),
-            MessagesPlaceholder("chat_history"),
-            ("human", "{input}"),
-        ]
-    )
-    question_answer_chain = create_stuff_documents_chain(llm, qa_prompt)
+@app.get("/embedding_cache_stats/")
+async def get_embedding_cache_stats():
+    return (await get_embedding_function.aget()).stats()
 
-    rag_chain = create_retrieval_chain(history_aware_retriever, question_answer_chain)
 
+@app.post("/rag_chat/")
+async def rag_chat(request: RAGChatRequest):
+    from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
+
+    start = time.perf_counter()
     chat_history = []
 
-    user_input = request.messages[-1]
-    previous_chat = request.messages[:-1]
+    # Checked before a slot is taken, so a malformed request never holds one
+    if not request.messages or any("role" not in message or "content" not in message for message in request.messages):
+        raise HTTPException(status_code=400, detail="Every message needs a role and content.")
+    user_input = request.messages[-1]["content"]
 
-    for message in request.messages:
-        if message["role"] == "user":
-            chat_history.append(HumanMessage(content=message["content"]))
-        if message["role"] == "assistant":
-            chat_history.append(AIMessage(content=message["content"]))
-    
-    # response = rag_chain.invoke({
-    #     "chat_history":chat_history,
-    #     "input":user_input
-    # })
+    # Unknown documents are not searched, so asking about one does not create an empty collection
+    if request.pdf_uuid not in ingest_jobs and await (await get_document_index.aget()).acollection(request.pdf_uuid) is None:
+        raise HTTPException(status_code=404, detail="Document not found")
+
+    cached, ticket = await lookup_response("rag_chat", request.messages, pdf_uuid=request.pdf_uuid, options=(request.k,))
+    if cached is not None:
+        return replay_response("rag_chat", cached, request.stream_format, start)
+
+    slot = await admit("interactive")
+    try:
+        with span("rag.history"):
+            previous_chat = await (await get_history_manager.aget()).fit(request.messages[:-1], request.chat_id)
 
-    chain = rag_chain.pick("answer")
+        for message in previous_chat:
+            if message["role"] == "user":
+                chat_history.append(HumanMessage(content=message["content"]))
+            if message["role"] == "assistant":
+                chat_history.append(AIMessage(content=message["content"]))
+            if message["role"] == "system":
+                chat_history.append(SystemMessage(content=message["content"]))
 
-    stream = chain.stream({
-        "chat_history":chat_history,
-        "input":user_input
-    })
+        usage = {}
+        timing = {}
+        stream = (await get_rag_pipeline.aget()).astream(request.pdf_uuid, request.k, chat_history, user_input, usage=usage)
+        if ticket is not None:
+            stream = (await get_response_cache.aget()).record(ticket, stream, usage)
 
-    def stream_response():
-            for chunk in stream:
-                yield chunk
+        # Use StreamingResponse to return
+        return stream_tokens(
+            timed_stream("rag_chat", stream, start, timing),
+            request.stream_format, timing, usage,
+            max_delay=STREAM_COALESCE_MS / 1000, max_chars=STREAM_COALESCE_CHARS, slot=slot,
+        )
 
-    # Use StreamingResponse to return
-    return StreamingResponse(stream_response(), media_type="text/plain")
+    except Exception as e:
+        slot.release()
+        raise HTTPException(status_code=500, detail=str(e))
+    except BaseException:
+        slot.release()
+        raise
 
 
+@app.get("/admission_stats/")
+async def get_admission_stats():
+    return {name: lane.stats() for name, lane in lanes.items()}
 
+@app.get("/rag_stats/")
+async def get_rag_stats():
+    # How often each question-rewriting path was taken, and retrieval cache hits
+    pipeline = await get_rag_pipeline.aget()
+    return {"rewrite": pipeline.rewriter.stats, "retrieval_cache": pipeline.index.stats}
@@ -0,0 +1,99 @@
+"""Fill the chat_messages search table from the transcripts in blob storage.
+
+    python backfill_search.py [--missing-only] [--batch-size 100] [--concurrency 8]
+
+/save_chat/ and /append_chat/ keep chat_messages up to date as chats change;
+this indexes chats saved before the table existed, or rebuilds it after the
+tokenizer configuration changes. Each batch of chats is replaced in one
+transaction, so /search_chats/ never sees a half-indexed chat, and the job
+can be stopped and rerun at any point. --missing-only skips chats that
+already have rows.
+
+It also sets message_count of chats saved before that column existed, which
+are stored with 0; /load_chat/ clients compare it with the messages they
+have, and /append_chat/ numbers new messages after it.
+"""
+import argparse
+import asyncio
+import time
+
+import asyncpg
+
+from backend import settings, read_chat_messages, message_rows
+
+
+async def load_rows(chat_ids_paths, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def load(chat_id, file_path):
+        async with semaphore:
+            try:
+                return message_rows(chat_id, await read_chat_messages(file_path))
+            except Exception as e:
+                print(f"Skipping {chat_id}: {e}")
+                return None
+
+    results = await asyncio.gather(*(load(chat_id, file_path) for chat_id, file_path in chat_ids_paths))
+    return {chat_id: rows for (chat_id, _), rows in zip(chat_ids_paths, results) if rows is not None}
+
+
+async def backfill(args):
+    await asyncio.to_thread(settings.refresh)
+    db = await asyncpg.connect(
+        database=settings.get("DB_NAME"),
+        user=settings.get("DB_USER"),
+        password=settings.get("DB_PASSWORD"),
+        host=settings.get("DB_HOST"),
+        port=int(settings.get("DB_PORT")),
+    )
+    start = time.perf_counter()
+    chats = messages = counted = 0
+    last_id = ""
+    try:
+        while True:
+            # Keyset pagination, so chats created while the job runs cannot shift the batches
+            batch = await db.fetch(
+                f"""
+                SELECT id, file_path FROM advanced_chats c
+                WHERE id > $1 {"AND NOT EXISTS (SELECT 1 FROM chat_messages m WHERE m.chat_id = c.id)" if args.missing_only else ""}
+                ORDER BY id LIMIT $2
+                """,
+                last_id, args.batch_size,
+            )
+            if not batch:
+                break
+            last_id = batch[-1]["id"]
+
+            loaded = await load_rows([(row["id"], row["file_path"]) for row in batch], args.concurrency)
+            async with db.transaction():
+                await db.execute("DELETE FROM chat_messages WHERE chat_id = ANY($1::text[])", list(loaded))
+                await db.copy_records_to_table(
+                    "chat_messages",
+                    records=[row for rows in loaded.values() for row in rows],
+                    columns=["chat_id", "seq", "role", "content"],
+                )
+                # A count is only raised: a chat appended to since its transcript was read is already ahead
+                fixed = await db.fetch(
+                    """
+                    UPDATE advanced_chats c SET message_count = t.message_count
+                    FROM unnest($1::text[], $2::int[]) AS t(id, message_count)
+                    WHERE c.id = t.id AND c.message_count < t.message_count
+                    RETURNING c.id
+                    """,
+                    list(loaded), [len(rows) for rows in loaded.values()],
+                )
+            chats += len(loaded)
+            messages += sum(len(rows) for rows in loaded.values())
+            counted += len(fixed)
+            print(f"Indexed {chats} chats, {messages} messages; set message_count of {counted} chats")
+    finally:
+        await db.close()
+    print(f"Done in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--batch-size", type=int, default=100, help="chats per transaction")
+    parser.add_argument("--concurrency", type=int, default=8, help="transcripts downloaded at once")
+    parser.add_argument("--missing-only", action="store_true", help="only index chats that have no rows yet")
+    asyncio.run(backfill(parser.parse_args()))
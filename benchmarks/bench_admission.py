@@ -0,0 +1,155 @@
+"""Chat latency with and without bulk ingestion running alongside it.
+
+    python benchmarks/bench_admission.py --scenario rag_chat --concurrency 8 --duration 30
+    python benchmarks/bench_admission.py --ingest-clients 4 --ingest-pages 200 --max-p99-increase 0.25
+
+Starts the same stand-ins as bench_e2e.py, then runs the chat scenario
+twice for --duration seconds: once alone, and once while --ingest-clients
+clients upload --ingest-pages page PDFs back to back, each waiting for its
+document to be indexed before sending the next (and backing off on 429).
+The embedding token budget is lowered with --embedding-tokens-per-minute
+so ingestion runs into it, as it would against a real account.
+
+Reports chat p50/p95/p99 latency and time to first token for both runs,
+how many uploads were accepted, turned away or failed, and the admission
+lane metrics scraped from /metrics. The exit code is non-zero if chat p99
+grew by more than --max-p99-increase while ingestion was running.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import uuid
+
+import httpx
+
+from bench_e2e import Scenarios, Stack, format_ms, make_pdf, page_text, prepare_document, run_scenario
+
+
+class Ingestion:
+    """Clients uploading large PDFs for as long as they run."""
+
+    def __init__(self, url, pages):
+        self.url = url
+        self.pages = pages
+        self.stats = {"accepted": 0, "rejected": 0, "indexed": 0, "failed": 0}
+        self.stopping = False
+
+    async def client(self, http, worker):
+        n = 0
+        while not self.stopping:
+            nonce = uuid.uuid4().hex
+            pdf = make_pdf([f"{nonce} {page} {page_text(worker * 1000 + n + page)}" for page in range(self.pages)])
+            n += 1
+            try:
+                response = await http.post(f"{self.url}/upload_pdf/", files={"file": (f"{nonce}.pdf", pdf, "application/pdf")})
+            except httpx.HTTPError:
+                self.stats["failed"] += 1
+                continue
+            if response.status_code == 429:
+                self.stats["rejected"] += 1
+                await asyncio.sleep(min(float(response.headers.get("retry-after", 1)), 1))
+                continue
+            if response.status_code >= 400:
+                self.stats["failed"] += 1
+                continue
+            self.stats["accepted"] += 1
+            pdf_uuid = response.json()["pdf_uuid"]
+            while not self.stopping:
+                status = (await http.get(f"{self.url}/ingest/{pdf_uuid}")).json()["status"]
+                if status in ("done", "failed"):
+                    self.stats["indexed" if status == "done" else "failed"] += 1
+                    break
+                await asyncio.sleep(0.5)
+
+    async def run(self, http, clients):
+        await asyncio.gather(*(self.client(http, worker) for worker in range(clients)))
+
+
+async def lane_metrics(http, url):
+    text = (await http.get(f"{url}/metrics")).text
+    return [line for line in text.splitlines() if line.startswith("lane_") and "_created" not in line and "_bucket" not in line]
+
+
+def report(results):
+    print(f"{'run':<18}{'requests':>9}{'errors':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'ttft50':>9}{'ttft95':>9}{'ttft99':>9}")
+    for name, result in results.items():
+        print(
+            f"{name:<18}{result['requests']:9d}{result['errors']:8d}"
+            + "".join(format_ms(result[key]) for key in ("p50_ms", "p95_ms", "p99_ms", "ttft_p50_ms", "ttft_p95_ms", "ttft_p99_ms"))
+        )
+
+
+async def main(args):
+    # The backend inherits these through the Stack's environment
+    os.environ["EMBEDDING_TOKENS_PER_MINUTE"] = str(args.embedding_tokens_per_minute)
+    os.environ["LANE_BULK_LIMIT"] = str(args.bulk_limit)
+    os.environ["LANE_BULK_QUEUE"] = str(args.bulk_queue)
+
+    stack = Stack(args)
+    try:
+        await stack.start()
+        limits = httpx.Limits(max_connections=(args.concurrency + args.ingest_clients) * 2)
+        async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as http:
+            pdf_uuid = await prepare_document(http, stack.url, args.document_pages)
+            request = getattr(Scenarios(stack.url, pdf_uuid), args.scenario)
+            results = {}
+
+            print(f"Running {args.scenario} alone ...", flush=True)
+            results["alone"] = await run_scenario(http, request, args.concurrency, args.duration, args.warmup)
+
+            print(f"Running {args.scenario} with {args.ingest_clients} ingest clients ...", flush=True)
+            ingestion = Ingestion(stack.url, args.ingest_pages)
+            ingest = asyncio.create_task(ingestion.run(http, args.ingest_clients))
+            # Let the first documents reach the embedding stage
+            await asyncio.sleep(args.ingest_lead)
+            results["with ingestion"] = await run_scenario(http, request, args.concurrency, args.duration, 0)
+            metrics = await lane_metrics(http, stack.url)
+            ingestion.stopping = True
+            await ingest
+    finally:
+        stack.stop()
+
+    print()
+    report(results)
+    stats = ingestion.stats
+    print(f"\nUploads: {stats['accepted']} accepted, {stats['rejected']} turned away with 429, "
+          f"{stats['indexed']} indexed during the run, {stats['failed']} failed")
+    print("\nAdmission lanes:")
+    for line in metrics:
+        print(f"  {line}")
+
+    alone, loaded = results["alone"]["p99_ms"], results["with ingestion"]["p99_ms"]
+    if not alone or not loaded:
+        print("\nNo chat requests completed")
+        return 1
+    change = loaded / alone - 1
+    print(f"\nChat p99 {alone:.1f} -> {loaded:.1f} ms ({change:+.1%}, limit {args.max_p99_increase:.0%})")
+    return 1 if change > args.max_p99_increase else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenario", choices=["chat", "rag_chat"], default="rag_chat")
+    parser.add_argument("--concurrency", type=int, default=8, help="chat clients")
+    parser.add_argument("--duration", type=float, default=30, help="seconds per run")
+    parser.add_argument("--warmup", type=int, default=3, help="sequential requests before the first run")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--ingest-clients", type=int, default=4)
+    parser.add_argument("--ingest-pages", type=int, default=200, help="pages per uploaded PDF")
+    parser.add_argument("--ingest-lead", type=float, default=5, help="seconds ingestion runs before chat is measured")
+    parser.add_argument("--embedding-tokens-per-minute", type=int, default=300_000)
+    parser.add_argument("--bulk-limit", type=int, default=4, help="LANE_BULK_LIMIT for the backend")
+    parser.add_argument("--bulk-queue", type=int, default=16, help="LANE_BULK_QUEUE for the backend")
+    parser.add_argument("--max-p99-increase", type=float, default=0.25)
+    parser.add_argument("--tokens", type=int, default=50, help="tokens per fake completion")
+    parser.add_argument("--token-delay", type=float, default=0.02)
+    parser.add_argument("--first-token-delay", type=float, default=0.2)
+    parser.add_argument("--document-pages", type=int, default=20, help="pages in the document /rag_chat/ asks about")
+    parser.add_argument("--db-host", help="use this Postgres instead of a throwaway cluster; its tables are written to")
+    parser.add_argument("--db-port", type=int, default=5432)
+    parser.add_argument("--db-user", default="postgres")
+    parser.add_argument("--db-password", default="")
+    parser.add_argument("--db-name", default="bench")
+    parser.add_argument("--keep-workdir", action="store_true", help="keep logs and data of the stand-ins")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,110 @@
+"""Per-request cost of /rag_chat/ up to the first answer chunk, before and after the prebuilt pipeline.
+
+    python benchmarks/bench_chain_construction.py --iterations 200 --documents 20 --chunks 100
+
+"Before" is what /rag_chat/ used to do for every request: build the
+retriever, prompts and chains with create_history_aware_retriever,
+create_stuff_documents_chain and create_retrieval_chain, then stream the
+answer. It searches the shared collection, filtered to the document. "After"
+is RAGPipeline.astream on the pipeline built at startup. It searches the
+document's own collection. Both are timed from the start of the request to
+the first chunk of the answer, with a different question each time so the
+retrieval cache does not hide the search. Neither path touches the network:
+a fake chat model, fake embeddings and an in-memory Chroma stand in for
+OpenAI and the Chroma server.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import tracemalloc
+
+import chromadb
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from langchain_chroma import Chroma
+from langchain_core.embeddings import FakeEmbeddings
+from langchain_core.language_models import FakeListChatModel
+from langchain.chains import create_history_aware_retriever, create_retrieval_chain
+from langchain.chains.combine_documents import create_stuff_documents_chain
+
+from document_index import SHARED_COLLECTION, DocumentIndex
+from rag_chain import RAGPipeline, contextualize_q_prompt, qa_prompt
+
+
+def build_per_request(llm, vectorstore, pdf_uuid, k):
+    retriever = vectorstore.as_retriever(search_kwargs={"k": k, "filter": {"pdf_uuid": pdf_uuid}})
+    history_aware_retriever = create_history_aware_retriever(llm, retriever, contextualize_q_prompt)
+    question_answer_chain = create_stuff_documents_chain(llm, qa_prompt)
+    return create_retrieval_chain(history_aware_retriever, question_answer_chain).pick("answer")
+
+
+async def before(llm, vectorstore, pdf_uuid, k, question):
+    chain = build_per_request(llm, vectorstore, pdf_uuid, k)
+    async for chunk in chain.astream({"input": question, "chat_history": []}):
+        if chunk:
+            return chunk
+
+
+async def after(pipeline, pdf_uuid, k, question):
+    stream = pipeline.astream(pdf_uuid, k, [], question)
+    try:
+        async for chunk in stream:
+            return chunk
+    finally:
+        await stream.aclose()
+
+
+async def measure(label, request, iterations):
+    await request(-1)  # warm up imports and caches
+    start = time.perf_counter()
+    for i in range(iterations):
+        await request(i)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    for i in range(iterations, 2 * iterations):
+        await request(i)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    per_request_ms = elapsed / iterations * 1000
+    print(f"{label:<8} {per_request_ms:>8.2f} ms to first chunk   peak traced {peak / 1024:>8.1f} KiB")
+    return per_request_ms
+
+
+async def load_documents(client, embeddings, documents, chunks):
+    # The same chunks go into the old shared collection and into per-document collections
+    shared = Chroma(client=client, collection_name=SHARED_COLLECTION, embedding_function=embeddings)
+    index = DocumentIndex(client, embeddings)
+    for d in range(documents):
+        pdf_uuid = f"doc{d}"
+        texts = [f"Chunk {n} of document {pdf_uuid}, about topic {n % 17}." for n in range(chunks)]
+        ids = [f"{pdf_uuid}-{n}-0" for n in range(chunks)]
+        metadatas = [{"pdf_uuid": pdf_uuid, "page": n} for n in range(chunks)]
+        shared.add_texts(texts, ids=ids, metadatas=metadatas)
+        await index.aadd_texts(pdf_uuid, texts, ids=ids, metadatas=metadatas)
+    return shared, index
+
+
+async def main(args):
+    llm = FakeListChatModel(responses=["The document says it is fine."])
+    embeddings = FakeEmbeddings(size=64)
+    shared, index = await load_documents(chromadb.EphemeralClient(), embeddings, args.documents, args.chunks)
+    pipeline = RAGPipeline(llm, index)
+
+    pdf_uuid = "doc0"
+    old = await measure("before", lambda i: before(llm, shared, pdf_uuid, args.k, f"What is topic {i}?"), args.iterations)
+    new = await measure("after", lambda i: after(pipeline, pdf_uuid, args.k, f"What is topic {i}?"), args.iterations)
+    print(f"speedup  {old / new:>8.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--documents", type=int, default=20, help="documents in the collection")
+    parser.add_argument("--chunks", type=int, default=100, help="chunks per document")
+    parser.add_argument("--k", type=int, default=5)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,184 @@
+"""Compare the original character splitter with the deduplicating chunker.
+
+    python benchmarks/bench_chunking.py [--pdf report.pdf] [--chunker tokens] [--queries 200]
+
+Without --pdf, a synthetic report is generated with a running header, a page
+footer and a disclaimer paragraph repeated in the middle of every page. Both pipelines
+split the document the way ingestion does. The baseline keeps every chunk of
+the 500-character splitter. The new pipeline strips headers and footers,
+splits with --chunker and drops duplicate chunks. The chunks are embedded
+with the fake OpenAI server's deterministic vectors and stored in a temporary
+persistent Chroma collection. The script reports embeddings per document,
+index size on disk, k=5 query latency, and how many of the top-5 results
+repeat text already in the results.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import chromadb
+
+from chunking import Deduplicator, fingerprint, get_splitter, is_informative, strip_repeated_lines
+from pdf_processing import open_pdf
+from fake_openai import embed
+
+WORDS = (
+    "revenue margin customer growth quarter product market segment operating cost forecast "
+    "region supply demand pricing contract service platform investment risk capital team"
+).split()
+DISCLAIMER = (
+    "This document contains forward-looking statements that involve risks and uncertainties. "
+    "Actual results may differ materially from those expressed or implied in these statements. "
+    "Factors that could cause such differences include changes in demand, pricing pressure, "
+    "supply disruptions and the other risks described in our filings. We undertake no obligation "
+    "to update these statements, except as required by law."
+)
+
+
+def escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_report(path, pages, seed=0):
+    rng = random.Random(seed)
+    offsets = []
+    with open(path, "wb") as f:
+        def write_object(body):
+            offsets.append(f.tell())
+            f.write(f"{len(offsets)} 0 obj\n".encode("ascii") + body + b"\nendobj\n")
+
+        f.write(b"%PDF-1.4\n")
+        page_ids = [4 + 2 * i for i in range(pages)]
+        write_object(b"<< /Type /Catalog /Pages 2 0 R >>")
+        kids = " ".join(f"{page_id} 0 R" for page_id in page_ids).encode("ascii")
+        write_object(b"<< /Type /Pages /Kids [" + kids + b"] /Count " + str(pages).encode("ascii") + b" >>")
+        write_object(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+        for i in range(pages):
+            lines = ["Example Corp Annual Report - Confidential"]
+            for paragraph in range(6):
+                sentence = " ".join(rng.choice(WORDS) for _ in range(rng.randint(40, 80)))
+                lines.extend(sentence[start:start + 90] for start in range(0, len(sentence), 90))
+                if paragraph == 2:
+                    lines.extend(DISCLAIMER[start:start + 90] for start in range(0, len(DISCLAIMER), 90))
+            lines.append(f"Page {i + 1} of {pages}")
+            body = "BT /F1 9 Tf 11 TL 50 760 Td " + " ".join(f"({escape(line)}) Tj T*" for line in lines) + " ET"
+            content = body.encode("ascii")
+            write_object(
+                f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {page_ids[i] + 1} 0 R "
+                f"/Resources << /Font << /F1 3 0 R >> >> >>".encode("ascii")
+            )
+            write_object(b"<< /Length " + str(len(content)).encode("ascii") + b" >>\nstream\n" + content + b"\nendstream")
+
+        xref_offset = f.tell()
+        f.write(f"xref\n0 {len(offsets) + 1}\n0000000000 65535 f \n".encode("ascii"))
+        for offset in offsets:
+            f.write(f"{offset:010d} 00000 n \n".encode("ascii"))
+        f.write(f"trailer\n<< /Size {len(offsets) + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode("ascii"))
+
+
+def disk_usage(path):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(path) for name in files)
+
+
+def read_pages(path):
+    with open_pdf(path) as reader:
+        return [page.extract_text() for page in reader.pages]
+
+
+def baseline_chunks(pages):
+    splitter = get_splitter("characters")
+    return [chunk for text in pages for chunk in splitter.split_text(text)]
+
+
+def deduplicated_chunks(pages, chunker, pages_per_task):
+    splitter = get_splitter(chunker)
+    dedup = Deduplicator()
+    chunks = []
+    stripped = 0
+    # Headers and footers are stripped per worker range, as in ingestion
+    for start in range(0, len(pages), pages_per_task):
+        texts, removed = strip_repeated_lines(pages[start:start + pages_per_task])
+        stripped += removed
+        for text in texts:
+            for chunk in splitter.split_text(text):
+                if is_informative(chunk) and not dedup.is_duplicate(*fingerprint(chunk)):
+                    chunks.append(chunk)
+    return chunks, stripped, dedup.stats
+
+
+def measure_index(chunks, queries, k):
+    with tempfile.TemporaryDirectory() as path:
+        client = chromadb.PersistentClient(path=path)
+        collection = client.create_collection("bench", embedding_function=None)
+        for start in range(0, len(chunks), 1000):
+            batch = chunks[start:start + 1000]
+            collection.add(
+                ids=[str(start + i) for i in range(len(batch))],
+                embeddings=[embed(chunk).tolist() for chunk in batch],
+                documents=batch,
+            )
+        size = disk_usage(path)
+
+        latencies = []
+        repeated = 0
+        for query in queries:
+            vector = embed(query).tolist()
+            started = time.perf_counter()
+            result = collection.query(query_embeddings=[vector], n_results=k)
+            latencies.append((time.perf_counter() - started) * 1000)
+            seen = set()
+            for document in result["documents"][0]:
+                exact, _ = fingerprint(document)
+                repeated += exact in seen
+                seen.add(exact)
+    latencies.sort()
+    return {
+        "bytes": size,
+        "p50": statistics.median(latencies),
+        "p95": latencies[int(0.95 * (len(latencies) - 1))],
+        "repeated": repeated / len(queries),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pdf", help="a PDF to chunk; a synthetic report is generated otherwise")
+    parser.add_argument("--pages", type=int, default=200, help="pages of the synthetic report")
+    parser.add_argument("--chunker", default=None, help="splitter for the new pipeline, defaults to PDF_CHUNKER")
+    parser.add_argument("--pages-per-task", type=int, default=int(os.environ.get("PDF_PAGES_PER_TASK", 10)))
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        path = args.pdf
+        if path is None:
+            path = os.path.join(workdir, "report.pdf")
+            write_report(path, args.pages)
+        pages = read_pages(path)
+
+    baseline = baseline_chunks(pages)
+    chunks, stripped, skipped = deduplicated_chunks(pages, args.chunker, args.pages_per_task)
+    # Queries are chunk texts sampled from the baseline, so both indexes are asked the same questions
+    queries = random.Random(0).choices(baseline, k=args.queries)
+
+    print(f"{len(pages)} pages, {stripped} header and footer lines stripped")
+    print(f"Duplicate chunks dropped: {skipped['exact']} exact, {skipped['near']} near")
+    print(f"Embeddings per document: {len(baseline)} -> {len(chunks)} ({len(baseline) - len(chunks)} saved)")
+    print(f"Embedded characters: {sum(map(len, baseline))} -> {sum(map(len, chunks))}")
+    for label, texts in (("baseline", baseline), ("deduplicated", chunks)):
+        result = measure_index(texts, queries, args.k)
+        print(
+            f"{label:>12}: index {result['bytes'] / 1024 / 1024:.1f} MB, query p50 {result['p50']:.2f} ms, "
+            f"p95 {result['p95']:.2f} ms, repeated results per query {result['repeated']:.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,463 @@
+"""End-to-end load benchmark of the backend against local stand-ins.
+
+    python benchmarks/bench_e2e.py --concurrency 8 --duration 20 --save-baseline baseline.json
+    python benchmarks/bench_e2e.py --concurrency 8 --duration 20 --baseline baseline.json
+
+Nothing remote is needed. The harness starts:
+
+  - benchmarks/fake_openai.py for chat completions and embeddings,
+    with a configurable delay per token
+  - a directory standing in for blob storage (local_blob.py)
+  - a throwaway Postgres cluster, when initdb and pg_ctl are available
+    (pass --db-host and friends to use an existing, disposable database)
+  - a local Chroma server with its data in a temporary directory
+
+It then boots the backend with uvicorn and drives /save_chat/, /load_chat/,
+/chat/, /rag_chat/ and /upload_pdf/ in turn, each with --concurrency clients
+for --duration seconds. For every endpoint it reports requests per second,
+errors, p50/p95/p99 latency and, for streamed responses, time to first
+token. Peak RSS of the server and of its PDF workers is reported at the end.
+With --baseline the run is compared with a saved one, and the exit code is
+non-zero if any endpoint regressed by more than --max-regression.
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import asyncpg
+import httpx
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# Keep in sync with setup.sh
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS advanced_chats (
+        id TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        file_path TEXT NOT NULL,
+        last_update TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        pdf_path TEXT,
+        pdf_name TEXT,
+        pdf_uuid TEXT,
+        message_count INTEGER NOT NULL DEFAULT 0,
+        log_count INTEGER NOT NULL DEFAULT 0
+    )""",
+    """CREATE TABLE IF NOT EXISTS pdf_documents (
+        pdf_uuid TEXT PRIMARY KEY,
+        pdf_path TEXT NOT NULL,
+        pdf_name TEXT,
+        status TEXT NOT NULL,
+        chunk_count INTEGER NOT NULL DEFAULT 0,
+        pages_indexed INTEGER[] NOT NULL DEFAULT '{}',
+        claimed_at TIMESTAMP,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )""",
+    "CREATE INDEX IF NOT EXISTS advanced_chats_last_update_idx ON advanced_chats (last_update DESC, id DESC)",
+    """CREATE TABLE IF NOT EXISTS chat_messages (
+        chat_id TEXT NOT NULL REFERENCES advanced_chats (id) ON DELETE CASCADE,
+        seq INTEGER NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        content_tsv TSVECTOR GENERATED ALWAYS AS (to_tsvector('english', content)) STORED,
+        PRIMARY KEY (chat_id, seq)
+    )""",
+    "CREATE INDEX IF NOT EXISTS chat_messages_content_tsv_idx ON chat_messages USING GIN (content_tsv)",
+]
+
+SCENARIOS = ["save_chat", "load_chat", "chat", "rag_chat", "upload_pdf"]
+
+WORDS = (
+    "index latency budget replica shard cache vector token stream upload parser chunk "
+    "summary history ingest schema cursor commit blob worker pool query embedding"
+).split()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def make_pdf(pages):
+    # One line of text per page; small, valid, and unique when the text is
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for text in pages:
+        content = f"BT /F1 10 Tf 40 720 Td ({text}) Tj ET".encode("ascii")
+        page_id = len(objects) + 1
+        kids.append(f"{page_id} 0 R")
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {page_id + 1} 0 R "
+            f"/Resources << /Font << /F1 3 0 R >> >> >>".encode("ascii")
+        )
+        objects.append(b"<< /Length " + str(len(content)).encode("ascii") + b" >>\nstream\n" + content + b"\nendstream")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>".encode("ascii")
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += f"{i} 0 obj\n".encode("ascii") + body + b"\nendobj\n"
+    xref_offset = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode("ascii")
+    for offset in offsets:
+        out += f"{offset:010d} 00000 n \n".encode("ascii")
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode("ascii")
+    return bytes(out)
+
+
+def page_text(seed, words=120):
+    return " ".join(WORDS[(seed * 7 + i * 13) % len(WORDS)] for i in range(words))
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(p / 100 * (len(ordered) - 1)))]
+
+
+def peak_rss_mb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def child_pids(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [int(child) for child in f.read().split()]
+    except FileNotFoundError:
+        return []
+
+
+async def wait_until(check, timeout, what):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            if await check():
+                return
+        except (httpx.HTTPError, OSError):
+            pass
+        await asyncio.sleep(0.2)
+    raise TimeoutError(f"{what} did not come up within {timeout}s")
+
+
+class Stack:
+    """The stand-in services and the backend, each in its own process."""
+
+    def __init__(self, args):
+        self.args = args
+        self.workdir = tempfile.mkdtemp(prefix="bench_e2e_")
+        self.processes = []
+        self.pg_data = None
+        self.pg_ctl = None
+        self.env = None
+        self.backend = None
+        self.url = None
+
+    def spawn(self, command, **kwargs):
+        log = open(os.path.join(self.workdir, f"{len(self.processes)}.log"), "wb")
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, **kwargs)
+        self.processes.append(process)
+        return process
+
+    async def start_postgres(self):
+        args = self.args
+        if args.db_host:
+            return {"DB_HOST": args.db_host, "DB_PORT": str(args.db_port), "DB_USER": args.db_user,
+                    "DB_PASSWORD": args.db_password, "DB_NAME": args.db_name}
+
+        candidates = [shutil.which("initdb")] + sorted(glob.glob("/usr/lib/postgresql/*/bin/initdb"), reverse=True)
+        initdb = next((path for path in candidates if path), None)
+        if initdb is None:
+            raise SystemExit("No initdb found; install Postgres or pass --db-host, --db-user, --db-password and --db-name")
+        bin_dir = os.path.dirname(initdb)
+        port = free_port()
+        self.pg_data = os.path.join(self.workdir, "postgres")
+        self.pg_ctl = os.path.join(bin_dir, "pg_ctl")
+        subprocess.run([initdb, "-D", self.pg_data, "-U", "bench", "-A", "trust", "--no-sync"], check=True, capture_output=True)
+        subprocess.run(
+            [self.pg_ctl, "-D", self.pg_data, "-l", os.path.join(self.workdir, "postgres.log"), "-w",
+             "-o", f"-p {port} -k {self.pg_data} -c listen_addresses=127.0.0.1", "start"],
+            check=True, capture_output=True,
+        )
+        db = await asyncpg.connect(host="127.0.0.1", port=port, user="bench", database="postgres")
+        try:
+            await db.execute("CREATE DATABASE bench")
+        finally:
+            await db.close()
+        return {"DB_HOST": "127.0.0.1", "DB_PORT": str(port), "DB_USER": "bench", "DB_PASSWORD": "bench", "DB_NAME": "bench"}
+
+    async def start(self):
+        args = self.args
+        db_settings = await self.start_postgres()
+        db = await asyncpg.connect(host=db_settings["DB_HOST"], port=int(db_settings["DB_PORT"]), user=db_settings["DB_USER"],
+                                   password=db_settings["DB_PASSWORD"], database=db_settings["DB_NAME"])
+        try:
+            for statement in SCHEMA:
+                await db.execute(statement)
+        finally:
+            await db.close()
+
+        openai_port = free_port()
+        self.spawn([sys.executable, os.path.join(ROOT, "benchmarks", "fake_openai.py"), "--port", str(openai_port),
+                    "--tokens", str(args.tokens), "--token-delay", str(args.token_delay),
+                    "--first-token-delay", str(args.first_token_delay)])
+
+        chroma_port = free_port()
+        self.spawn(["chroma", "run", "--path", os.path.join(self.workdir, "chroma"), "--port", str(chroma_port)],
+                   env={**os.environ, "ANONYMIZED_TELEMETRY": "False"})
+
+        self.env = {
+            **os.environ,
+            **db_settings,
+            # Settings come from the environment only
+            "KEY_VAULT_NAME": "",
+            "SETTINGS_FILE": "",
+            "OPENAI_API_KEY": "bench",
+            "OPENAI_BASE_URL": f"http://127.0.0.1:{openai_port}/v1",
+            "AZURE_STORAGE_SAS_URL": f"file://{os.path.join(self.workdir, 'blobs')}",
+            "AZURE_STORAGE_CONTAINER": "bench",
+            "CHROMADB_HOST": "127.0.0.1",
+            "CHROMADB_PORT": str(chroma_port),
+            "EMBEDDING_CACHE_DIR": os.path.join(self.workdir, "embedding_cache"),
+            "PDF_SPOOL_DIR": os.path.join(self.workdir, "spool"),
+            "ANONYMIZED_TELEMETRY": "False",
+        }
+        backend_port = free_port()
+        self.url = f"http://127.0.0.1:{backend_port}"
+        self.backend = self.spawn([sys.executable, "-m", "uvicorn", "backend:app", "--port", str(backend_port), "--log-level", "warning"],
+                                  cwd=ROOT, env=self.env)
+
+        async with httpx.AsyncClient() as http:
+            async def healthy(url):
+                return (await http.get(url)).status_code < 500
+            await wait_until(lambda: healthy(f"http://127.0.0.1:{openai_port}/docs"), 30, "fake OpenAI")
+            await wait_until(lambda: healthy(f"http://127.0.0.1:{chroma_port}/api/v1/heartbeat"), 60, "Chroma")
+            await wait_until(lambda: healthy(f"{self.url}/openapi.json"), 60, "backend")
+
+    def memory(self):
+        workers = [peak_rss_mb(pid) for pid in child_pids(self.backend.pid)]
+        workers = [rss for rss in workers if rss is not None]
+        return {"server_peak_rss_mb": peak_rss_mb(self.backend.pid), "worker_peak_rss_mb": max(workers, default=None)}
+
+    def stop(self):
+        for process in reversed(self.processes):
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if self.pg_ctl:
+            subprocess.run([self.pg_ctl, "-D", self.pg_data, "-m", "fast", "stop"], capture_output=True)
+        if self.args.keep_workdir:
+            print(f"Logs and data kept in {self.workdir}")
+        else:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+async def timed_stream(http, url, payload):
+    start = time.perf_counter()
+    ttft = None
+    async with http.stream("POST", url, json=payload) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes():
+            if chunk and ttft is None:
+                ttft = time.perf_counter() - start
+    return time.perf_counter() - start, ttft
+
+
+async def timed_request(http, method, url, **kwargs):
+    start = time.perf_counter()
+    response = await http.request(method, url, **kwargs)
+    response.raise_for_status()
+    return time.perf_counter() - start, None
+
+
+def conversation(turns):
+    messages = []
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"Question {i}: {page_text(i, 20)}?"})
+        messages.append({"role": "assistant", "content": page_text(i + 1, 60)})
+    return messages
+
+
+class Scenarios:
+    def __init__(self, url, pdf_uuid):
+        self.url = url
+        self.pdf_uuid = pdf_uuid
+
+    async def save_chat(self, http, n):
+        payload = {"chat_id": str(uuid.uuid4()), "chat_name": f"bench {n}", "messages": conversation(5)}
+        return await timed_request(http, "POST", f"{self.url}/save_chat/", json=payload)
+
+    async def load_chat(self, http, n):
+        return await timed_request(http, "GET", f"{self.url}/load_chat/")
+
+    async def chat(self, http, n):
+        payload = {"messages": conversation(2) + [{"role": "user", "content": f"Tell me about {WORDS[n % len(WORDS)]}."}]}
+        return await timed_stream(http, f"{self.url}/chat/", payload)
+
+    async def rag_chat(self, http, n):
+        payload = {
+            "messages": conversation(2) + [{"role": "user", "content": f"What does the document say about {WORDS[n % len(WORDS)]}?"}],
+            "pdf_uuid": self.pdf_uuid,
+        }
+        return await timed_stream(http, f"{self.url}/rag_chat/", payload)
+
+    async def upload_pdf(self, http, n):
+        nonce = uuid.uuid4().hex
+        pdf = make_pdf([f"{nonce} {page_text(n + page)}" for page in range(3)])
+        return await timed_request(http, "POST", f"{self.url}/upload_pdf/", files={"file": (f"{nonce}.pdf", pdf, "application/pdf")})
+
+
+async def prepare_document(http, url, pages):
+    pdf = make_pdf([f"Page {page}: {page_text(page)}" for page in range(pages)])
+    response = await http.post(f"{url}/upload_pdf/", files={"file": ("bench.pdf", pdf, "application/pdf")})
+    response.raise_for_status()
+    pdf_uuid = response.json()["pdf_uuid"]
+
+    async def ingested():
+        status = (await http.get(f"{url}/ingest/{pdf_uuid}")).json()["status"]
+        if status == "failed":
+            raise RuntimeError("Ingesting the benchmark document failed")
+        return status == "done"
+
+    await wait_until(ingested, 120, "document ingestion")
+    return pdf_uuid
+
+
+async def run_scenario(http, request, concurrency, duration, warmup):
+    for n in range(warmup):
+        await request(http, n)
+
+    latencies, ttfts, errors = [], [], 0
+    deadline = time.perf_counter() + duration
+
+    async def client(worker):
+        nonlocal errors
+        n = worker
+        while time.perf_counter() < deadline:
+            try:
+                latency, ttft = await request(http, n)
+            except httpx.HTTPError:
+                errors += 1
+            else:
+                latencies.append(latency)
+                if ttft is not None:
+                    ttfts.append(ttft)
+            n += concurrency
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(worker) for worker in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    result = {"requests": len(latencies), "errors": errors, "rps": len(latencies) / elapsed}
+    for p in (50, 95, 99):
+        result[f"p{p}_ms"] = percentile(latencies, p) * 1000 if latencies else None
+        result[f"ttft_p{p}_ms"] = percentile(ttfts, p) * 1000 if ttfts else None
+    return result
+
+
+def format_ms(value):
+    return f"{value:9.1f}" if value is not None else f"{'-':>9}"
+
+
+def report(results):
+    print(f"{'endpoint':<12}{'req/s':>9}{'errors':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'ttft50':>9}{'ttft95':>9}{'ttft99':>9}")
+    for name, result in results["endpoints"].items():
+        print(
+            f"{name:<12}{result['rps']:9.1f}{result['errors']:8d}"
+            + "".join(format_ms(result[key]) for key in ("p50_ms", "p95_ms", "p99_ms", "ttft_p50_ms", "ttft_p95_ms", "ttft_p99_ms"))
+        )
+    memory = results["memory"]
+    for label, key in (("server", "server_peak_rss_mb"), ("PDF workers", "worker_peak_rss_mb")):
+        if memory[key] is not None:
+            print(f"peak RSS, {label}: {memory[key]:.0f} MB")
+
+
+def compare(results, baseline, max_regression):
+    # Latencies may grow and throughput may drop by at most max_regression
+    regressions = []
+    print(f"\nCompared with baseline (limit {max_regression:.0%}):")
+    for name, result in results["endpoints"].items():
+        base = baseline["endpoints"].get(name)
+        if base is None:
+            continue
+        for key, higher_is_worse in (("rps", False), ("p95_ms", True), ("ttft_p95_ms", True)):
+            if result[key] is None or not base[key]:
+                continue
+            change = result[key] / base[key] - 1
+            worse = change > max_regression if higher_is_worse else change < -max_regression
+            print(f"  {name:<12}{key:<13}{base[key]:9.1f} -> {result[key]:9.1f}  {change:+7.1%}{'  REGRESSION' if worse else ''}")
+            if worse:
+                regressions.append((name, key))
+    return regressions
+
+
+async def main(args):
+    stack = Stack(args)
+    try:
+        await stack.start()
+        limits = httpx.Limits(max_connections=args.concurrency * 2, max_keepalive_connections=args.concurrency * 2)
+        async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as http:
+            pdf_uuid = await prepare_document(http, stack.url, args.document_pages) if "rag_chat" in args.scenarios else None
+            scenarios = Scenarios(stack.url, pdf_uuid)
+            results = {"config": {key: value for key, value in vars(args).items() if key not in ("baseline", "save_baseline")}, "endpoints": {}}
+            for name in args.scenarios:
+                print(f"Running {name} ...", flush=True)
+                results["endpoints"][name] = await run_scenario(http, getattr(scenarios, name), args.concurrency, args.duration, args.warmup)
+        results["memory"] = stack.memory()
+    finally:
+        stack.stop()
+
+    print()
+    report(results)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.max_regression):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=20, help="seconds per endpoint")
+    parser.add_argument("--warmup", type=int, default=3, help="sequential requests per endpoint before measuring")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--tokens", type=int, default=50, help="tokens per fake completion")
+    parser.add_argument("--token-delay", type=float, default=0.02)
+    parser.add_argument("--first-token-delay", type=float, default=0.2)
+    parser.add_argument("--document-pages", type=int, default=20, help="pages in the document /rag_chat/ asks about")
+    parser.add_argument("--db-host", help="use this Postgres instead of a throwaway cluster; its tables are written to")
+    parser.add_argument("--db-port", type=int, default=5432)
+    parser.add_argument("--db-user", default="postgres")
+    parser.add_argument("--db-password", default="")
+    parser.add_argument("--db-name", default="bench")
+    parser.add_argument("--baseline", help="compare with results saved by --save-baseline")
+    parser.add_argument("--save-baseline")
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    parser.add_argument("--keep-workdir", action="store_true", help="keep logs and data of the stand-ins")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,145 @@
+"""Peak memory of the PDF upload and parse path for a very large synthetic PDF.
+
+    python benchmarks/bench_large_upload.py --size-mb 300
+    python benchmarks/bench_large_upload.py --size-mb 300 --url http://127.0.0.1:5000 --server-pid <uvicorn pid>
+
+Writes a synthetic PDF of roughly --size-mb megabytes, mostly unreferenced
+padding streams plus one line of text per page, without holding it in memory.
+It then parses a page range in a worker process, as ingestion does, and reports
+that process's peak RSS. With --url, it also streams the file to /upload_pdf/
+and reports how far the server's peak RSS (VmHWM) grew. The exit code is
+non-zero if either peak exceeds --max-rss-mb.
+"""
+import argparse
+import multiprocessing
+import os
+import queue
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from pdf_processing import count_pages, load_and_split_pages
+
+
+def write_synthetic_pdf(path, size_mb, pages):
+    padding = b"0" * (size_mb * 1024 * 1024 // pages)
+    offsets = []
+
+    with open(path, "wb") as f:
+        def write_object(body):
+            offsets.append(f.tell())
+            f.write(f"{len(offsets)} 0 obj\n".encode("ascii") + body + b"\nendobj\n")
+
+        f.write(b"%PDF-1.4\n")
+        # 1: catalog, 2: page tree, 3: font; each page then takes three objects
+        page_ids = [4 + 3 * i for i in range(pages)]
+        write_object(b"<< /Type /Catalog /Pages 2 0 R >>")
+        kids = " ".join(f"{page_id} 0 R" for page_id in page_ids).encode("ascii")
+        write_object(b"<< /Type /Pages /Kids [" + kids + b"] /Count " + str(pages).encode("ascii") + b" >>")
+        write_object(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+        for i in range(pages):
+            content = f"BT /F1 12 Tf 72 720 Td (Synthetic page {i} of the large upload benchmark.) Tj ET".encode("ascii")
+            write_object(
+                f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents {page_ids[i] + 1} 0 R "
+                f"/Resources << /Font << /F1 3 0 R >> >> >>".encode("ascii")
+            )
+            write_object(b"<< /Length " + str(len(content)).encode("ascii") + b" >>\nstream\n" + content + b"\nendstream")
+            write_object(b"<< /Length " + str(len(padding)).encode("ascii") + b" >>\nstream\n" + padding + b"\nendstream")
+
+        xref_offset = f.tell()
+        f.write(f"xref\n0 {len(offsets) + 1}\n0000000000 65535 f \n".encode("ascii"))
+        for offset in offsets:
+            f.write(f"{offset:010d} 00000 n \n".encode("ascii"))
+        f.write(f"trailer\n<< /Size {len(offsets) + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode("ascii"))
+
+
+def parse_first_range(path, pages_per_task, result):
+    total = count_pages(path)
+    _, chunks, _, _ = load_and_split_pages(path, 0, min(pages_per_task, total))
+    result.put((total, len(chunks), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def wait_for_result(worker, result, timeout):
+    # None if the worker died without a result, or did not finish in time
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        alive = worker.is_alive()
+        try:
+            return result.get(timeout=1)
+        except queue.Empty:
+            if not alive:
+                return None
+    return None
+
+
+def read_vm_hwm_mb(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return None
+
+
+def upload(url, path, server_pid):
+    import httpx
+
+    before = read_vm_hwm_mb(server_pid) if server_pid else None
+    start = time.perf_counter()
+    with open(path, "rb") as f, httpx.Client(timeout=None) as http:
+        response = http.post(f"{url}/upload_pdf/", files={"file": ("synthetic.pdf", f, "application/pdf")})
+    response.raise_for_status()
+    elapsed = time.perf_counter() - start
+    after = read_vm_hwm_mb(server_pid) if server_pid else None
+    return elapsed, response.json(), before, after
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=300)
+    parser.add_argument("--pages", type=int, default=600)
+    parser.add_argument("--pages-per-task", type=int, default=10)
+    parser.add_argument("--max-rss-mb", type=float, default=256)
+    parser.add_argument("--parse-timeout", type=float, default=600, help="seconds to wait for the parse worker")
+    parser.add_argument("--url")
+    parser.add_argument("--server-pid", type=int)
+    args = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "synthetic.pdf")
+        start = time.perf_counter()
+        write_synthetic_pdf(path, args.size_mb, args.pages)
+        print(f"wrote {os.path.getsize(path) / 1024 / 1024:.0f} MB PDF in {time.perf_counter() - start:.1f}s")
+
+        result = multiprocessing.get_context("spawn").Queue()
+        worker = multiprocessing.get_context("spawn").Process(target=parse_first_range, args=(path, args.pages_per_task, result))
+        worker.start()
+        parsed = wait_for_result(worker, result, args.parse_timeout)
+        if parsed is None:
+            worker.terminate()
+        worker.join()
+        if parsed is None or worker.exitcode:
+            # e.g. killed by the OOM killer, which is what this benchmark is looking for
+            print(f"parse worker failed: exit code {worker.exitcode}, {'no result' if parsed is None else 'result discarded'}")
+            failed = True
+        else:
+            total, chunks, peak_mb = parsed
+            print(f"parse worker: {total} pages, {chunks} chunks from first range, peak RSS {peak_mb:.0f} MB")
+            failed |= peak_mb > args.max_rss_mb
+
+        if args.url:
+            elapsed, body, before, after = upload(args.url, path, args.server_pid)
+            print(f"upload: {elapsed:.1f}s -> {body}")
+            if before is not None:
+                print(f"server peak RSS: {before:.0f} MB -> {after:.0f} MB")
+                failed |= after - before > args.max_rss_mb
+
+    print("FAIL" if failed else "OK")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
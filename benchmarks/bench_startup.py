@@ -0,0 +1,73 @@
+"""Cold-start cost of the backend: import time and time to first response.
+
+    python benchmarks/bench_startup.py
+    python benchmarks/bench_startup.py --serve --port 5055
+
+Each sample runs in a fresh interpreter so nothing is cached in-process.
+"import backend" is timed against importing the modules the backend used to
+load eagerly (LangChain, Chroma, OpenAI, pypdf), which now load on first use
+or in the background warm-up. With --serve, uvicorn is started and the time
+until /openapi.json answers is reported; that needs the database and the
+settings (Key Vault, environment or SETTINGS_FILE) the backend normally uses.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import requests
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+
+HEAVY_IMPORTS = (
+    "import openai, chromadb, langchain_openai, langchain.storage, langchain_core.messages, "
+    "embedding_cache, rag_chain, document_index, history, pdf_processing"
+)
+
+
+def time_import(statement):
+    code = f"import time; t = time.perf_counter(); {statement}; print(time.perf_counter() - t)"
+    out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+
+def time_first_response(port, timeout):
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "backend:app", "--port", str(port)],
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                if requests.get(f"http://127.0.0.1:{port}/openapi.json", timeout=1).ok:
+                    return time.perf_counter() - start
+            except requests.ConnectionError:
+                pass
+            time.sleep(0.05)
+        raise TimeoutError(f"backend did not answer within {timeout}s")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def report(label, samples):
+    print(f"{label:<28} median {statistics.median(samples) * 1000:8.1f} ms   max {max(samples) * 1000:8.1f} ms")
+
+
+def main(args):
+    report("import backend", [time_import("import backend") for _ in range(args.samples)])
+    report("deferred heavy imports", [time_import(HEAVY_IMPORTS) for _ in range(args.samples)])
+    if args.serve:
+        report("time to first response", [time_first_response(args.port, args.timeout) for _ in range(args.samples)])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--samples", type=int, default=5)
+    parser.add_argument("--serve", action="store_true")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--timeout", type=float, default=60)
+    main(parser.parse_args())
@@ -0,0 +1,133 @@
+"""A stand-in for the OpenAI API: streamed chat completions and embeddings.
+
+    python benchmarks/fake_openai.py --port 8100 --token-delay 0.02
+
+Point the backend at it with OPENAI_BASE_URL=http://127.0.0.1:8100/v1.
+Completions answer with --tokens tokens, the first after --first-token-delay
+seconds and the rest --token-delay seconds apart. Embeddings are
+deterministic pseudo-random unit vectors derived from the input, so the same
+text always gets the same vector. With --embedding-429-rate, that share of
+embedding requests is refused with a 429 and a Retry-After header, to
+exercise the backend's backoff.
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import random
+import time
+import uuid
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+app = FastAPI()
+config = {"tokens": 50, "token_delay": 0.02, "first_token_delay": 0.2, "dimensions": 1536, "embedding_429_rate": 0.0, "retry_after": 0.5}
+
+
+def completion_chunk(completion_id, model, delta, finish_reason=None):
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+def usage(messages, completion_tokens):
+    prompt_tokens = sum(len(str(message.get("content", "")).split()) for message in messages)
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    model = body.get("model", "gpt-3.5-turbo")
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    tokens = [f"token{i} " for i in range(config["tokens"])]
+
+    if not body.get("stream"):
+        await asyncio.sleep(config["first_token_delay"] + config["token_delay"] * (len(tokens) - 1))
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop"}],
+            "usage": usage(body["messages"], len(tokens)),
+        }
+
+    async def stream():
+        await asyncio.sleep(config["first_token_delay"])
+        yield f"data: {json.dumps(completion_chunk(completion_id, model, {'role': 'assistant', 'content': ''}))}\n\n"
+        for i, token in enumerate(tokens):
+            if i:
+                await asyncio.sleep(config["token_delay"])
+            yield f"data: {json.dumps(completion_chunk(completion_id, model, {'content': token}))}\n\n"
+        yield f"data: {json.dumps(completion_chunk(completion_id, model, {}, 'stop'))}\n\n"
+        if (body.get("stream_options") or {}).get("include_usage"):
+            chunk = {**completion_chunk(completion_id, model, {}), "choices": [], "usage": usage(body["messages"], len(tokens))}
+            yield f"data: {json.dumps(chunk)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+
+def embed(value):
+    seed = int.from_bytes(hashlib.sha256(json.dumps(value).encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(config["dimensions"]).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    body = await request.json()
+    if random.random() < config["embedding_429_rate"]:
+        return JSONResponse(
+            {"error": {"message": "Rate limit reached for requests", "type": "requests", "code": "rate_limit_exceeded"}},
+            status_code=429,
+            headers={"retry-after": str(config["retry_after"])},
+        )
+    inputs = body["input"]
+    # A single string, a list of strings, or (from LangChain) lists of token ids
+    if isinstance(inputs, str) or inputs and isinstance(inputs[0], int):
+        inputs = [inputs]
+
+    data = []
+    for i, value in enumerate(inputs):
+        vector = embed(value)
+        if body.get("encoding_format") == "base64":
+            embedding = base64.b64encode(vector.tobytes()).decode("ascii")
+        else:
+            embedding = vector.tolist()
+        data.append({"object": "embedding", "index": i, "embedding": embedding})
+
+    tokens = sum(len(value) if isinstance(value, list) else len(value.split()) for value in inputs)
+    return {
+        "object": "list",
+        "data": data,
+        "model": body.get("model", "text-embedding-ada-002"),
+        "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--tokens", type=int, default=config["tokens"])
+    parser.add_argument("--token-delay", type=float, default=config["token_delay"])
+    parser.add_argument("--first-token-delay", type=float, default=config["first_token_delay"])
+    parser.add_argument("--dimensions", type=int, default=config["dimensions"])
+    parser.add_argument("--embedding-429-rate", type=float, default=config["embedding_429_rate"])
+    parser.add_argument("--retry-after", type=float, default=config["retry_after"])
+    args = parser.parse_args()
+    config.update(
+        tokens=args.tokens, token_delay=args.token_delay, first_token_delay=args.first_token_delay, dimensions=args.dimensions,
+        embedding_429_rate=args.embedding_429_rate, retry_after=args.retry_after,
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
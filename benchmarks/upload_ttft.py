@@ -0,0 +1,75 @@
+"""Check that a slow /upload_pdf/ does not delay first-token latency on /chat/.
+
+Runs against a live backend:
+
+    python benchmarks/upload_ttft.py path/to/large.pdf --url http://127.0.0.1:5000
+
+Measures time-to-first-token on /chat/ with no upload in flight, then again
+while the PDF is being uploaded, and exits non-zero if the second is more than
+``--max-slowdown`` seconds worse.
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import time
+
+import httpx
+
+CHAT_PAYLOAD = {"messages": [{"role": "user", "content": "Say hello in five words."}]}
+
+
+async def time_to_first_token(http, url):
+    start = time.perf_counter()
+    async with http.stream("POST", f"{url}/chat/", json=CHAT_PAYLOAD) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes():
+            if chunk:
+                return time.perf_counter() - start
+    return time.perf_counter() - start
+
+
+async def sample_ttft(http, url, samples):
+    return [await time_to_first_token(http, url) for _ in range(samples)]
+
+
+async def upload(http, url, pdf_path):
+    with open(pdf_path, "rb") as f:
+        files = {"file": (pdf_path, f.read(), "application/pdf")}
+    start = time.perf_counter()
+    response = await http.post(f"{url}/upload_pdf/", files=files)
+    response.raise_for_status()
+    return time.perf_counter() - start
+
+
+async def main(args):
+    async with httpx.AsyncClient(timeout=None) as http:
+        idle = await sample_ttft(http, args.url, args.samples)
+
+        upload_task = asyncio.create_task(upload(http, args.url, args.pdf))
+        # Give the upload a head start so parsing is under way
+        await asyncio.sleep(args.head_start)
+        busy = await sample_ttft(http, args.url, args.samples)
+        upload_seconds = await upload_task
+
+    idle_median = statistics.median(idle)
+    busy_median = statistics.median(busy)
+    print(f"upload took         {upload_seconds:.2f}s")
+    print(f"ttft idle  median   {idle_median * 1000:.0f}ms  max {max(idle) * 1000:.0f}ms")
+    print(f"ttft busy  median   {busy_median * 1000:.0f}ms  max {max(busy) * 1000:.0f}ms")
+
+    if busy_median - idle_median > args.max_slowdown:
+        print("FAIL: /chat/ first-token latency degraded during upload")
+        return 1
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("pdf")
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--samples", type=int, default=5)
+    parser.add_argument("--head-start", type=float, default=1.0)
+    parser.add_argument("--max-slowdown", type=float, default=0.5)
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -1,40 +1,110 @@
 import streamlit as st
 import uuid
+import time
+import json
 import requests
+from requests.adapters import HTTPAdapter
 
 # Backend URLs define
 LOAD_CHAT_URL = "http://127.0.0.1:5000/load_chat/"
+CHAT_MESSAGES_URL = "http://127.0.0.1:5000/chat/{chat_id}/messages"
 SAVE_CHAT_URL = "http://127.0.0.1:5000/save_chat/"
+APPEND_CHAT_URL = "http://127.0.0.1:5000/append_chat/"
 DELETE_CHAT_URL = "http://127.0.0.1:5000/delete_chat/"
 UPLOAD_PDF_URL = "http://127.0.0.1:5000/upload_pdf/"
+INGEST_STATUS_URL = "http://127.0.0.1:5000/ingest/{pdf_uuid}"
 CHAT_URL = "http://127.0.0.1:5000/chat/"
 RAG_CHAT_URL = "http://127.0.0.1:5000/rag_chat/"
 
+# Seconds between checks for chats changed elsewhere
+SYNC_INTERVAL = 10
+
+def make_session():
+    # Keep-alive connections to the backend, reused by every request of this browser session
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+    return session
+
 # Initialize session state
+if "http" not in st.session_state:
+    st.session_state["http"] = make_session()
 if "history_chats" not in st.session_state:
-    st.session_state["history_chats"] = []
+    # Chats by id; messages stay None until the chat is opened
+    st.session_state["history_chats"] = {}
+if "chat_order" not in st.session_state:
+    # Sidebar order, newest first; only rebuilt when the chat list changes
+    st.session_state["chat_order"] = []
 if "current_chat" not in st.session_state:
     st.session_state["current_chat"] = None
 if "chat_names" not in st.session_state:
     st.session_state["chat_names"] = {}
+if "synced_until" not in st.session_state:
+    st.session_state["synced_until"] = None
+if "last_sync" not in st.session_state:
+    st.session_state["last_sync"] = None
+
+http = st.session_state["http"]
 
 # Functions to manage chats
-def load_chats_from_db():
-    response = requests.get(LOAD_CHAT_URL)
+def merge_chat(record):
+    chat = st.session_state["history_chats"].get(record["id"])
+    if chat is None:
+        chat = {"id": record["id"], "messages": None}
+        st.session_state["history_chats"][record["id"]] = chat
+    elif chat["messages"] is not None and len(chat["messages"]) != record["message_count"]:
+        # Changed in another session; fetched again when next shown
+        chat["messages"] = None
+    chat.update(pdf_name=record["pdf_name"], pdf_path=record["pdf_path"], pdf_uuid=record["pdf_uuid"], last_update=record["last_update"])
+    st.session_state["chat_names"][record["id"]] = record["chat_name"]
+
+def order_chats():
+    chats = st.session_state["history_chats"]
+    # Chats created here and not yet listed by the backend have no last_update and stay on top
+    st.session_state["chat_order"] = sorted(chats, key=lambda chat_id: chats[chat_id]["last_update"] or "~", reverse=True)
+
+def sync_chats():
+    # The first sync lists every chat; later ones, at most every SYNC_INTERVAL seconds,
+    # only ask for chats changed since the newest one already seen
+    last_sync = st.session_state["last_sync"]
+    if last_sync is not None and time.monotonic() - last_sync < SYNC_INTERVAL:
+        return
+
+    synced_until = st.session_state["synced_until"]
+    cursor = None
+    changed = False
+    while True:
+        params = {"updated_since": synced_until} if synced_until else {}
+        if cursor:
+            params["cursor"] = cursor
+        response = http.get(LOAD_CHAT_URL, params=params)
+
+        if response.status_code != 200:
+            print(f"Failed to retrieve data. Status code: {response.status_code}")
+            return
+
+        page = response.json()
+        for record in page["chats"]:
+            merge_chat(record)
+            changed = True
+            if not st.session_state["synced_until"] or record["last_update"] > st.session_state["synced_until"]:
+                st.session_state["synced_until"] = record["last_update"]
+
+        cursor = page["next_cursor"]
+        if not cursor:
+            break
+
+    st.session_state["last_sync"] = time.monotonic()
+    if changed:
+        order_chats()
+
+def load_chat_messages(chat):
+    response = http.get(CHAT_MESSAGES_URL.format(chat_id=chat["id"]))
 
     if response.status_code == 200:
-        records = response.json()
-        for record in records:
-            chat_id = record['id']
-            messages = record['messages']
-            name = record['chat_name']
-            pdf_path = record['pdf_path']
-            pdf_name = record['pdf_name']
-            pdf_uuid = record['pdf_uuid']
-            st.session_state["history_chats"].append({"id": chat_id, "messages": messages, "pdf_name":pdf_name, "pdf_path":pdf_path, "pdf_uuid":pdf_uuid})
-            st.session_state["chat_names"][chat_id] = name
+        chat["messages"] = response.json()
     else:
-        print(f"Failed to retrieve data. Status code: {response.status_code}")
+        print(f"Failed to retrieve messages. Status code: {response.status_code}")
+        chat["messages"] = []
 
 def save_chat_to_db(chat_id, chat_name, messages, pdf_name, pdf_path, pdf_uuid):
     payload = {
@@ -47,17 +117,26 @@ def save_chat_to_db(chat_id, chat_name, messages, pdf_name, pdf_path, pdf_uuid):
     }
     headers = {"Content-Type": "application/json"}
 
-    response = requests.post(SAVE_CHAT_URL, json=payload, headers=headers)
+    response = http.post(SAVE_CHAT_URL, json=payload, headers=headers)
 
     if response.status_code != 200:
         print(f"Failed to save data. Status code: {response.status_code}")
 
+def append_chat_to_db(chat_id, messages):
+    payload = {"chat_id": chat_id, "messages": messages}
+    headers = {"Content-Type": "application/json"}
+
+    response = http.post(APPEND_CHAT_URL, json=payload, headers=headers)
+
+    if response.status_code != 200:
+        print(f"Failed to append data. Status code: {response.status_code}")
+
 def create_chat_with_pdf(chat_name, uploaded_pdf):
 
-    with st.spinner("Uploading and Processing document, please wait..."):
+    with st.spinner("Uploading document, please wait..."):
         files = {"file": (uploaded_pdf.name, uploaded_pdf.getvalue(), "application/pdf")}
 
-        response = requests.post(UPLOAD_PDF_URL, files=files)
+        response = http.post(UPLOAD_PDF_URL, files=files)
 
         if response.status_code == 200:
 
@@ -65,8 +144,9 @@ def create_chat_with_pdf(chat_name, uploaded_pdf):
             pdf_uuid = response.json()["pdf_uuid"]
 
             new_chat_id = str(uuid.uuid4())
-            new_chat = {"id": new_chat_id, "messages": [], "pdf_name":uploaded_pdf.name, "pdf_path": pdf_path, "pdf_uuid":pdf_uuid}
-            st.session_state["history_chats"].insert(0, new_chat)
+            new_chat = {"id": new_chat_id, "messages": [], "pdf_name":uploaded_pdf.name, "pdf_path": pdf_path, "pdf_uuid":pdf_uuid, "last_update": None}
+            st.session_state["history_chats"][new_chat_id] = new_chat
+            st.session_state["chat_order"].insert(0, new_chat_id)
             st.session_state["chat_names"][new_chat_id] = chat_name
             st.session_state["current_chat"] = new_chat_id
             save_chat_to_db(new_chat_id, chat_name, [], uploaded_pdf.name, pdf_path, pdf_uuid)
@@ -74,10 +154,27 @@ def create_chat_with_pdf(chat_name, uploaded_pdf):
         else:
             st.error("Failed to upload PDF.")
 
+def show_ingest_progress(chat):
+    # The backend indexes PDFs in the background; older chats have no job and are already indexed
+    response = http.get(INGEST_STATUS_URL.format(pdf_uuid=chat["pdf_uuid"]))
+    if response.status_code != 200:
+        chat["indexed"] = True
+        return
+
+    job = response.json()
+    if job["status"] == "done":
+        chat["indexed"] = True
+    elif job["status"] == "failed":
+        st.error(f"Failed to process PDF: {job['error']}")
+    else:
+        progress = job["pages_done"] / job["pages_total"] if job["pages_total"] else 0.0
+        st.progress(progress, text=f"Indexing document: {job['pages_done']}/{job['pages_total'] or '?'} pages. Answers use the pages indexed so far.")
+
 def create_chat(chat_name):
     new_chat_id = str(uuid.uuid4())
-    new_chat = {"id": new_chat_id, "messages": [], "pdf_name":None, "pdf_path": None, "pdf_uuid": None}
-    st.session_state["history_chats"].insert(0, new_chat)
+    new_chat = {"id": new_chat_id, "messages": [], "pdf_name":None, "pdf_path": None, "pdf_uuid": None, "last_update": None}
+    st.session_state["history_chats"][new_chat_id] = new_chat
+    st.session_state["chat_order"].insert(0, new_chat_id)
     st.session_state["chat_names"][new_chat_id] = chat_name
     st.session_state["current_chat"] = new_chat_id
     
@@ -87,29 +184,28 @@ def create_chat(chat_name):
 def delete_chat():
     if st.session_state["current_chat"]:
         chat_id = st.session_state["current_chat"]
-        st.session_state["history_chats"] = [
-            chat for chat in st.session_state["history_chats"] if chat["id"] != chat_id
-        ]
+        st.session_state["history_chats"].pop(chat_id, None)
+        st.session_state["chat_order"].remove(chat_id)
         del st.session_state["chat_names"][chat_id]
         payload = {
                 "chat_id": chat_id
         }
         headers = {"Content-Type": "application/json"}
 
-        response = requests.post(DELETE_CHAT_URL, json=payload, headers=headers)
+        response = http.post(DELETE_CHAT_URL, json=payload, headers=headers)
 
         if response.status_code != 200:
             print(f"Failed to delete data. Status code: {response.status_code}")
 
         st.session_state["current_chat"] = (
-            st.session_state["history_chats"][0]["id"] if st.session_state["history_chats"] else None
+            st.session_state["chat_order"][0] if st.session_state["chat_order"] else None
         )
 
 def select_chat(chat_id):
     st.session_state["current_chat"] = chat_id
 
-# Load chats from database
-load_chats_from_db()
+# Pick up chats created or changed elsewhere
+sync_chats()
 # st.write(st.session_state)
 # Sidebar
 with st.sidebar:
@@ -136,15 +232,12 @@ with st.sidebar:
     # if not st.session_state["current_chat"]:
     #     st.session_state["current_chat"] = st.session_state["history_chats"][0]['id']
 
-    if st.session_state["history_chats"]:
-        chat_options = {
-            chat["id"]: st.session_state["chat_names"][chat["id"]]
-            for chat in st.session_state["history_chats"]
-        }
+    if st.session_state["chat_order"]:
+        chat_names = st.session_state["chat_names"]
         selected_chat = st.radio(
             "Select Chat",
-            options=list(chat_options.keys()),
-            format_func=lambda x: chat_options[x],
+            options=st.session_state["chat_order"],
+            format_func=lambda x: chat_names[x],
             # index=list(chat_options.keys()).index(st.session_state["current_chat"]),
             key="chat_selector",
             on_change=lambda: select_chat(st.session_state.chat_selector),
@@ -161,16 +254,19 @@ if st.session_state["current_chat"]:
     chat_name = st.session_state["chat_names"][chat_id]
     st.subheader(f"Current Chat: {chat_name}")
 
-    current_chat = next(
-        (chat for chat in st.session_state["history_chats"] if chat["id"] == chat_id),
-        None,
-    )
+    current_chat = st.session_state["history_chats"].get(chat_id)
 
     if current_chat:
+        if current_chat["messages"] is None:
+            load_chat_messages(current_chat)
+
         if current_chat["pdf_name"]:
             pdf_name = current_chat["pdf_name"]
             st.subheader(f"Associate with: {pdf_name}")
 
+        if current_chat["pdf_uuid"] and not current_chat.get("indexed"):
+            show_ingest_progress(current_chat)
+
         for message in current_chat["messages"]:
             with st.chat_message(message["role"]):
                 st.markdown(message["content"])
@@ -182,10 +278,12 @@ if st.session_state["current_chat"]:
 
             with st.chat_message("assistant"):
                 payload = {
+                    "chat_id": chat_id,
                     "messages": [
                         {"role": m["role"], "content": m["content"]}
                         for m in current_chat["messages"]
-                    ]
+                    ],
+                    "stream_format": "ndjson",
                 }
                 headers = {"Content-Type": "application/json"}
 
@@ -200,15 +298,35 @@ if st.session_state["current_chat"]:
                 # response = stream.json()["reply"]
                 # st.markdown(response)
 
-                # Stream approach
+                # Stream approach: one JSON frame per line. Whole lines are decoded, so multi-byte
+                # characters are never split, and leaving early closes the connection, which stops the LLM call
+                stream_result = {}
+
                 def get_stream_response():
-                    with requests.post(chat_taret_url, json=payload, headers=headers, stream=True) as r:
-                        for chunk in r:
-                            yield chunk.decode("utf-8")
+                    with http.post(chat_taret_url, json=payload, headers=headers, stream=True) as r:
+                        if r.status_code != 200:
+                            stream_result["error"] = r.text
+                            return
+                        for line in r.iter_lines():
+                            if not line:
+                                continue
+                            frame = json.loads(line)
+                            if frame["type"] == "delta":
+                                yield frame["text"]
+                            elif frame["type"] == "done":
+                                stream_result.update(frame)
+                            elif frame["type"] == "error":
+                                stream_result["error"] = frame["detail"]
 
                 response = st.write_stream(get_stream_response)
+                if "error" in stream_result:
+                    st.error(f"The reply was cut short: {stream_result['error']}")
+                elif stream_result.get("timing", {}).get("tokens"):
+                    timing = stream_result["timing"]
+                    st.caption(f"{timing['tokens']} tokens, first after {timing['time_to_first_token_ms']} ms, {timing['duration_ms']} ms total")
                 current_chat["messages"].append({"role": "assistant", "content": response})
-                save_chat_to_db(chat_id, chat_name, current_chat["messages"], current_chat["pdf_name"], current_chat["pdf_path"], current_chat["pdf_uuid"])
+                # Only the user prompt and the reply are new
+                append_chat_to_db(chat_id, current_chat["messages"][-2:])
 else:
     st.write("No chat selected. Use the sidebar to create or select a chat.")
 
@@ -0,0 +1,167 @@
+"""Chunking for PDF ingestion.
+
+Pages have repeated headers and footers stripped, are split into chunks by
+the splitter named in PDF_CHUNKER, and every chunk gets a fingerprint. The
+fingerprints let the backend skip chunks whose text it has already embedded
+for the same document. Like pdf_processing, this runs in worker processes.
+"""
+import functools
+import hashlib
+import os
+import re
+from collections import Counter
+
+import mmh3
+import numpy as np
+
+# "tokens" sizes chunks in tiktoken tokens, as the embedding model counts them; "characters" is the
+# original 500-character splitter
+PDF_CHUNKER = os.environ.get("PDF_CHUNKER", "tokens")
+CHUNK_TOKENS = int(os.environ.get("CHUNK_TOKENS", 300))
+CHUNK_OVERLAP_TOKENS = int(os.environ.get("CHUNK_OVERLAP_TOKENS", 30))
+# Chunks with fewer letters and digits than this, e.g. a lone page number, are dropped
+CHUNK_MIN_CHARS = int(os.environ.get("CHUNK_MIN_CHARS", 20))
+
+# MinHash signatures have MINHASH_PERMUTATIONS values, banded for lookup; chunks whose
+# estimated Jaccard similarity over word 3-grams reaches NEAR_DUPLICATE_THRESHOLD are dropped
+MINHASH_PERMUTATIONS = 64
+MINHASH_BANDS = 16
+NEAR_DUPLICATE_THRESHOLD = float(os.environ.get("NEAR_DUPLICATE_THRESHOLD", 0.85))
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_rng = np.random.default_rng(1)
+_PERM_A = _rng.integers(1, _MERSENNE_PRIME, MINHASH_PERMUTATIONS, dtype=np.uint64)
+_PERM_B = _rng.integers(0, _MERSENNE_PRIME, MINHASH_PERMUTATIONS, dtype=np.uint64)
+
+
+def token_splitter():
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    return RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+        encoding_name="cl100k_base", chunk_size=CHUNK_TOKENS, chunk_overlap=CHUNK_OVERLAP_TOKENS,
+    )
+
+
+def character_splitter():
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+    return RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50)
+
+
+CHUNKERS = {"tokens": token_splitter, "characters": character_splitter}
+
+
+@functools.lru_cache(maxsize=None)
+def get_splitter(name=None):
+    # Built on first use, so importing this module does not load a tokenizer
+    return CHUNKERS[name or PDF_CHUNKER]()
+
+
+# "Page 12", "p. 12", "12 of 40", "12 / 40"
+_PAGE_LABEL = r"(?:(?:page|pg\.?|p\.)\s*\d+(?:\s*(?:of|/)\s*\d+)?|\d+\s*(?:of|/)\s*\d+)"
+# A line that is just a number ("12", "- 12 -"), or a page label at either end of a line
+PAGE_NUMBER = re.compile(rf"^[-–—]?\s*\d+\s*[-–—]?$|^{_PAGE_LABEL}\b|(?<!\S){_PAGE_LABEL}$")
+
+
+def line_key(line):
+    # Page numbers are ignored so "Page 3 of 40" matches "Page 4 of 40";
+    # other digits count, so "Table 3" and "Table 4" stay different lines
+    key = " ".join(line.split()).lower()
+    return PAGE_NUMBER.sub(lambda match: re.sub(r"\d+", "#", match.group()), key)
+
+
+def strip_repeated_lines(pages, edge_lines=3, min_share=0.5, min_pages=3):
+    """Remove headers and footers from a list of page texts.
+
+    A line counts as one if it is within ``edge_lines`` of the top or bottom
+    of its page and the same line is at an edge of at least ``min_share`` of
+    the pages (and at least ``min_pages`` of them). Pages of ``2 * edge_lines``
+    lines or fewer have no body to tell apart from their edges, so they are
+    left alone. Returns the stripped pages and the number of lines removed.
+    """
+    if len(pages) < min_pages:
+        return pages, 0
+
+    page_lines = [[line for line in text.splitlines() if line.strip()] for text in pages]
+    counts = Counter()
+    for lines in page_lines:
+        if len(lines) > 2 * edge_lines:
+            counts.update({line_key(line) for line in lines[:edge_lines] + lines[-edge_lines:]})
+    repeated = {key for key, count in counts.items() if count >= max(min_pages, min_share * len(pages))}
+    if not repeated:
+        return pages, 0
+
+    stripped = []
+    removed = 0
+    for lines in page_lines:
+        if len(lines) <= 2 * edge_lines:
+            stripped.append("\n".join(lines))
+            continue
+        kept = [
+            line for i, line in enumerate(lines)
+            if not ((i < edge_lines or i >= len(lines) - edge_lines) and line_key(line) in repeated)
+        ]
+        removed += len(lines) - len(kept)
+        stripped.append("\n".join(kept))
+    return stripped, removed
+
+
+def is_informative(text):
+    return sum(ch.isalnum() for ch in text) >= CHUNK_MIN_CHARS
+
+
+def fingerprint(text):
+    """(exact hash, MinHash signature) of a chunk's normalized text."""
+    words = re.findall(r"\w+", text.lower())
+    exact = hashlib.blake2b(" ".join(words).encode("utf-8"), digest_size=16).digest()
+    shingles = {" ".join(words[i:i + 3]) for i in range(max(1, len(words) - 2))}
+    hashes = np.fromiter((mmh3.hash(shingle, signed=False) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+    # Universal hashing as in datasketch: the product wraps at 2**64, which is what mixes
+    # the bits, and the result is kept to 32 bits
+    signature = (((hashes[:, None] * _PERM_A + _PERM_B) % np.uint64(_MERSENNE_PRIME)) & np.uint64(0xFFFFFFFF)).min(axis=0)
+    return exact, signature
+
+
+def fingerprint_all(texts):
+    return [fingerprint(text) for text in texts]
+
+
+class Deduplicator:
+    """Remembers the chunks of one document and spots repeats of them.
+
+    Exact repeats are found by hash. Near-duplicates are found by MinHash:
+    signatures are split into bands, any earlier chunk sharing a band is a
+    candidate, and a candidate matches if enough signature values agree.
+    """
+
+    def __init__(self, threshold=NEAR_DUPLICATE_THRESHOLD):
+        self.threshold = threshold
+        self.exact = set()
+        self.bands = {}
+        self.signatures = []
+        self.stats = {"exact": 0, "near": 0}
+
+    def band_keys(self, signature):
+        rows = MINHASH_PERMUTATIONS // MINHASH_BANDS
+        return [(band, signature[band * rows:(band + 1) * rows].tobytes()) for band in range(MINHASH_BANDS)]
+
+    def is_duplicate(self, exact, signature):
+        # Returns True for a repeat; otherwise records the chunk and returns False
+        if exact in self.exact:
+            self.stats["exact"] += 1
+            return True
+
+        keys = self.band_keys(signature)
+        candidates = {self.bands[key] for key in keys if key in self.bands}
+        for candidate in candidates:
+            if np.mean(self.signatures[candidate] == signature) >= self.threshold:
+                self.stats["near"] += 1
+                return True
+
+        self.remember(exact, signature, keys)
+        return False
+
+    def remember(self, exact, signature, keys=None):
+        # Records a chunk without checking it, e.g. one indexed by an earlier run
+        self.exact.add(exact)
+        self.signatures.append(signature)
+        for key in keys or self.band_keys(signature):
+            self.bands.setdefault(key, len(self.signatures) - 1)
@@ -0,0 +1,125 @@
+import asyncio
+import re
+from collections import defaultdict
+
+from cachetools import LRUCache, TTLCache
+from chromadb.errors import ChromaError, InvalidArgumentError, InvalidCollectionException, NotFoundError
+from langchain_core.documents import Document
+
+from telemetry import span
+
+# Collections that held every document before per-document partitioning
+SHARED_COLLECTION = "langchain"
+
+
+def collection_name(pdf_uuid):
+    # Chroma names are limited to 63 characters; a 56-character prefix of the
+    # content hash is still collision free in practice
+    return f"pdf-{pdf_uuid[:56]}"
+
+
+def get_collection(client, name):
+    try:
+        return client.get_collection(name, embedding_function=None)
+    except (ValueError, InvalidCollectionException, InvalidArgumentError, NotFoundError):
+        # How a missing collection is reported depends on the Chroma version and client
+        return None
+
+
+def query_collection(collection, embedding, k):
+    result = collection.query(query_embeddings=[embedding], n_results=k, include=["documents", "metadatas"])
+    return [
+        Document(id=chunk_id, page_content=text, metadata=metadata or {})
+        for chunk_id, text, metadata in zip(result["ids"][0], result["documents"][0], result["metadatas"][0])
+    ]
+
+
+def delete_vectors(client, pdf_uuid):
+    try:
+        client.delete_collection(collection_name(pdf_uuid))
+    except (ValueError, ChromaError):
+        # Never indexed, or already gone
+        pass
+    finally:
+        # Documents indexed before partitioning can still have chunks in the shared collection
+        shared = get_collection(client, SHARED_COLLECTION)
+        if shared is not None:
+            shared.delete(where={"pdf_uuid": pdf_uuid})
+
+
+def normalize_query(query):
+    return re.sub(r"\s+", " ", query).strip().strip("?!.").lower()
+
+
+class DocumentIndex:
+    """Chroma vectors partitioned into one collection per document.
+
+    Queries only search the vectors of the document they ask about, and
+    results are cached per (pdf_uuid, normalized query, k). Collections are
+    only created by writes, so asking about an unknown document finds
+    nothing instead of leaving an empty collection behind. Writing to or
+    deleting a document bumps its generation, which invalidates its cached
+    results without scanning the cache.
+    """
+
+    def __init__(self, client, embedding_function, collection_cache_size=256, cache_size=2048, cache_ttl=300):
+        self.client = client
+        self.embedding_function = embedding_function
+        self.collections = LRUCache(maxsize=collection_cache_size)
+        self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self.generations = defaultdict(int)
+        self.stats = {"hits": 0, "misses": 0}
+
+    async def acollection(self, pdf_uuid, create=False):
+        # Chroma's client blocks on HTTP, so lookups run in a thread; None if the document has no vectors
+        collection = self.collections.get(pdf_uuid)
+        if collection is None:
+            if create:
+                collection = await asyncio.to_thread(self.client.get_or_create_collection, collection_name(pdf_uuid), embedding_function=None)
+            else:
+                collection = await asyncio.to_thread(get_collection, self.client, collection_name(pdf_uuid))
+            if collection is not None:
+                self.collections[pdf_uuid] = collection
+        return collection
+
+    def invalidate(self, pdf_uuid):
+        self.generations[pdf_uuid] += 1
+
+    async def aadd_texts(self, pdf_uuid, texts, ids, metadatas):
+        # Embedding and writing are done separately so each can be timed
+        with span("ingest.embed", chunks=len(texts)):
+            embeddings = await self.embedding_function.aembed_documents(texts)
+        with span("ingest.insert", chunks=len(texts)):
+            collection = await self.acollection(pdf_uuid, create=True)
+            await asyncio.to_thread(collection.upsert, ids=ids, embeddings=embeddings, documents=texts, metadatas=metadatas)
+        self.invalidate(pdf_uuid)
+
+    async def atexts(self, pdf_uuid, pages):
+        # Texts of the document's chunks on the given pages
+        collection = await self.acollection(pdf_uuid)
+        if collection is None or not pages:
+            return []
+        result = await asyncio.to_thread(collection.get, where={"page": {"$in": list(pages)}}, include=["documents"])
+        return result["documents"]
+
+    async def asearch(self, pdf_uuid, query, k):
+        key = (pdf_uuid, self.generations[pdf_uuid], normalize_query(query), k)
+        docs = self.cache.get(key)
+        if docs is not None:
+            self.stats["hits"] += 1
+            return docs
+
+        self.stats["misses"] += 1
+        with span("rag.embed_query"):
+            embedding = await self.embedding_function.aembed_query(query)
+        with span("rag.search", k=k):
+            collection = await self.acollection(pdf_uuid)
+            docs = await asyncio.to_thread(query_collection, collection, embedding, k) if collection is not None else []
+        self.cache[key] = docs
+        return docs
+
+    async def adelete(self, pdf_uuid):
+        # The caches are only touched on the event loop; Chroma's blocking calls run in a thread
+        self.collections.pop(pdf_uuid, None)
+        self.invalidate(pdf_uuid)
+        await asyncio.to_thread(delete_vectors, self.client, pdf_uuid)
@@ -0,0 +1,70 @@
+import asyncio
+import hashlib
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper that stores document vectors in a byte store.
+
+    Keys are the SHA-256 of the chunk text under a namespace per embedding
+    model, so identical chunks are embedded once no matter which upload they
+    came from. Query embeddings are passed straight through.
+    """
+
+    def __init__(self, underlying, store, model):
+        self.underlying = underlying
+        self.store = store
+        self.model = model
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, text):
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return f"{self.model}/{digest[:2]}/{digest}"
+
+    def embed_documents(self, texts):
+        keys = [self._key(text) for text in texts]
+        vectors, missing = self._lookup(keys)
+        if missing:
+            computed = self.underlying.embed_documents([texts[i] for i in missing])
+            self.store.mset(self._fill(vectors, keys, missing, computed))
+        return vectors
+
+    async def aembed_documents(self, texts):
+        # Misses go to the underlying model's async path, e.g. the EmbeddingScheduler
+        keys = [self._key(text) for text in texts]
+        vectors, missing = await asyncio.to_thread(self._lookup, keys)
+        if missing:
+            computed = await self.underlying.aembed_documents([texts[i] for i in missing])
+            await asyncio.to_thread(self.store.mset, self._fill(vectors, keys, missing, computed))
+        return vectors
+
+    def _lookup(self, keys):
+        cached = self.store.mget(keys)
+        missing = [i for i, value in enumerate(cached) if value is None]
+        vectors = [None if value is None else np.frombuffer(value, dtype=np.float32).tolist() for value in cached]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        return vectors, missing
+
+    def _fill(self, vectors, keys, missing, computed):
+        for i, vector in zip(missing, computed):
+            vectors[i] = vector
+        return [(keys[i], np.asarray(vector, dtype=np.float32).tobytes()) for i, vector in zip(missing, computed)]
+
+    def embed_query(self, text):
+        return self.underlying.embed_query(text)
+
+    async def aembed_query(self, text):
+        return await self.underlying.aembed_query(text)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "model": self.model,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else None,
+        }
@@ -0,0 +1,163 @@
+import asyncio
+import random
+import time
+
+from langchain_core.embeddings import Embeddings
+from openai import APIConnectionError, InternalServerError, RateLimitError
+
+
+class TokenBucket:
+    """Allows ``rate`` units per second on average, in bursts of up to ``capacity``.
+
+    Waiters are served in arrival order. ``pause`` puts the bucket into debt,
+    so everyone waits after the provider says to slow down, not only the
+    caller that was told.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount):
+        # A request bigger than the bucket still goes through once the bucket is full
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            self._refill()
+            while self.level < amount:
+                await asyncio.sleep((amount - self.level) / self.rate)
+                self._refill()
+            self.level -= amount
+
+    def take(self, amount):
+        # Debits without waiting, so the next acquire waits for it instead
+        self._refill()
+        self.level -= min(amount, self.capacity)
+
+    def pause(self, seconds):
+        # Concurrent 429s do not add up: the bucket is empty for ``seconds`` from now
+        self._refill()
+        self.level = min(self.level, -seconds * self.rate)
+
+
+def tiktoken_counter():
+    import tiktoken
+    encoding = tiktoken.get_encoding("cl100k_base")
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+class EmbeddingScheduler(Embeddings):
+    """Paces and batches calls to an embeddings model.
+
+    Texts are grouped into requests of at most ``max_batch_tokens`` tokens
+    and ``max_batch_size`` inputs, sent ``max_concurrency`` at a time, and
+    held back by token buckets sized to the account's tokens and requests
+    per minute. A 429 pauses both buckets for the Retry-After time, or an
+    exponential backoff with jitter, and the request is retried up to
+    ``max_retries`` times. ``underlying`` should be built with its own
+    retries turned off.
+
+    Queries skip the queue: a chat waiting on retrieval should not sit behind
+    an ingest's batches. They are charged to the buckets without waiting, so
+    the batches after them are held back by their tokens instead.
+    """
+
+    def __init__(
+        self, underlying, count_tokens=None, max_batch_tokens=20000, max_batch_size=256, max_concurrency=4,
+        tokens_per_minute=1_000_000, requests_per_minute=3000, max_retries=6, max_backoff=60,
+    ):
+        self.underlying = underlying
+        self.count_tokens = count_tokens
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.tokens = TokenBucket(tokens_per_minute / 60, tokens_per_minute)
+        self.requests = TokenBucket(requests_per_minute / 60, max(1, requests_per_minute // 60))
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self.stats = {"requests": 0, "texts": 0, "tokens": 0, "retries": 0, "rate_limited": 0, "in_flight": 0}
+
+    def batches(self, texts):
+        if self.count_tokens is None:
+            self.count_tokens = tiktoken_counter()
+        batch, batch_tokens = [], 0
+        for text in texts:
+            tokens = self.count_tokens(text)
+            if batch and (batch_tokens + tokens > self.max_batch_tokens or len(batch) >= self.max_batch_size):
+                yield batch, batch_tokens
+                batch, batch_tokens = [], 0
+            batch.append(text)
+            batch_tokens += tokens
+        if batch:
+            yield batch, batch_tokens
+
+    def backoff(self, error, attempt):
+        retry_after = None
+        response = getattr(error, "response", None)
+        if response is not None:
+            try:
+                retry_after = float(response.headers.get("retry-after"))
+            except (TypeError, ValueError):
+                pass
+        if retry_after is None:
+            retry_after = min(self.max_backoff, 2 ** attempt) * (0.5 + random.random() / 2)
+        return retry_after
+
+    async def call(self, texts, queued):
+        if not queued:
+            return await self.underlying.aembed_documents(texts)
+        async with self.semaphore:
+            self.stats["in_flight"] += 1
+            try:
+                return await self.underlying.aembed_documents(texts)
+            finally:
+                self.stats["in_flight"] -= 1
+
+    async def embed_batch(self, texts, tokens, queued=True):
+        for attempt in range(self.max_retries + 1):
+            if queued:
+                await self.tokens.acquire(tokens)
+                await self.requests.acquire(1)
+            else:
+                self.tokens.take(tokens)
+                self.requests.take(1)
+            try:
+                vectors = await self.call(texts, queued)
+            except (RateLimitError, APIConnectionError, InternalServerError) as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff(e, attempt)
+                self.stats["retries"] += 1
+                if isinstance(e, RateLimitError):
+                    self.stats["rate_limited"] += 1
+                    self.tokens.pause(delay)
+                    self.requests.pause(delay)
+                if not queued or not isinstance(e, RateLimitError):
+                    await asyncio.sleep(delay)
+                continue
+            self.stats["requests"] += 1
+            self.stats["texts"] += len(texts)
+            self.stats["tokens"] += tokens
+            return vectors
+
+    async def aembed_documents(self, texts):
+        results = await asyncio.gather(*(self.embed_batch(batch, tokens) for batch, tokens in self.batches(texts)))
+        return [vector for vectors in results for vector in vectors]
+
+    async def aembed_query(self, text):
+        [(batch, tokens)] = self.batches([text])
+        return (await self.embed_batch(batch, tokens, queued=False))[0]
+
+    # Synchronous calls bypass the scheduler; the backend only uses the async ones
+    def embed_documents(self, texts):
+        return self.underlying.embed_documents(texts)
+
+    def embed_query(self, text):
+        return self.underlying.embed_query(text)
@@ -0,0 +1,188 @@
+"""Remove documents, blobs and vectors that no chat references any more.
+
+    python garbage_collect.py [--dry-run] [--grace-minutes 60] [--compact] [--chroma-path chroma_db]
+
+/delete_chat/ already cleans up after itself; this catches what it cannot,
+e.g. two chats on the same document deleted at once, or a crash halfway
+through a delete. It compares Postgres, blob storage and Chroma and removes:
+
+  - pdf_documents rows that no chat points at
+  - blobs under chat_logs/ and pdf_store/ that belong to no chat or document
+  - per-document collections, and chunks in the shared collection, of
+    documents that are gone
+
+Anything newer than --grace-minutes is kept, so an upload whose chat has not
+been saved yet survives. Storage is listed before references are read, which
+means anything written while the job runs is never mistaken for garbage.
+--compact rebuilds the shared collection, since Chroma does not shrink an
+HNSW index when vectors are deleted from it.
+"""
+import argparse
+import asyncio
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+import asyncpg
+import chromadb
+from azure.storage.blob.aio import ContainerClient
+
+from backend import settings, get_log_path, get_summary_path
+from document_index import SHARED_COLLECTION, collection_name, get_collection
+
+BLOB_PREFIXES = ("chat_logs/", "pdf_store/")
+
+
+def disk_usage(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def index_size(client, chroma_path):
+    collections = client.list_collections()
+    return {
+        "collections": len(collections),
+        "vectors": sum(collection.count() for collection in collections),
+        "bytes": disk_usage(chroma_path) if chroma_path else None,
+    }
+
+
+def format_size(size):
+    if size is None:
+        return "n/a"
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.1f} {unit}"
+        size /= 1024
+
+
+async def list_blobs(container):
+    blobs = []
+    for prefix in BLOB_PREFIXES:
+        async for blob in container.list_blobs(name_starts_with=prefix):
+            blobs.append(blob)
+    return blobs
+
+
+def list_shared_chunks(shared, batch_size):
+    chunks = defaultdict(list)
+    total = shared.count()
+    for offset in range(0, total, batch_size):
+        batch = shared.get(limit=batch_size, offset=offset, include=["metadatas"])
+        for chunk_id, metadata in zip(batch["ids"], batch["metadatas"]):
+            chunks[(metadata or {}).get("pdf_uuid")].append(chunk_id)
+    return chunks
+
+
+async def release_documents(db, grace_minutes, dry_run):
+    # The reference check is repeated in the DELETE so a chat saved meanwhile keeps its document
+    query = """
+        FROM pdf_documents d
+        WHERE d.created_at < CURRENT_TIMESTAMP - make_interval(mins => $1::int)
+        AND NOT EXISTS (SELECT 1 FROM advanced_chats c WHERE c.pdf_uuid = d.pdf_uuid OR c.pdf_path = d.pdf_path)
+    """
+    if dry_run:
+        return await db.fetch(f"SELECT d.pdf_uuid, d.pdf_path {query}", grace_minutes)
+    return await db.fetch(f"DELETE {query} RETURNING d.pdf_uuid, d.pdf_path", grace_minutes)
+
+
+async def load_references(db, released):
+    released_uuids = {row["pdf_uuid"] for row in released}
+    live_blobs = set()
+    live_uuids = set()
+    for chat in await db.fetch("SELECT id, file_path, pdf_path, pdf_uuid FROM advanced_chats"):
+        live_blobs.update((chat["file_path"], get_log_path(chat["file_path"]), get_summary_path(chat["id"]), chat["pdf_path"]))
+        live_uuids.add(chat["pdf_uuid"])
+    for document in await db.fetch("SELECT pdf_uuid, pdf_path FROM pdf_documents"):
+        if document["pdf_uuid"] not in released_uuids:
+            live_blobs.add(document["pdf_path"])
+            live_uuids.add(document["pdf_uuid"])
+    live_blobs.discard(None)
+    live_uuids.discard(None)
+    return live_blobs, live_uuids
+
+
+def compact_shared(client, shared, batch_size):
+    # Copy the surviving chunks into a fresh collection and swap it in under the old name
+    rebuilt = client.get_or_create_collection(f"{SHARED_COLLECTION}-compacted", metadata=shared.metadata, embedding_function=None)
+    total = shared.count()
+    for offset in range(0, total, batch_size):
+        batch = shared.get(limit=batch_size, offset=offset, include=["embeddings", "documents", "metadatas"])
+        rebuilt.upsert(ids=batch["ids"], embeddings=batch["embeddings"], documents=batch["documents"], metadatas=batch["metadatas"])
+    client.delete_collection(SHARED_COLLECTION)
+    rebuilt.modify(name=SHARED_COLLECTION)
+    return total
+
+
+async def collect(args):
+    await asyncio.to_thread(settings.refresh)
+    client = chromadb.HttpClient(host=args.host or settings.get("CHROMADB_HOST"), port=args.port or settings.get("CHROMADB_PORT"))
+    storage_resource_uri, token = settings.get("AZURE_STORAGE_SAS_URL").split('?', 1)
+    container_url = f"{storage_resource_uri}/{settings.get('AZURE_STORAGE_CONTAINER')}?{token}"
+    cutoff = datetime.now(timezone.utc) - timedelta(minutes=args.grace_minutes)
+
+    before = index_size(client, args.chroma_path)
+
+    # Snapshot storage first: whatever it holds was written before the references below were read
+    collections = [collection.name for collection in client.list_collections()]
+    shared = get_collection(client, SHARED_COLLECTION)
+    shared_chunks = list_shared_chunks(shared, args.batch_size) if shared is not None else {}
+    async with ContainerClient.from_container_url(container_url) as container:
+        blobs = await list_blobs(container)
+
+        db = await asyncpg.connect(
+            database=settings.get("DB_NAME"),
+            user=settings.get("DB_USER"),
+            password=settings.get("DB_PASSWORD"),
+            host=settings.get("DB_HOST"),
+            port=int(settings.get("DB_PORT")),
+        )
+        try:
+            released = await release_documents(db, args.grace_minutes, args.dry_run)
+            live_blobs, live_uuids = await load_references(db, released)
+        finally:
+            await db.close()
+
+        live_collections = {collection_name(pdf_uuid) for pdf_uuid in live_uuids}
+        orphan_collections = [name for name in collections if name.startswith("pdf-") and name not in live_collections]
+        orphan_chunks = [chunk_id for pdf_uuid, ids in shared_chunks.items() if pdf_uuid and pdf_uuid not in live_uuids for chunk_id in ids]
+        orphan_blobs = [blob for blob in blobs if blob.name not in live_blobs and blob.last_modified < cutoff]
+
+        if not args.dry_run:
+            for blob in orphan_blobs:
+                await container.delete_blob(blob.name)
+
+    if not args.dry_run:
+        for name in orphan_collections:
+            client.delete_collection(name)
+        for start in range(0, len(orphan_chunks), args.batch_size):
+            shared.delete(ids=orphan_chunks[start:start + args.batch_size])
+        if shared is not None and shared.count() == 0:
+            client.delete_collection(SHARED_COLLECTION)
+        elif shared is not None and args.compact and orphan_chunks:
+            compacted = compact_shared(client, shared, args.batch_size)
+            print(f"Rebuilt '{SHARED_COLLECTION}' with {compacted} vectors")
+
+    action = "Would remove" if args.dry_run else "Removed"
+    print(f"{action} {len(released)} document rows")
+    print(f"{action} {len(orphan_blobs)} blobs, {format_size(sum(blob.size for blob in orphan_blobs))}")
+    print(f"{action} {len(orphan_collections)} document collections and {len(orphan_chunks)} chunks from '{SHARED_COLLECTION}'")
+
+    after = before if args.dry_run else index_size(client, args.chroma_path)
+    for label, size in (("before", before), ("after", after)):
+        print(f"Index {label}: {size['collections']} collections, {size['vectors']} vectors, {format_size(size['bytes'])} on disk")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", help="defaults to the CHROMADB_HOST setting")
+    parser.add_argument("--port", type=int, help="defaults to the CHROMADB_PORT setting")
+    parser.add_argument("--chroma-path", help="Chroma's data directory, to report its size on disk")
+    parser.add_argument("--grace-minutes", type=int, default=60, help="keep anything newer than this")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--compact", action="store_true", help="rebuild the shared collection after deleting from it")
+    parser.add_argument("--dry-run", action="store_true", help="report what would be removed without deleting")
+    asyncio.run(collect(parser.parse_args()))
@@ -0,0 +1,102 @@
+import json
+import hashlib
+from functools import lru_cache
+
+import tiktoken
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+from cachetools import LRUCache
+
+summarize_prompt = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            "You maintain a running summary of a conversation between a user and an assistant. "
+            "Extend the existing summary with the new messages. Keep names, numbers, decisions "
+            "and open questions; drop pleasantries. Reply with the updated summary only.",
+        ),
+        ("human", "Existing summary:\n{summary}\n\nNew messages:\n{messages}"),
+    ]
+)
+
+# Tokens added per message by the chat format, on top of its content
+MESSAGE_OVERHEAD = 4
+
+
+def messages_digest(messages):
+    return hashlib.sha256(
+        json.dumps([(m["role"], m["content"]) for m in messages], ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+
+class HistoryManager:
+    """Fits a chat's messages into a token budget.
+
+    Leading system messages and the most recent ``recent_messages`` messages
+    are always kept. Older messages that do not fit are folded into a rolling
+    summary, which is cached per chat_id and persisted through the
+    ``load_summary``/``save_summary`` callbacks so it is only extended when
+    more messages fall out of the window.
+    """
+
+    def __init__(self, llm, model, budget, recent_messages, load_summary, save_summary, cache_size=1024):
+        self.summarize_chain = summarize_prompt | llm | StrOutputParser()
+        try:
+            self.encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            self.encoding = tiktoken.get_encoding("cl100k_base")
+        self.budget = budget
+        self.recent_messages = recent_messages
+        self.load_summary = load_summary
+        self.save_summary = save_summary
+        self.summaries = LRUCache(maxsize=cache_size)
+        self.count_text = lru_cache(maxsize=8192)(lambda text: len(self.encoding.encode(text)))
+
+    def count_tokens(self, messages):
+        return sum(self.count_text(m["content"] or "") + MESSAGE_OVERHEAD for m in messages)
+
+    async def fit(self, messages, chat_id=None):
+        pinned = []
+        while len(pinned) < len(messages) and messages[len(pinned)]["role"] == "system":
+            pinned.append(messages[len(pinned)])
+        conversation = messages[len(pinned):]
+
+        if self.count_tokens(messages) <= self.budget:
+            return messages
+
+        # Keep as many recent messages as fit, never fewer than recent_messages
+        remaining = self.budget - self.count_tokens(pinned)
+        keep_from = len(conversation)
+        for i in range(len(conversation) - 1, -1, -1):
+            cost = self.count_tokens([conversation[i]])
+            if len(conversation) - i > self.recent_messages and cost > remaining:
+                break
+            remaining -= cost
+            keep_from = i
+
+        if chat_id is None:
+            # Without a chat to cache against, older turns are dropped rather than summarized
+            return pinned + conversation[keep_from:]
+
+        summary = await self.summarize(chat_id, conversation, keep_from)
+        keep_from = max(keep_from, summary["count"])
+        summary_message = {"role": "system", "content": f"Summary of the earlier conversation:\n{summary['summary']}"}
+        return pinned + [summary_message] + conversation[keep_from:]
+
+    async def summarize(self, chat_id, conversation, fold_until):
+        summary = self.summaries.get(chat_id)
+        if summary is None:
+            summary = await self.load_summary(chat_id) or {"count": 0, "digest": messages_digest([]), "summary": ""}
+
+        # Start over if the summarized messages were edited since
+        if summary["count"] > len(conversation) or messages_digest(conversation[:summary["count"]]) != summary["digest"]:
+            summary = {"count": 0, "digest": messages_digest([]), "summary": ""}
+
+        if fold_until > summary["count"]:
+            new_messages = "\n".join(f"{m['role']}: {m['content']}" for m in conversation[summary["count"]:fold_until])
+            text = await self.summarize_chain.ainvoke({"summary": summary["summary"] or "(none)", "messages": new_messages})
+            summary = {"count": fold_until, "digest": messages_digest(conversation[:fold_until]), "summary": text}
+            await self.save_summary(chat_id, summary)
+
+        self.summaries[chat_id] = summary
+        return summary
@@ -0,0 +1,117 @@
+"""Ingest every PDF in a directory through the backend's ingestion pipeline.
+
+    python ingest_directory.py docs/ [--recursive] [--concurrency 2]
+
+Each PDF is stored in blob storage and recorded in pdf_documents exactly as
+/upload_pdf/ would, then parsed, chunked and embedded by the same worker
+processes and embedding scheduler, so the tokens-per-minute and request
+limits hold across all documents in flight. Documents that are already
+indexed are skipped. A document that fails keeps the checkpoints of the
+pages it finished, so running the command again resumes it.
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+import tempfile
+import time
+import uuid
+
+import backend
+from backend import app, lifespan, get_blob_client, get_embedding_function, ingest_pdf, ingest_jobs, register_document, abandon_document, PDF_SPOOL_DIR
+
+
+def find_pdfs(directory, recursive):
+    if not recursive:
+        return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.lower().endswith(".pdf"))
+    return sorted(
+        os.path.join(root, name)
+        for root, _, files in os.walk(directory)
+        for name in files if name.lower().endswith(".pdf")
+    )
+
+
+def hash_and_spool(path):
+    # ingest_pdf deletes the file it is given, so it gets a copy
+    hasher = hashlib.sha256()
+    os.makedirs(PDF_SPOOL_DIR, exist_ok=True)
+    with open(path, "rb") as source, tempfile.NamedTemporaryFile(dir=PDF_SPOOL_DIR, suffix=".pdf", delete=False) as spool:
+        while chunk := source.read(4 * 1024 * 1024):
+            hasher.update(chunk)
+            spool.write(chunk)
+    return hasher.hexdigest(), spool.name
+
+
+async def ingest_file(path):
+    name = os.path.basename(path)
+    pdf_uuid, spool = await asyncio.to_thread(hash_and_spool, path)
+    async with backend.db_pool.acquire() as db:
+        existing = await db.fetchrow("SELECT pdf_path, status FROM pdf_documents WHERE pdf_uuid = $1", pdf_uuid)
+        if existing and existing["status"] == "done":
+            os.remove(spool)
+            print(f"{name}: already indexed as {pdf_uuid}")
+            return "skipped"
+
+        pdf_path = existing["pdf_path"] if existing else f"pdf_store/{uuid.uuid4().hex}_{name}"
+        if not await register_document(db, pdf_uuid, pdf_path, name):
+            os.remove(spool)
+            print(f"{name}: already being indexed as {pdf_uuid}")
+            return "skipped"
+
+    # Claimed first, so a concurrent upload of the same PDF does not store it twice
+    try:
+        async with get_blob_client(pdf_path) as blob_client:
+            if not await blob_client.exists():
+                with open(path, "rb") as f:
+                    await blob_client.upload_blob(f, overwrite=True)
+    except Exception as e:
+        await abandon_document(pdf_uuid, e)
+        ingest_jobs.pop(pdf_uuid)
+        os.remove(spool)
+        raise
+
+    start = time.perf_counter()
+    await ingest_pdf(pdf_uuid, spool)
+    job = ingest_jobs.pop(pdf_uuid)
+    print(
+        f"{name}: {job['status']} in {time.perf_counter() - start:.1f}s, {job['pages_total']} pages, "
+        f"{job['chunks_indexed']} chunks indexed, {job['chunks_skipped']} duplicates skipped"
+        + (f", error: {job['error']}" if job["error"] else "")
+    )
+    return job["status"]
+
+
+async def ingest_directory(args):
+    paths = find_pdfs(args.directory, args.recursive)
+    print(f"Found {len(paths)} PDFs")
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def run(path):
+        async with semaphore:
+            try:
+                return await ingest_file(path)
+            except Exception as e:
+                print(f"{os.path.basename(path)}: failed, error: {e}")
+                return "failed"
+
+    start = time.perf_counter()
+    async with lifespan(app):
+        results = await asyncio.gather(*(run(path) for path in paths))
+        stats = (await get_embedding_function.aget()).underlying.stats
+
+    counts = {status: results.count(status) for status in ("done", "skipped", "failed")}
+    print(f"{counts['done']} indexed, {counts['skipped']} already indexed, {counts['failed']} failed in {time.perf_counter() - start:.1f}s")
+    print(
+        f"Embedding requests: {stats['requests']} ({stats['tokens']} tokens), "
+        f"{stats['retries']} retries of which {stats['rate_limited']} were rate limited"
+    )
+    if counts["failed"]:
+        print("Run the command again to resume the failed documents")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory")
+    parser.add_argument("--recursive", action="store_true", help="also ingest PDFs in subdirectories")
+    parser.add_argument("--concurrency", type=int, default=2, help="documents ingested at once")
+    asyncio.run(ingest_directory(parser.parse_args()))
@@ -0,0 +1,105 @@
+"""A directory standing in for Azure Blob Storage, for local runs and benchmarks.
+
+Implements the subset of azure.storage.blob.aio.BlobClient the backend uses.
+Blobs are files under ``root``; blocks staged for a block blob are kept next
+to them until committed, as Azure keeps uncommitted blocks.
+"""
+import asyncio
+import hashlib
+import os
+import shutil
+
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+class LocalDownloader:
+    def __init__(self, path):
+        self.path = path
+
+    async def readall(self):
+        return await asyncio.to_thread(self._read)
+
+    def _read(self):
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    async def chunks(self):
+        with open(self.path, "rb") as f:
+            while chunk := await asyncio.to_thread(f.read, CHUNK_SIZE):
+                yield chunk
+
+
+class LocalBlobClient:
+    def __init__(self, root, blob_path):
+        self.path = os.path.join(root, blob_path)
+        self.staging_dir = os.path.join(root, ".staged", hashlib.sha256(blob_path.encode("utf-8")).hexdigest())
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        pass
+
+    async def exists(self):
+        return os.path.exists(self.path)
+
+    async def download_blob(self):
+        if not os.path.exists(self.path):
+            raise ResourceNotFoundError(f"{self.path} does not exist")
+        return LocalDownloader(self.path)
+
+    async def upload_blob(self, data, overwrite=False):
+        if not overwrite and os.path.exists(self.path):
+            raise ResourceExistsError(f"{self.path} already exists")
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if hasattr(data, "read"):
+            await asyncio.to_thread(self._copy, data)
+        else:
+            await asyncio.to_thread(self._write, data, "wb")
+
+    async def delete_blob(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            raise ResourceNotFoundError(f"{self.path} does not exist")
+
+    async def create_append_blob(self):
+        await asyncio.to_thread(self._write, b"", "wb")
+
+    async def append_block(self, data):
+        if not os.path.exists(self.path):
+            raise ResourceNotFoundError(f"{self.path} does not exist")
+        await asyncio.to_thread(self._write, data, "ab")
+
+    async def stage_block(self, block_id, data):
+        os.makedirs(self.staging_dir, exist_ok=True)
+        with open(os.path.join(self.staging_dir, hashlib.sha256(block_id.encode("ascii")).hexdigest()), "wb") as f:
+            await asyncio.to_thread(f.write, data)
+
+    async def commit_block_list(self, block_ids):
+        await asyncio.to_thread(self._commit, block_ids)
+
+    def _write(self, data, mode):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, mode) as f:
+            f.write(data)
+
+    def _copy(self, stream):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "wb") as f:
+            shutil.copyfileobj(stream, f, CHUNK_SIZE)
+
+    def _commit(self, block_ids):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "wb") as f:
+            for block_id in block_ids:
+                block_path = os.path.join(self.staging_dir, hashlib.sha256(block_id.encode("ascii")).hexdigest())
+                with open(block_path, "rb") as block:
+                    shutil.copyfileobj(block, f)
+        shutil.rmtree(self.staging_dir)
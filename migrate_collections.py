@@ -0,0 +1,77 @@
+"""Move vectors from the shared "langchain" collection into per-document collections.
+
+    python migrate_collections.py --host localhost --port 8000 [--delete-source]
+
+Embeddings are copied as stored, so nothing is re-embedded. Chunks are
+upserted under their existing ids, which makes the migration safe to re-run.
+"""
+import argparse
+import os
+from collections import defaultdict
+
+import chromadb
+
+from document_index import SHARED_COLLECTION, collection_name, get_collection
+
+
+def migrate(client, batch_size, delete_source, dry_run):
+    shared = get_collection(client, SHARED_COLLECTION)
+    if shared is None:
+        print(f"No '{SHARED_COLLECTION}' collection, nothing to migrate")
+        return
+
+    total = shared.count()
+    print(f"{total} vectors in '{SHARED_COLLECTION}'")
+    per_document = defaultdict(int)
+    migrated_ids = []
+    skipped = 0
+
+    offset = 0
+    while offset < total:
+        batch = shared.get(limit=batch_size, offset=offset, include=["embeddings", "documents", "metadatas"])
+        offset += batch_size
+
+        groups = defaultdict(lambda: {"ids": [], "embeddings": [], "documents": [], "metadatas": []})
+        for i, chunk_id in enumerate(batch["ids"]):
+            metadata = batch["metadatas"][i] or {}
+            pdf_uuid = metadata.get("pdf_uuid")
+            if not pdf_uuid:
+                skipped += 1
+                continue
+            group = groups[pdf_uuid]
+            group["ids"].append(chunk_id)
+            group["embeddings"].append(batch["embeddings"][i])
+            group["documents"].append(batch["documents"][i])
+            group["metadatas"].append(metadata)
+
+        for pdf_uuid, group in groups.items():
+            per_document[pdf_uuid] += len(group["ids"])
+            if not dry_run:
+                target = client.get_or_create_collection(collection_name(pdf_uuid), embedding_function=None)
+                target.upsert(**group)
+            migrated_ids.extend(group["ids"])
+
+    print(f"{len(migrated_ids)} vectors for {len(per_document)} documents, {skipped} without a pdf_uuid")
+    for pdf_uuid, count in sorted(per_document.items(), key=lambda item: -item[1]):
+        print(f"  {collection_name(pdf_uuid)}  {count}")
+
+    if delete_source and not dry_run:
+        # Delete only after every document has been copied
+        for start in range(0, len(migrated_ids), batch_size):
+            shared.delete(ids=migrated_ids[start:start + batch_size])
+        print(f"Deleted {len(migrated_ids)} migrated vectors from '{SHARED_COLLECTION}'")
+        if shared.count() == 0:
+            client.delete_collection(SHARED_COLLECTION)
+            print(f"Dropped empty '{SHARED_COLLECTION}' collection")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default=os.environ.get("CHROMADB_HOST", "localhost"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("CHROMADB_PORT", 8000)))
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--delete-source", action="store_true", help="remove migrated vectors from the shared collection")
+    parser.add_argument("--dry-run", action="store_true", help="report what would be moved without writing")
+    args = parser.parse_args()
+
+    migrate(chromadb.HttpClient(host=args.host, port=args.port), args.batch_size, args.delete_source, args.dry_run)
@@ -0,0 +1,47 @@
+import mmap
+import time
+from contextlib import contextmanager
+
+from pypdf import PdfReader
+from langchain_core.documents import Document
+
+from chunking import get_splitter, strip_repeated_lines, is_informative, fingerprint
+
+# Runs inside the backend's worker processes, so keep this module free of
+# secrets, clients and other import-time side effects.
+
+@contextmanager
+def open_pdf(file_path):
+    # PdfReader copies a file path into memory in full; a memory map lets every
+    # worker share the page cache and only touch the pages it parses
+    with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        yield PdfReader(buffer)
+
+def count_pages(file_path):
+    with open_pdf(file_path) as reader:
+        return len(reader.pages)
+
+def load_and_split_pages(file_path, start, stop):
+    # Parse and split pages [start, stop) and return
+    # (pages parsed, [(chunk text, page, seq, exact hash, minhash)], timings, header/footer lines removed)
+    started = time.perf_counter()
+    with open_pdf(file_path) as reader:
+        texts = [reader.pages[page].extract_text() for page in range(start, stop)]
+    parsed = time.perf_counter()
+
+    # Headers and footers are spotted within the range a worker gets, PDF_PAGES_PER_TASK pages
+    texts, stripped = strip_repeated_lines(texts)
+    documents = [Document(page_content=text, metadata={"page": page}) for page, text in zip(range(start, stop), texts)]
+    split = get_splitter().split_documents(documents)
+
+    # Number chunks within their page so chunk ids stay stable across re-ingests
+    chunks = []
+    seq = {}
+    for doc in split:
+        if not is_informative(doc.page_content):
+            continue
+        page = doc.metadata["page"]
+        seq[page] = seq.get(page, -1) + 1
+        chunks.append((doc.page_content, page, seq[page], *fingerprint(doc.page_content)))
+    timings = {"parse": parsed - started, "split": time.perf_counter() - parsed}
+    return stop - start, chunks, timings, stripped
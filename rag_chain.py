@@ -0,0 +1,127 @@
+import re
+import json
+import time
+import hashlib
+from cachetools import TTLCache
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnablePassthrough
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain.chains.combine_documents import create_stuff_documents_chain
+
+from telemetry import span, observe
+
+### Contextualize question ###
+contextualize_q_system_prompt = (
+    "Given a chat history and the latest user question "
+    "which might reference context in the chat history, "
+    "formulate a standalone question which can be understood "
+    "without the chat history. Do NOT answer the question, "
+    "just reformulate it if needed and otherwise return it as is."
+)
+contextualize_q_prompt = ChatPromptTemplate.from_messages(
+    [
+        ("system", contextualize_q_system_prompt),
+        MessagesPlaceholder("chat_history"),
+        ("human", "{input}"),
+    ]
+)
+
+### Answer question ###
+system_prompt = (
+    "You are an assistant for question-answering tasks. "
+    "Use the following pieces of retrieved context to answer "
+    "the question. If you don't know the answer, say that you "
+    "don't know. Use three sentences maximum and keep the "
+    "answer concise."
+    "\n\n"
+    "{context}"
+)
+qa_prompt = ChatPromptTemplate.from_messages(
+    [
+        ("system", system_prompt),
+        MessagesPlaceholder("chat_history"),
+        ("human", "{input}"),
+    ]
+)
+
+# Follow-ups that lean on earlier turns usually contain one of these words
+REFERENCE_PATTERN = (
+    r"\b(it|its|this|that|these|those|they|them|their|he|him|his|she|her|"
+    r"above|previous|earlier|former|latter|same|else|more|again|also)\b"
+)
+
+class QuestionRewriter:
+    """Turns a follow-up into a standalone question for retrieval.
+
+    The contextualize LLM call is skipped when there is no history, when the
+    question looks self-contained (``mode="heuristic"``), or when the same
+    question was rewritten recently for the same document and recent history.
+    """
+
+    def __init__(self, llm, mode="heuristic", min_words=6, history_turns=6, cache_size=1024, cache_ttl=600, reference_pattern=REFERENCE_PATTERN):
+        self.chain = contextualize_q_prompt | llm | StrOutputParser()
+        self.mode = mode
+        self.min_words = min_words
+        self.history_turns = history_turns
+        self.reference_re = re.compile(reference_pattern, re.IGNORECASE)
+        self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self.stats = {"no_history": 0, "self_contained": 0, "cache_hit": 0, "rewritten": 0}
+
+    def is_self_contained(self, question):
+        return len(question.split()) >= self.min_words and not self.reference_re.search(question)
+
+    async def arewrite(self, pdf_uuid, chat_history, question):
+        if not chat_history:
+            self.stats["no_history"] += 1
+            return question
+        if self.mode == "heuristic" and self.is_self_contained(question):
+            self.stats["self_contained"] += 1
+            return question
+
+        history = chat_history[-self.history_turns:]
+        history_hash = hashlib.sha256(
+            json.dumps([(m.type, m.content) for m in history]).encode("utf-8")
+        ).hexdigest()
+        key = (pdf_uuid, history_hash, question.strip())
+        if key in self.cache:
+            self.stats["cache_hit"] += 1
+            return self.cache[key]
+
+        self.stats["rewritten"] += 1
+        standalone = await self.chain.ainvoke({"chat_history": history, "input": question})
+        self.cache[key] = standalone
+        return standalone
+
+class RAGPipeline:
+    """Prompts and chains assembled once and shared by every request.
+
+    Retrieval goes through a ``DocumentIndex``, which searches only the
+    collection of the requested document.
+    """
+
+    def __init__(self, llm, index, **rewriter_options):
+        self.index = index
+        self.rewriter = QuestionRewriter(llm, **rewriter_options)
+        # Message chunks rather than text, so the token usage on the last chunk is not lost
+        self.answer_chain = create_stuff_documents_chain(llm, qa_prompt, output_parser=RunnablePassthrough())
+
+    async def astream(self, pdf_uuid, k, chat_history, question, usage=None):
+        # Yields the answer text; ``usage``, if given, receives the answer's token counts
+        with span("rag.rewrite"):
+            standalone = await self.rewriter.arewrite(pdf_uuid, chat_history, question)
+        with span("rag.retrieve"):
+            docs = await self.index.asearch(pdf_uuid, standalone, k)
+        # Not a span: the answer is streamed, and a span would stay open across yields
+        start = time.perf_counter()
+        try:
+            async for chunk in self.answer_chain.astream({"context": docs, "chat_history": chat_history, "input": question}):
+                if usage is not None and chunk.usage_metadata:
+                    usage.update(
+                        prompt_tokens=chunk.usage_metadata["input_tokens"],
+                        completion_tokens=chunk.usage_metadata["output_tokens"],
+                        total_tokens=chunk.usage_metadata["total_tokens"],
+                    )
+                if chunk.content:
+                    yield chunk.content
+        finally:
+            observe("rag.answer", time.perf_counter() - start)
@@ -0,0 +1,124 @@
+import hashlib
+import json
+from collections import defaultdict
+
+import numpy as np
+from cachetools import TTLCache
+
+from document_index import normalize_query
+
+
+class CachedResponse:
+    def __init__(self, chunks, usage, vector):
+        self.chunks = chunks
+        self.usage = usage
+        self.vector = vector
+        self.size = sum(len(chunk.encode("utf-8")) for chunk in chunks) + (vector.nbytes if vector is not None else 0) + 200
+
+
+class ResponseCache:
+    """Answers already given, replayed instead of generating them again.
+
+    Entries are keyed by endpoint, model, document, retrieval options, a hash
+    of the last ``context_messages`` messages before the question, and the
+    normalized question. In "semantic" mode a question with no exact match
+    is embedded. If an earlier question with the same key parts, apart from
+    the question itself, has cosine similarity of at least ``similarity``,
+    its answer is used. Entries expire after ``ttl`` seconds, and the least
+    recently used are evicted once they hold more than ``max_bytes``.
+    """
+
+    def __init__(self, embed=None, mode="exact", similarity=0.95, max_bytes=64 * 1024 * 1024, ttl=3600, context_messages=2):
+        self.embed = embed
+        self.mode = mode
+        self.similarity = similarity
+        self.context_messages = context_messages
+        self.entries = TTLCache(maxsize=max_bytes, ttl=ttl, getsizeof=lambda entry: entry.size)
+        # Question vectors by scope, for the semantic lookup; evicted keys are pruned when seen
+        self.vectors = defaultdict(dict)
+        self.stats = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "stored": 0, "invalidated": 0}
+
+    def scope(self, endpoint, model, pdf_uuid, options, context):
+        trimmed = context[-self.context_messages:] if self.context_messages else []
+        context_hash = hashlib.sha256(
+            json.dumps([(m.get("role"), m.get("content")) for m in trimmed], ensure_ascii=False).encode("utf-8")
+        ).hexdigest()
+        return (endpoint, model, pdf_uuid, options, context_hash)
+
+    async def lookup(self, endpoint, model, question, context, pdf_uuid=None, options=()):
+        """Returns (cached response or None, ticket for ``record``)."""
+        scope = self.scope(endpoint, model, pdf_uuid, options, context)
+        key = scope + (normalize_query(question),)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.stats["exact_hits"] += 1
+            return entry, None
+
+        vector = None
+        if self.mode == "semantic" and self.embed is not None:
+            vector = np.asarray(await self.embed(question), dtype=np.float32)
+            vector /= np.linalg.norm(vector) or 1.0
+            entry = self.nearest(scope, vector)
+            if entry is not None:
+                self.stats["semantic_hits"] += 1
+                return entry, None
+
+        self.stats["misses"] += 1
+        return None, (key, scope, vector)
+
+    def nearest(self, scope, vector):
+        candidates = self.vectors.get(scope)
+        if not candidates:
+            return None
+        best, best_score = None, self.similarity
+        for key in list(candidates):
+            entry = self.entries.get(key)
+            if entry is None:
+                del candidates[key]
+                continue
+            score = float(candidates[key] @ vector)
+            if score >= best_score:
+                best, best_score = entry, score
+        return best
+
+    def store(self, ticket, chunks, usage):
+        key, scope, vector = ticket
+        try:
+            self.entries[key] = CachedResponse(chunks, dict(usage), vector)
+        except ValueError:
+            # Larger than the whole cache
+            return
+        if vector is not None:
+            self.vectors[scope][key] = vector
+        self.stats["stored"] += 1
+
+    async def record(self, ticket, chunks, usage):
+        # Passes the stream through and caches it once it has finished; streams that fail
+        # or whose client disconnects are not cached
+        collected = []
+        async for chunk in chunks:
+            collected.append(chunk)
+            yield chunk
+        self.store(ticket, collected, usage)
+
+    def invalidate(self, pdf_uuid):
+        # Called when a document is re-ingested or deleted
+        for key in [key for key in list(self.entries.keys()) if key[2] == pdf_uuid]:
+            self.entries.pop(key, None)
+            self.stats["invalidated"] += 1
+        for scope in [scope for scope in self.vectors if scope[2] == pdf_uuid]:
+            del self.vectors[scope]
+
+    def read_stats(self):
+        lookups = self.stats["exact_hits"] + self.stats["semantic_hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "entries": len(self.entries),
+            "bytes": self.entries.currsize,
+            "hit_rate": (lookups - self.stats["misses"]) / lookups if lookups else None,
+        }
+
+
+async def replay(entry):
+    for chunk in entry.chunks:
+        yield chunk
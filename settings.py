@@ -0,0 +1,84 @@
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Setting name -> Key Vault secret name. The setting name is also the
+# environment variable / settings file key used as a fallback.
+SECRETS = {
+    "DB_NAME": "PROJ-DB-NAME",
+    "DB_USER": "PROJ-DB-USER",
+    "DB_PASSWORD": "PROJ-DB-PASSWORD",
+    "DB_HOST": "PROJ-DB-HOST",
+    "DB_PORT": "PROJ-DB-PORT",
+    "OPENAI_API_KEY": "PROJ-OPENAI-API-KEY",
+    "AZURE_STORAGE_SAS_URL": "PROJ-AZURE-STORAGE-SAS-URL",
+    "AZURE_STORAGE_CONTAINER": "PROJ-AZURE-STORAGE-CONTAINER",
+    "CHROMADB_HOST": "PROJ-CHROMADB-HOST",
+    "CHROMADB_PORT": "PROJ-CHROMADB-PORT",
+}
+
+
+class Settings:
+    """Secrets from Azure Key Vault, with environment and file fallbacks.
+
+    Key Vault secrets are fetched concurrently when ``KEY_VAULT_NAME`` is set.
+    Any secret not found there comes from the environment (including ``.env``)
+    or from a local JSON file. Values are cached for ``ttl`` seconds;
+    ``refresh()`` reloads them and reports whether anything rotated.
+    """
+
+    def __init__(self, secrets=SECRETS, vault_name=None, settings_file=None, ttl=3600):
+        self.secrets = secrets
+        self.vault_name = vault_name
+        self.settings_file = settings_file
+        self.ttl = ttl
+        self.values = {}
+        self.loaded_at = None
+        self.lock = threading.Lock()
+
+    def _from_file(self):
+        if not self.settings_file or not os.path.exists(self.settings_file):
+            return {}
+        with open(self.settings_file, encoding="utf-8") as f:
+            return {name: str(value) for name, value in json.load(f).items() if name in self.secrets}
+
+    def _from_env(self):
+        return {name: os.environ[name] for name in self.secrets if name in os.environ}
+
+    def _from_vault(self):
+        if not self.vault_name:
+            return {}
+        from azure.identity import DefaultAzureCredential
+        from azure.keyvault.secrets import SecretClient
+        from azure.core.exceptions import ResourceNotFoundError
+
+        client = SecretClient(vault_url=f"https://{self.vault_name}.vault.azure.net", credential=DefaultAzureCredential())
+
+        def fetch(item):
+            name, secret_name = item
+            try:
+                return name, client.get_secret(secret_name).value
+            except ResourceNotFoundError:
+                return name, None
+
+        with ThreadPoolExecutor(max_workers=len(self.secrets)) as executor:
+            return {name: value for name, value in executor.map(fetch, self.secrets.items()) if value is not None}
+
+    def refresh(self):
+        values = {**self._from_file(), **self._from_env(), **self._from_vault()}
+        missing = [name for name in self.secrets if name not in values]
+        if missing:
+            raise RuntimeError(f"Missing settings: {', '.join(missing)}")
+
+        with self.lock:
+            changed = bool(self.values) and values != self.values
+            self.values = values
+            self.loaded_at = time.monotonic()
+        return changed
+
+    def get(self, name):
+        if self.loaded_at is None:
+            self.refresh()
+        return self.values[name]
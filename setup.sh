@@ -32,8 +32,35 @@ sudo -u postgres psql -d project -c "CREATE TABLE IF NOT EXISTS advanced_chats (
     last_update TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     pdf_path TEXT,
     pdf_name TEXT,
-    pdf_uuid TEXT
+    pdf_uuid TEXT,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    log_count INTEGER NOT NULL DEFAULT 0
 );"
+# Chats saved before message_count existed get 0; run python backfill_search.py once the backend is configured to count them
+sudo -u postgres psql -d project -c "ALTER TABLE advanced_chats ADD COLUMN IF NOT EXISTS message_count INTEGER NOT NULL DEFAULT 0;"
+sudo -u postgres psql -d project -c "ALTER TABLE advanced_chats ADD COLUMN IF NOT EXISTS log_count INTEGER NOT NULL DEFAULT 0;"
+sudo -u postgres psql -d project -c "CREATE TABLE IF NOT EXISTS pdf_documents (
+    pdf_uuid TEXT PRIMARY KEY,
+    pdf_path TEXT NOT NULL,
+    pdf_name TEXT,
+    status TEXT NOT NULL,
+    chunk_count INTEGER NOT NULL DEFAULT 0,
+    pages_indexed INTEGER[] NOT NULL DEFAULT '{}',
+    claimed_at TIMESTAMP,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);"
+sudo -u postgres psql -d project -c "ALTER TABLE pdf_documents ADD COLUMN IF NOT EXISTS pages_indexed INTEGER[] NOT NULL DEFAULT '{}';"
+sudo -u postgres psql -d project -c "ALTER TABLE pdf_documents ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP;"
+sudo -u postgres psql -d project -c "CREATE TABLE IF NOT EXISTS chat_messages (
+    chat_id TEXT NOT NULL REFERENCES advanced_chats (id) ON DELETE CASCADE,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    content_tsv TSVECTOR GENERATED ALWAYS AS (to_tsvector('english', content)) STORED,
+    PRIMARY KEY (chat_id, seq)
+);"
+sudo -u postgres psql -d project -c "CREATE INDEX IF NOT EXISTS chat_messages_content_tsv_idx ON chat_messages USING GIN (content_tsv);"
+sudo -u postgres psql -d project -c "CREATE INDEX IF NOT EXISTS advanced_chats_last_update_idx ON advanced_chats (last_update DESC, id DESC);"
 
 # Set up Conda environment
 echo "Setting up conda environment..."
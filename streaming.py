@@ -0,0 +1,98 @@
+import asyncio
+import json
+import time
+
+from fastapi.responses import StreamingResponse
+
+MEDIA_TYPES = {"text": "text/plain; charset=utf-8", "sse": "text/event-stream", "ndjson": "application/x-ndjson"}
+
+
+async def coalesce(chunks, max_delay, max_chars):
+    """Group streamed text into larger pieces.
+
+    The first piece is sent as soon as it arrives, so time to first token is
+    unchanged. After that, text is held until ``max_chars`` characters have
+    built up or the oldest held text is ``max_delay`` seconds old.
+    """
+    iterator = chunks.__aiter__()
+    buffer = []
+    size = 0
+    held_since = None
+    first = True
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            timeout = None if held_since is None else max(0.0, held_since + max_delay - time.perf_counter())
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if not done:
+                # Upstream is slow; send what is held rather than sit on it
+                yield "".join(buffer)
+                buffer, size, held_since = [], 0, None
+                continue
+
+            try:
+                text = pending.result()
+            except StopAsyncIteration:
+                break
+            finally:
+                pending = None
+
+            if first or max_delay <= 0:
+                first = False
+                yield text
+                continue
+            buffer.append(text)
+            size += len(text)
+            if held_since is None:
+                held_since = time.perf_counter()
+            if size >= max_chars:
+                yield "".join(buffer)
+                buffer, size, held_since = [], 0, None
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        # Also reached when the client disconnects and the response is cancelled
+        if pending is not None:
+            pending.cancel()
+            await asyncio.wait({pending})
+        if hasattr(iterator, "aclose"):
+            await iterator.aclose()
+
+
+def encode_frame(stream_format, frame_type, payload):
+    if stream_format == "sse":
+        return f"event: {frame_type}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+    return json.dumps({"type": frame_type, **payload}, ensure_ascii=False) + "\n"
+
+
+async def frames(chunks, stream_format, timing, usage):
+    # One "delta" frame per coalesced piece, then a "done" frame with usage and timings,
+    # or an "error" frame if the upstream call fails part way
+    try:
+        async for text in chunks:
+            yield encode_frame(stream_format, "delta", {"text": text})
+    except Exception as e:
+        print(e)
+        yield encode_frame(stream_format, "error", {"detail": str(e)})
+        return
+    yield encode_frame(stream_format, "done", {"usage": usage or None, "timing": timing})
+
+
+def stream_tokens(chunks, stream_format, timing, usage, max_delay, max_chars, headers=None, slot=None):
+    """StreamingResponse for streamed LLM text.
+
+    ``stream_format`` is "text" (raw text, the original protocol), "sse" or
+    "ndjson". ``timing`` and ``usage`` are dicts filled in while the stream
+    runs and reported in the final frame. An admission ``slot``, if given, is
+    held until the response has been sent.
+    """
+    chunks = coalesce(chunks, max_delay, max_chars)
+    if stream_format != "text":
+        chunks = frames(chunks, stream_format, timing, usage)
+    if slot is not None:
+        chunks = slot.hold(chunks)
+    # X-Accel-Buffering keeps nginx from holding frames back
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no", **(headers or {})}
+    return StreamingResponse(chunks, media_type=MEDIA_TYPES[stream_format], headers=headers)
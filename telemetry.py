@@ -0,0 +1,132 @@
+import os
+import time
+from contextlib import contextmanager
+
+from opentelemetry import trace
+from prometheus_client import Counter, Gauge, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.registry import Collector
+
+# Stages are named "<area>.<step>", e.g. "rag.search" or "ingest.embed"
+STAGE_SECONDS = Histogram(
+    "stage_duration_seconds", "Time spent in each stage of a request or ingest job", ["stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+STAGE_ERRORS = Counter("stage_errors", "Stages that raised", ["stage"])
+TIME_TO_FIRST_TOKEN = Histogram(
+    "stream_time_to_first_token_seconds", "Time from request to first streamed token", ["endpoint"],
+    buckets=(0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10, 30),
+)
+TOKENS_PER_SECOND = Histogram(
+    "stream_tokens_per_second", "Streaming rate after the first token", ["endpoint"],
+    buckets=(1, 5, 10, 20, 40, 60, 80, 120, 160, 240, 320),
+)
+STREAM_TOKENS = Counter("stream_tokens", "Streamed tokens", ["endpoint"])
+LANE_QUEUE_DEPTH = Gauge("lane_queue_depth", "Callers waiting for a slot in an admission lane", ["lane"])
+LANE_IN_USE = Gauge("lane_in_use", "Slots held in an admission lane", ["lane"])
+LANE_WAIT_SECONDS = Histogram(
+    "lane_wait_seconds", "Time spent waiting for a slot in an admission lane", ["lane"],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+LANE_REJECTED = Counter("lane_rejected", "Callers turned away by an admission lane", ["lane", "reason"])
+CHUNKS_SKIPPED = Counter("ingest_chunks_skipped", "Chunks not embedded because they repeat earlier text of the document", ["reason"])
+
+tracer = trace.get_tracer("capstone.backend")
+
+
+@contextmanager
+def span(stage, **attributes):
+    # Recorded as a histogram sample and, when tracing is set up, as an OpenTelemetry span
+    start = time.perf_counter()
+    with tracer.start_as_current_span(stage, attributes=attributes):
+        try:
+            yield
+        except BaseException:
+            STAGE_ERRORS.labels(stage).inc()
+            raise
+        finally:
+            STAGE_SECONDS.labels(stage).observe(time.perf_counter() - start)
+
+
+def observe(stage, seconds):
+    # For stages timed elsewhere, e.g. in a worker process
+    STAGE_SECONDS.labels(stage).observe(seconds)
+
+
+async def timed_stream(endpoint, chunks, start, timing=None):
+    # Each streamed chunk counts as one token, which is what OpenAI sends.
+    # If given, ``timing`` is filled in with the same numbers once the stream ends
+    first = None
+    tokens = 0
+    try:
+        async for chunk in chunks:
+            if first is None:
+                first = time.perf_counter()
+                TIME_TO_FIRST_TOKEN.labels(endpoint).observe(first - start)
+            tokens += 1
+            yield chunk
+    finally:
+        end = time.perf_counter()
+        rate = None
+        if tokens:
+            STREAM_TOKENS.labels(endpoint).inc(tokens)
+            elapsed = end - first
+            if tokens > 1 and elapsed > 0:
+                rate = (tokens - 1) / elapsed
+                TOKENS_PER_SECOND.labels(endpoint).observe(rate)
+        if timing is not None:
+            timing.update(
+                time_to_first_token_ms=round((first - start) * 1000, 1) if first else None,
+                duration_ms=round((end - start) * 1000, 1),
+                tokens=tokens,
+                tokens_per_second=round(rate, 1) if rate else None,
+            )
+
+
+class StatsCollector(Collector):
+    """Publishes one of the app's stats dicts, read at scrape time.
+
+    Numeric values become counters, except for the keys listed in ``gauges``.
+    """
+
+    def __init__(self, prefix, read, gauges=()):
+        self.prefix = prefix
+        self.read = read
+        self.gauges = set(gauges)
+
+    def describe(self):
+        # Without this, registering would call collect() and build the services it reads from
+        return []
+
+    def collect(self):
+        try:
+            stats = self.read()
+        except Exception:
+            # Not available yet, e.g. before startup has finished
+            return
+        if stats is None:
+            return
+        for key, value in stats.items():
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                continue
+            name = f"{self.prefix}_{key}"
+            if key in self.gauges:
+                yield GaugeMetricFamily(name, f"{self.prefix} {key}", value=value)
+            else:
+                yield CounterMetricFamily(name, f"{self.prefix} {key}", value=value)
+
+
+def setup_tracing(app):
+    # Traces are only exported when an OTLP endpoint is configured
+    if not os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT"):
+        return
+    from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+    from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+    provider = TracerProvider(resource=Resource.create({"service.name": os.environ.get("OTEL_SERVICE_NAME", "capstone-backend")}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter()))
+    trace.set_tracer_provider(provider)
+    FastAPIInstrumentor.instrument_app(app, excluded_urls="metrics")
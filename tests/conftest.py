@@ -0,0 +1,261 @@
+"""Fakes for the services the backend talks to, so handlers run in-process.
+
+Settings come from the environment, blobs go to a local directory
+(local_blob.py), PDFs are parsed in threads, and Postgres, OpenAI and the
+history manager are replaced by the small fakes below.
+"""
+import asyncio
+import os
+import re
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+BLOB_ROOT = tempfile.mkdtemp(prefix="backend_tests_")
+os.environ.update({
+    "KEY_VAULT_NAME": "",
+    "SETTINGS_FILE": "",
+    "DB_NAME": "test",
+    "DB_USER": "test",
+    "DB_PASSWORD": "test",
+    "DB_HOST": "127.0.0.1",
+    "DB_PORT": "5432",
+    "OPENAI_API_KEY": "test",
+    "AZURE_STORAGE_SAS_URL": f"file://{BLOB_ROOT}",
+    "AZURE_STORAGE_CONTAINER": "test",
+    "CHROMADB_HOST": "127.0.0.1",
+    "CHROMADB_PORT": "8000",
+    "PDF_CHUNKER": "characters",
+    "ANONYMIZED_TELEMETRY": "False",
+})
+
+
+class FakeConnection:
+    """Just enough of asyncpg for the statements the tests exercise.
+
+    Rows of pdf_documents and advanced_chats are kept in dicts; a statement is
+    recognised by the table and columns it touches. Anything else is recorded
+    in ``statements`` and answered with None.
+    """
+
+    def __init__(self):
+        self.documents = {}
+        self.chats = {}
+        self.messages = {}
+        self.statements = []
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def fetchrow(self, query, *args):
+        query = " ".join(query.split())
+        if query.startswith("SELECT pdf_path, status FROM pdf_documents"):
+            return self.documents.get(args[0])
+        if query.startswith("UPDATE pdf_documents SET chunk_count = CASE"):
+            document = self.documents.get(args[0])
+            if document is None:
+                return None
+            if not document["pages_indexed"]:
+                document["chunk_count"] = 0
+            return document
+        if re.match(r"SELECT [\w, ]+ FROM advanced_chats WHERE id = \$1", query):
+            return self.chats.get(args[0])
+        if query.startswith("UPDATE advanced_chats SET last_update = CURRENT_TIMESTAMP, message_count = GREATEST"):
+            chat_id, appended, known_count = args
+            chat = self.chats[chat_id]
+            chat.update(message_count=max(chat["message_count"], known_count) + appended, log_count=chat["log_count"] + appended)
+            return chat
+        if query.startswith("DELETE FROM advanced_chats WHERE id = $1"):
+            return self.chats.pop(args[0], None)
+        if query.startswith("DELETE FROM pdf_documents WHERE pdf_uuid = $1"):
+            return self.documents.pop(args[0], None)
+        self.statements.append((query, args))
+        return None
+
+    async def fetchval(self, query, *args):
+        query = " ".join(query.split())
+        match = re.match(r"SELECT (\w+) FROM advanced_chats WHERE id = \$1", query)
+        if match:
+            chat = self.chats.get(args[0])
+            return chat and chat[match.group(1)]
+        if query.startswith("UPDATE advanced_chats SET file_path = $2, log_count = 0"):
+            chat_id, file_path, old_path, log_count = args
+            chat = self.chats.get(chat_id)
+            if not chat or chat["file_path"] != old_path or chat["log_count"] != log_count:
+                return None
+            chat.update(file_path=file_path, log_count=0)
+            return chat_id
+        if query.startswith("INSERT INTO pdf_documents"):
+            # The claim: a new document, or one no ingestion holds
+            pdf_uuid, pdf_path, pdf_name, claim_timeout = args
+            document = self.documents.get(pdf_uuid)
+            if document and (document["status"] == "done" or document["status"] == "processing" and time.monotonic() - document["claimed_at"] < claim_timeout):
+                return None
+            document = self.documents.setdefault(pdf_uuid, {"pages_indexed": [], "chunk_count": 0})
+            document.update(pdf_path=pdf_path, pdf_name=pdf_name, status="processing", claimed_at=time.monotonic())
+            return pdf_uuid
+        if query.startswith("SELECT EXISTS (SELECT 1 FROM advanced_chats WHERE pdf_uuid = $1 OR pdf_path = $2)"):
+            return any(chat.get("pdf_uuid") == args[0] or chat.get("pdf_path") == args[1] for chat in self.chats.values())
+        self.statements.append((query, args))
+        return None
+
+    async def execute(self, query, *args):
+        query = " ".join(query.split())
+        if query.startswith("UPDATE pdf_documents SET pages_indexed"):
+            pdf_uuid, pages, chunks = args
+            self.documents[pdf_uuid]["pages_indexed"] += pages
+            self.documents[pdf_uuid]["chunk_count"] += chunks
+            self.documents[pdf_uuid]["claimed_at"] = time.monotonic()
+        elif query.startswith("UPDATE pdf_documents SET status"):
+            self.documents[args[0]]["status"] = args[1]
+        else:
+            self.statements.append((query, args))
+
+    async def executemany(self, query, rows):
+        query = " ".join(query.split())
+        if query.startswith("INSERT INTO chat_messages"):
+            for chat_id, seq, role, content in rows:
+                self.messages[chat_id, seq] = (role, content)
+        else:
+            self.statements.append((query, rows))
+
+
+class FakePool:
+    # One shared connection; in_use counts how many times it is checked out
+    def __init__(self):
+        self.connection = FakeConnection()
+        self.in_use = 0
+
+    def acquire(self, timeout=None):
+        return FakeAcquire(self)
+
+    async def release(self, connection):
+        self.in_use -= 1
+
+
+class FakeAcquire:
+    # Like asyncpg's, usable with both await and async with
+    def __init__(self, pool):
+        self.pool = pool
+
+    def __await__(self):
+        yield from asyncio.sleep(0).__await__()
+        self.pool.in_use += 1
+        return self.pool.connection
+
+    async def __aenter__(self):
+        return await self
+
+    async def __aexit__(self, *exc_info):
+        await self.pool.release(self.pool.connection)
+
+
+class FakeCompletionStream:
+    def __init__(self, tokens, first_token_delay, token_delay):
+        self.tokens = tokens
+        self.first_token_delay = first_token_delay
+        self.token_delay = token_delay
+        self.closed = False
+
+    async def __aiter__(self):
+        await asyncio.sleep(self.first_token_delay)
+        for i, token in enumerate(self.tokens):
+            if i:
+                await asyncio.sleep(self.token_delay)
+            yield SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=SimpleNamespace(content=token))])
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeOpenAI:
+    """AsyncOpenAI with a chat.completions.create that streams canned tokens."""
+
+    def __init__(self, tokens=("Hello", " there", "."), first_token_delay=0.02, token_delay=0.005):
+        self.options = (list(tokens), first_token_delay, token_delay)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, **kwargs):
+        return FakeCompletionStream(*self.options)
+
+
+class PassthroughHistory:
+    async def fit(self, messages, chat_id=None):
+        return messages
+
+
+class FakeDocumentIndex:
+    def __init__(self):
+        self.added = []
+
+    async def aadd_texts(self, pdf_uuid, texts, ids, metadatas):
+        self.added.extend(zip(ids, texts, (metadata["page"] for metadata in metadatas)))
+
+    async def atexts(self, pdf_uuid, pages):
+        return [text for _, text, page in self.added if page in pages]
+
+    async def adelete(self, pdf_uuid):
+        pass
+
+
+def built(instance):
+    # Stands in for one of the backend's lazy getters whose client already exists
+    async def aget():
+        return instance
+
+    def get():
+        return instance
+
+    get.aget = aget
+    get.peek = get
+    return get
+
+
+@pytest.fixture
+def backend(monkeypatch, tmp_path):
+    """The backend module with fakes in place of Postgres, OpenAI and Chroma."""
+    import backend as module
+
+    executor = ThreadPoolExecutor(max_workers=2)
+    monkeypatch.setattr(module, "db_pool", FakePool())
+    monkeypatch.setattr(module, "pdf_executor", executor)
+    monkeypatch.setattr(module, "PDF_SPOOL_DIR", str(tmp_path / "spool"))
+    openai = FakeOpenAI()
+    index = FakeDocumentIndex()
+    history = PassthroughHistory()
+    monkeypatch.setattr(module, "get_openai_client", built(openai))
+    monkeypatch.setattr(module, "get_document_index", built(index))
+    monkeypatch.setattr(module, "get_history_manager", built(history))
+    yield module
+    executor.shutdown(wait=True)
+    module.ingest_jobs.clear()
+    module.chat_locks.clear()
+
+
+@pytest.fixture
+def chroma():
+    """An in-memory Chroma client, emptied before each test."""
+    import chromadb
+    from chromadb.config import Settings
+
+    chroma_client = chromadb.EphemeralClient(settings=Settings(allow_reset=True, anonymized_telemetry=False))
+    chroma_client.reset()
+    return chroma_client
+
+
+def client(module):
+    # Requests go straight to the app, on the test's event loop; lifespan is not run
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=module.app), base_url="http://backend")
+
+
+def blob_path(module, path):
+    return os.path.join(BLOB_ROOT, module.settings.get("AZURE_STORAGE_CONTAINER"), path)
@@ -0,0 +1,71 @@
+import asyncio
+
+from conftest import built, client
+
+
+def rag_chat(backend, messages):
+    async def main():
+        async with client(backend) as http:
+            return await http.post("/rag_chat/", json={"messages": messages, "pdf_uuid": "doc"})
+
+    return asyncio.run(main())
+
+
+def test_rag_chat_rejects_malformed_messages_without_taking_a_slot(backend):
+    backend.ingest_jobs["doc"] = {"status": "done"}
+    for messages in ([], [{"role": "user"}], [{"content": "hi"}, {"role": "user", "content": "apple?"}]):
+        assert rag_chat(backend, messages).status_code == 400
+    assert backend.lanes["interactive"].in_use == 0
+
+
+def test_rag_chat_gives_its_slot_back_when_the_pipeline_fails(backend, monkeypatch):
+    class BrokenPipeline:
+        def astream(self, *args, **kwargs):
+            raise RuntimeError("no pipeline")
+
+    backend.ingest_jobs["doc"] = {"status": "done"}
+    monkeypatch.setattr(backend, "get_rag_pipeline", built(BrokenPipeline()))
+    response = rag_chat(backend, [{"role": "user", "content": "apple?"}])
+    assert response.status_code == 500
+    assert backend.lanes["interactive"].in_use == 0
+
+
+def test_upload_is_turned_away_before_its_body_is_read(backend, monkeypatch):
+    monkeypatch.setattr(backend.lanes["bulk"], "is_full", lambda: True)
+    received = []
+    sent = []
+
+    async def receive():
+        received.append(True)
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http", "method": "POST", "path": "/upload_pdf/", "raw_path": b"/upload_pdf/", "query_string": b"",
+        "headers": [(b"content-type", b"multipart/form-data; boundary=x")], "scheme": "http", "server": ("backend", 80),
+        "client": ("test", 1), "root_path": "", "http_version": "1.1", "asgi": {"version": "3.0"},
+    }
+    asyncio.run(backend.app(scope, receive, send))
+    assert sent[0]["status"] == 429 and (b"retry-after", b"30") in sent[0]["headers"]
+    assert not received
+
+
+def test_chat_gives_its_slot_back_when_cancelled_before_streaming(backend, monkeypatch):
+    class SlowHistory:
+        async def fit(self, messages, chat_id=None):
+            await asyncio.sleep(10)
+
+    monkeypatch.setattr(backend, "get_history_manager", built(SlowHistory()))
+
+    async def main():
+        # e.g. the client disconnected while the history was being fitted
+        request = asyncio.create_task(backend.chat(backend.ChatRequest(messages=[{"role": "user", "content": "Hello?"}])))
+        while backend.lanes["interactive"].in_use == 0:
+            await asyncio.sleep(0.01)
+        request.cancel()
+        await asyncio.gather(request, return_exceptions=True)
+
+    asyncio.run(main())
+    assert backend.lanes["interactive"].in_use == 0
@@ -0,0 +1,107 @@
+import asyncio
+import json
+
+import pytest
+
+from conftest import blob_path, client
+
+
+def write_chat(backend, chat_id, snapshot, log):
+    file_path = f"chat_logs/{chat_id}.json"
+
+    async def main():
+        async with backend.get_blob_client(file_path) as blob_client:
+            await blob_client.upload_blob(json.dumps(snapshot), overwrite=True)
+        async with backend.get_blob_client(backend.get_log_path(file_path)) as blob_client:
+            await blob_client.create_append_blob()
+            await blob_client.append_block("".join(json.dumps(message) + "\n" for message in log).encode("utf-8"))
+
+    asyncio.run(main())
+    backend.db_pool.connection.chats[chat_id] = {
+        "file_path": file_path, "log_count": len(log), "message_count": len(snapshot) + len(log),
+    }
+
+
+def transcript(backend, chat_id):
+    return asyncio.run(backend.read_chat_messages(backend.db_pool.connection.chats[chat_id]["file_path"]))
+
+
+def messages(start, stop):
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": f"message {i}"} for i in range(start, stop)]
+
+
+def test_compaction_folds_the_log_into_a_new_snapshot(backend):
+    write_chat(backend, "chat-a", messages(0, 4), messages(4, 10))
+    asyncio.run(backend.compact_chat("chat-a"))
+
+    chat = backend.db_pool.connection.chats["chat-a"]
+    assert chat["log_count"] == 0 and chat["file_path"] != "chat_logs/chat-a.json"
+    assert transcript(backend, "chat-a") == messages(0, 10)
+    with open(blob_path(backend, chat["file_path"])) as f:
+        assert json.load(f) == messages(0, 10)
+
+
+def test_compaction_that_fails_before_switching_leaves_the_chat_as_it_was(backend, monkeypatch):
+    write_chat(backend, "chat-b", messages(0, 4), messages(4, 10))
+    connection = backend.db_pool.connection
+    fetchval = connection.fetchval
+
+    async def failing_fetchval(query, *args):
+        if query.split()[0] == "UPDATE":
+            raise ConnectionError("connection lost")
+        return await fetchval(query, *args)
+
+    monkeypatch.setattr(connection, "fetchval", failing_fetchval)
+    with pytest.raises(ConnectionError):
+        asyncio.run(backend.compact_chat("chat-b"))
+    assert transcript(backend, "chat-b") == messages(0, 10)
+
+    monkeypatch.setattr(connection, "fetchval", fetchval)
+    asyncio.run(backend.compact_chat("chat-b"))
+    assert transcript(backend, "chat-b") == messages(0, 10)
+    assert connection.chats["chat-b"]["log_count"] == 0
+
+
+def test_compaction_that_fails_after_switching_does_not_duplicate_messages(backend, monkeypatch):
+    write_chat(backend, "chat-c", messages(0, 4), messages(4, 10))
+    get_blob_client = backend.get_blob_client
+
+    def failing_deletes(path):
+        blob_client = get_blob_client(path)
+
+        async def delete_blob():
+            raise ConnectionError("storage unavailable")
+
+        blob_client.delete_blob = delete_blob
+        return blob_client
+
+    monkeypatch.setattr(backend, "get_blob_client", failing_deletes)
+    with pytest.raises(ConnectionError):
+        asyncio.run(backend.compact_chat("chat-c"))
+    monkeypatch.setattr(backend, "get_blob_client", get_blob_client)
+
+    assert transcript(backend, "chat-c") == messages(0, 10)
+    asyncio.run(backend.compact_chat("chat-c"))
+    assert transcript(backend, "chat-c") == messages(0, 10)
+
+
+def append(backend, chat_id, new_messages):
+    async def main():
+        async with client(backend) as http:
+            return await http.post("/append_chat/", json={"chat_id": chat_id, "messages": new_messages})
+
+    assert asyncio.run(main()).status_code == 200
+
+
+def test_append_to_a_chat_saved_before_message_count_indexes_after_its_messages(backend):
+    write_chat(backend, "chat-d", messages(0, 4), [])
+    connection = backend.db_pool.connection
+    connection.chats["chat-d"]["message_count"] = 0
+    connection.messages.update({("chat-d", seq): (role, content) for _, seq, role, content in backend.message_rows("chat-d", messages(0, 4))})
+
+    append(backend, "chat-d", messages(4, 6))
+    append(backend, "chat-d", messages(6, 7))
+
+    assert connection.chats["chat-d"]["message_count"] == 7
+    assert transcript(backend, "chat-d") == messages(0, 7)
+    assert connection.messages == {("chat-d", seq): (role, content) for _, seq, role, content in backend.message_rows("chat-d", messages(0, 7))}
@@ -0,0 +1,28 @@
+from chunking import line_key, strip_repeated_lines
+
+
+def page(number, body):
+    return "\n".join(["ACME Annual Report", *body, f"Page {number} of 9"])
+
+
+def test_headers_and_page_numbers_are_stripped():
+    pages = [page(n, [f"Body line {n}.{i} about the results." for i in range(6)]) for n in range(1, 6)]
+    stripped, removed = strip_repeated_lines(pages)
+    assert removed == 10
+    assert stripped[0].splitlines() == [f"Body line 1.{i} about the results." for i in range(6)]
+
+
+def test_short_pages_are_left_alone():
+    # One line per page: every line is at an edge, and all of them differ only by a number
+    pages = [f"Synthetic page {n} of the benchmark." for n in range(10)]
+    assert strip_repeated_lines(pages) == (pages, 0)
+    pages = [page(n, ["Only a little text."]) for n in range(1, 6)]
+    assert strip_repeated_lines(pages) == (pages, 0)
+
+
+def test_only_page_numbers_are_ignored():
+    assert line_key("Page 3  of 40") == line_key("page 4 of 40")
+    assert line_key("- 12 -") == line_key("- 13 -")
+    assert line_key("Report | p. 7") == line_key("Report | p. 8")
+    assert line_key("Table 3") != line_key("Table 4")
+    assert line_key("Results for 2023") != line_key("Results for 2024")
@@ -0,0 +1,187 @@
+import asyncio
+import os
+import threading
+
+from chromadb.errors import InvalidCollectionException
+
+from conftest import blob_path, built, client
+from document_index import SHARED_COLLECTION, DocumentIndex, collection_name
+from migrate_collections import migrate
+
+
+def test_migrate_without_a_shared_collection_does_nothing(chroma, capsys):
+    migrate(chroma, batch_size=100, delete_source=True, dry_run=False)
+    assert "nothing to migrate" in capsys.readouterr().out
+
+
+def test_migrate_moves_vectors_and_can_run_again(chroma, capsys):
+    shared = chroma.get_or_create_collection(SHARED_COLLECTION, embedding_function=None)
+    shared.upsert(
+        ids=["a-0-0", "a-1-0", "b-0-0"],
+        embeddings=[[1.0, 0.0], [0.0, 1.0], [1.0, 1.0]],
+        documents=["one", "two", "three"],
+        metadatas=[{"pdf_uuid": "a", "page": 0}, {"pdf_uuid": "a", "page": 1}, {"pdf_uuid": "b", "page": 0}],
+    )
+    migrate(chroma, batch_size=2, delete_source=True, dry_run=False)
+    assert chroma.get_collection(collection_name("a"), embedding_function=None).count() == 2
+    assert chroma.get_collection(collection_name("b"), embedding_function=None).count() == 1
+
+    # The shared collection is gone now; a second run must not fail
+    migrate(chroma, batch_size=2, delete_source=True, dry_run=False)
+    assert "nothing to migrate" in capsys.readouterr().out.splitlines()[-1]
+
+
+class KeywordEmbeddings:
+    # Two dimensions are enough to tell the test chunks apart
+    async def aembed_documents(self, texts):
+        return [self.embed(text) for text in texts]
+
+    async def aembed_query(self, text):
+        return self.embed(text)
+
+    def embed(self, text):
+        return [1.0 if "apple" in text else 0.0, 1.0 if "pear" in text else 0.0]
+
+
+def test_search_finds_the_documents_chunks(chroma):
+    index = DocumentIndex(chroma, KeywordEmbeddings())
+
+    async def main():
+        await index.aadd_texts("a", ["about apple", "about pear"], ids=["a-0-0", "a-0-1"], metadatas=[{"pdf_uuid": "a", "page": 0}] * 2)
+        return await index.asearch("a", "apple?", 1)
+
+    [doc] = asyncio.run(main())
+    assert doc.page_content == "about apple" and doc.id == "a-0-0" and doc.metadata["page"] == 0
+
+
+def test_search_for_an_unknown_document_creates_no_collection(chroma):
+    index = DocumentIndex(chroma, KeywordEmbeddings())
+    assert asyncio.run(index.asearch("unknown", "apple", 3)) == []
+    assert asyncio.run(index.acollection("unknown")) is None
+    assert chroma.list_collections() == []
+
+
+def test_rag_chat_about_an_unknown_document_is_404(backend, chroma, monkeypatch):
+    monkeypatch.setattr(backend, "get_document_index", built(DocumentIndex(chroma, KeywordEmbeddings())))
+
+    async def main():
+        async with client(backend) as http:
+            return await http.post("/rag_chat/", json={"messages": [{"role": "user", "content": "apple?"}], "pdf_uuid": "unknown"})
+
+    assert asyncio.run(main()).status_code == 404
+    assert chroma.list_collections() == []
+
+
+def add_legacy_chunks(chroma):
+    # Indexed before per-document collections: chunks of every document share one collection
+    shared = chroma.get_or_create_collection(SHARED_COLLECTION, embedding_function=None)
+    shared.upsert(
+        ids=["legacy-0-0", "legacy-1-0", "other-0-0"],
+        embeddings=[[1.0, 0.0], [0.0, 1.0], [1.0, 1.0]],
+        documents=["about apple", "about pear", "about both"],
+        metadatas=[{"pdf_uuid": "legacy", "page": 0}, {"pdf_uuid": "legacy", "page": 1}, {"pdf_uuid": "other", "page": 0}],
+    )
+    return shared
+
+
+def test_delete_removes_a_legacy_documents_chunks(chroma):
+    shared = add_legacy_chunks(chroma)
+    asyncio.run(DocumentIndex(chroma, KeywordEmbeddings()).adelete("legacy"))
+    assert shared.get()["ids"] == ["other-0-0"]
+
+
+class HttpLikeClient:
+    # Over HTTP, Chroma reports a missing collection with a ChromaError rather than a ValueError
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def delete_collection(self, name):
+        raise InvalidCollectionException(f"Collection {name} does not exist.")
+
+
+def test_delete_cleans_the_shared_collection_when_the_documents_collection_is_missing(chroma):
+    shared = add_legacy_chunks(chroma)
+    asyncio.run(DocumentIndex(HttpLikeClient(chroma), KeywordEmbeddings()).adelete("legacy"))
+    assert shared.get()["ids"] == ["other-0-0"]
+
+
+def test_delete_touches_the_caches_on_the_loop_and_chroma_in_a_thread(chroma):
+    threads = {}
+
+    class WatchedCache(dict):
+        def pop(self, *args):
+            threads["cache"] = threading.get_ident()
+            return super().pop(*args)
+
+    class WatchedClient(HttpLikeClient):
+        def delete_collection(self, name):
+            threads["chroma"] = threading.get_ident()
+            return self.client.delete_collection(name)
+
+    index = DocumentIndex(WatchedClient(chroma), KeywordEmbeddings())
+    index.collections = WatchedCache()
+
+    async def main():
+        await index.aadd_texts("a", ["apple"], ids=["a-0-0"], metadatas=[{"pdf_uuid": "a", "page": 0}])
+        generation = index.generations["a"]
+        await index.adelete("a")
+        return generation
+
+    generation = asyncio.run(main())
+    assert threads["cache"] == threading.get_ident() != threads["chroma"]
+    assert index.generations["a"] == generation + 1 and "a" not in index.collections
+    assert chroma.list_collections() == []
+
+
+def test_delete_chat_removes_a_legacy_document(backend, chroma, monkeypatch):
+    shared = add_legacy_chunks(chroma)
+    monkeypatch.setattr(backend, "get_document_index", built(DocumentIndex(HttpLikeClient(chroma), KeywordEmbeddings())))
+    db = backend.db_pool.connection
+    db.chats["chat"] = {"file_path": "chats/chat.json", "pdf_path": "pdfs/legacy.pdf", "pdf_uuid": "legacy"}
+    db.documents["legacy"] = {"pdf_path": "pdfs/legacy.pdf"}
+    path = blob_path(backend, "pdfs/legacy.pdf")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"%PDF-1.4\n")
+
+    async def main():
+        async with client(backend) as http:
+            return await http.post("/delete_chat/", json={"chat_id": "chat"})
+
+    assert asyncio.run(main()).status_code == 200
+    assert shared.get()["ids"] == ["other-0-0"]
+    assert not os.path.exists(path) and not db.documents
+
+
+def test_delete_chat_succeeds_when_the_vectors_cannot_be_deleted(backend, monkeypatch):
+    class UnavailableIndex:
+        async def adelete(self, pdf_uuid):
+            raise ConnectionError("Chroma unavailable")
+
+    monkeypatch.setattr(backend, "get_document_index", built(UnavailableIndex()))
+    db = backend.db_pool.connection
+    db.chats["chat"] = {"file_path": "chats/chat.json", "pdf_path": "pdfs/gone.pdf", "pdf_uuid": "gone"}
+    db.documents["gone"] = {"pdf_path": "pdfs/gone.pdf"}
+
+    async def main():
+        async with client(backend) as http:
+            return await http.post("/delete_chat/", json={"chat_id": "chat"})
+
+    # The rows are deleted either way; garbage_collect.py removes the vectors later
+    assert asyncio.run(main()).status_code == 200
+    assert not db.chats and not db.documents
+
+
+def test_texts_of_indexed_pages(chroma):
+    index = DocumentIndex(chroma, KeywordEmbeddings())
+
+    async def main():
+        metadatas = [{"pdf_uuid": "a", "page": page} for page in (0, 1, 2)]
+        await index.aadd_texts("a", ["apple", "pear", "apple pear"], ids=["a-0-0", "a-1-0", "a-2-0"], metadatas=metadatas)
+        return await index.atexts("a", [0, 2]), await index.atexts("unknown", [0])
+
+    texts, unknown = asyncio.run(main())
+    assert sorted(texts) == ["apple", "apple pear"] and unknown == []
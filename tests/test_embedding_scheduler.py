@@ -0,0 +1,124 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from openai import RateLimitError
+
+import embedding_scheduler
+from embedding_scheduler import EmbeddingScheduler
+
+
+class FakeClock:
+    """Stands in for time.monotonic and asyncio.sleep in embedding_scheduler.
+
+    Sleeping moves the clock forward instead of waiting, so pacing over
+    minutes runs instantly and the times the scheduler chose can be asserted.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        # A real sleep always takes some time, even when rounding leaves a few ulps to wait for
+        self.now += max(seconds, 1e-6)
+        await asyncio.sleep(0)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(embedding_scheduler, "time", SimpleNamespace(monotonic=fake.monotonic))
+    monkeypatch.setattr(embedding_scheduler, "asyncio", SimpleNamespace(
+        Lock=asyncio.Lock, Semaphore=asyncio.Semaphore, gather=asyncio.gather, sleep=fake.sleep,
+    ))
+    return fake
+
+
+def rate_limited(retry_after=None):
+    headers = {"retry-after": str(retry_after)} if retry_after is not None else {}
+    response = httpx.Response(429, headers=headers, request=httpx.Request("POST", "https://api.openai.com/v1/embeddings"))
+    return RateLimitError("Rate limit reached", response=response, body=None)
+
+
+class FakeEmbeddings:
+    """Records when each request was made; ``failures`` are raised by the first requests."""
+
+    def __init__(self, clock, failures=(), delay=0):
+        self.clock = clock
+        self.failures = list(failures)
+        self.delay = delay
+        self.calls = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def aembed_documents(self, texts):
+        self.calls.append((self.clock.now, list(texts)))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            # Real time, so concurrent requests overlap
+            await asyncio.sleep(self.delay)
+            if self.failures:
+                raise self.failures.pop(0)
+            return [[float(len(text))] for text in texts]
+        finally:
+            self.in_flight -= 1
+
+
+def scheduler(underlying, **options):
+    return EmbeddingScheduler(underlying, count_tokens=len, **options)
+
+
+def test_requests_are_paced_to_the_token_budget(clock):
+    underlying = FakeEmbeddings(clock)
+    # 600 tokens a minute; each text is one 600-token request
+    embeddings = scheduler(underlying, tokens_per_minute=600, max_batch_size=1)
+    vectors = asyncio.run(embeddings.aembed_documents(["x" * 600, "y" * 600, "z" * 600]))
+    assert vectors == [[600.0]] * 3
+    assert [at for at, _ in underlying.calls] == pytest.approx([0, 60, 120])
+
+
+def test_a_429_pauses_for_retry_after_and_retries(clock):
+    underlying = FakeEmbeddings(clock, failures=[rate_limited(retry_after=7)])
+    embeddings = scheduler(underlying)
+    vectors = asyncio.run(embeddings.aembed_documents(["apple", "pear"]))
+    assert vectors == [[5.0], [4.0]]
+    assert [at for at, _ in underlying.calls] == pytest.approx([0, 7], abs=0.1)
+    assert embeddings.stats["retries"] == 1 and embeddings.stats["rate_limited"] == 1
+
+
+def test_queries_skip_the_queue_but_hold_back_later_batches(clock):
+    underlying = FakeEmbeddings(clock)
+    embeddings = scheduler(underlying, tokens_per_minute=600)
+
+    async def main():
+        await embeddings.aembed_query("q" * 300)
+        await embeddings.aembed_documents(["d" * 600])
+
+    asyncio.run(main())
+    # The query went at once, and the batch waited for the 300 tokens it used to come back
+    assert [at for at, _ in underlying.calls] == pytest.approx([0, 30])
+
+
+def test_gives_up_after_max_retries(clock):
+    underlying = FakeEmbeddings(clock, failures=[rate_limited() for _ in range(5)])
+    embeddings = scheduler(underlying, max_retries=2, max_backoff=4)
+    with pytest.raises(RateLimitError):
+        asyncio.run(embeddings.aembed_documents(["apple"]))
+    assert len(underlying.calls) == 3 and embeddings.stats["requests"] == 0
+    # Exponential backoff with jitter: 1 then 2 seconds, each scaled by 0.5-1, plus a request's
+    # share of the per-second request budget
+    first, second, third = (at for at, _ in underlying.calls)
+    assert 0.5 <= second - first <= 1.1 and 1 <= third - second <= 2.1
+
+
+def test_requests_in_flight_are_capped(clock):
+    underlying = FakeEmbeddings(clock, delay=0.01)
+    embeddings = scheduler(underlying, max_concurrency=2, max_batch_size=1)
+    texts = [f"text {i}" for i in range(8)]
+    assert asyncio.run(embeddings.aembed_documents(texts)) == [[float(len(text))] for text in texts]
+    assert underlying.max_in_flight == 2 and len(underlying.calls) == 8
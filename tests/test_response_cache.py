@@ -0,0 +1,181 @@
+import asyncio
+
+import pytest
+
+from conftest import built, client
+from response_cache import ResponseCache, replay
+
+
+async def answer(cache, ticket, chunks, usage=None):
+    # Streams an answer through record to the end, as a client that reads it all would
+    return [chunk async for chunk in cache.record(ticket, stream(chunks), usage or {})]
+
+
+async def stream(chunks, fail_after=None):
+    for i, chunk in enumerate(chunks):
+        if i == fail_after:
+            raise ConnectionError("upstream closed")
+        yield chunk
+
+
+def ask(cache, question, context=(), pdf_uuid="doc", endpoint="rag_chat"):
+    return asyncio.run(cache.lookup(endpoint, "gpt", question, list(context), pdf_uuid=pdf_uuid, options=(5,)))
+
+
+def cached_answer(cache, question, **kwargs):
+    entry, _ = ask(cache, question, **kwargs)
+    return entry and asyncio.run(collect(replay(entry)))
+
+
+async def collect(chunks):
+    return [chunk async for chunk in chunks]
+
+
+def remember(cache, question, chunks, **kwargs):
+    entry, ticket = ask(cache, question, **kwargs)
+    assert entry is None
+    asyncio.run(answer(cache, ticket, chunks, {"total_tokens": 7}))
+
+
+def test_exact_hit_after_the_answer_is_streamed():
+    cache = ResponseCache()
+    remember(cache, "What is the refund policy?", ["Thirty", " days."])
+    entry, ticket = ask(cache, "  what is the refund policy ")
+    assert ticket is None and entry.usage == {"total_tokens": 7}
+    assert asyncio.run(collect(replay(entry))) == ["Thirty", " days."]
+    assert cache.stats["exact_hits"] == 1
+
+
+def test_key_includes_document_endpoint_and_context():
+    cache = ResponseCache()
+    remember(cache, "Summary?", ["A."], context=[{"role": "user", "content": "Hi"}])
+    assert cached_answer(cache, "Summary?", context=[{"role": "user", "content": "Hi"}]) == ["A."]
+    assert cached_answer(cache, "Summary?", context=[{"role": "user", "content": "Hello"}]) is None
+    assert cached_answer(cache, "Summary?", context=[{"role": "user", "content": "Hi"}], pdf_uuid="other") is None
+    assert cached_answer(cache, "Summary?", context=[{"role": "user", "content": "Hi"}], endpoint="chat") is None
+
+
+VECTORS = {
+    "how long do refunds take": [1.0, 0.0, 0.0],
+    "how many days for a refund": [0.99, 0.1, 0.0],
+    "how do i cancel": [0.6, 0.8, 0.0],
+}
+
+
+async def embed(text):
+    return VECTORS[text.lower().strip("?")]
+
+
+def test_semantic_hit_above_the_threshold_and_miss_below():
+    cache = ResponseCache(embed=embed, mode="semantic", similarity=0.95)
+    remember(cache, "How long do refunds take?", ["Five days."])
+    assert cached_answer(cache, "How many days for a refund?") == ["Five days."]
+    # Cosine similarity 0.6
+    assert cached_answer(cache, "How do I cancel?") is None
+    # Similar, but about another document
+    assert cached_answer(cache, "How many days for a refund?", pdf_uuid="other") is None
+    assert cache.stats["semantic_hits"] == 1 and cache.stats["misses"] == 3
+
+
+def test_exact_mode_does_not_embed():
+    async def failing_embed(text):
+        raise AssertionError("embedded in exact mode")
+
+    cache = ResponseCache(embed=failing_embed, mode="exact")
+    remember(cache, "How long do refunds take?", ["Five days."])
+    assert cached_answer(cache, "How many days for a refund?") is None
+
+
+def test_least_recently_used_answers_are_evicted_past_max_bytes():
+    # Each entry is its text plus 200 bytes of overhead
+    cache = ResponseCache(max_bytes=1000)
+    for question in ("one", "two", "three"):
+        remember(cache, question, ["x" * 100])
+    assert cached_answer(cache, "one") is not None
+    remember(cache, "four", ["x" * 100])
+    assert cached_answer(cache, "two") is None
+    assert all(cached_answer(cache, question) for question in ("one", "three", "four"))
+    assert cache.read_stats()["bytes"] <= 1000
+    # Larger than the whole cache: passed through, never stored
+    remember(cache, "five", ["x" * 2000])
+    assert cached_answer(cache, "five") is None and cached_answer(cache, "one") is not None
+
+
+def test_failed_and_abandoned_streams_are_not_cached():
+    cache = ResponseCache()
+    _, ticket = ask(cache, "failed?")
+
+    async def failed():
+        return [chunk async for chunk in cache.record(ticket, stream(["a", "b", "c"], fail_after=2), {})]
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(failed())
+    assert cached_answer(cache, "failed?") is None
+
+    _, ticket = ask(cache, "abandoned?")
+
+    async def abandoned():
+        # The client disconnects after the first chunk
+        chunks = cache.record(ticket, stream(["a", "b", "c"]), {})
+        first = await chunks.__anext__()
+        await chunks.aclose()
+        return first
+
+    assert asyncio.run(abandoned()) == "a"
+    assert cached_answer(cache, "abandoned?") is None
+
+    _, ticket = ask(cache, "cancelled?")
+
+    async def cancelled():
+        async def slow():
+            yield "a"
+            await asyncio.sleep(10)
+            yield "b"
+
+        async def consume():
+            return [chunk async for chunk in cache.record(ticket, slow(), {})]
+
+        task = asyncio.create_task(consume())
+        await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(cancelled())
+    assert cached_answer(cache, "cancelled?") is None
+    assert cache.stats["stored"] == 0
+
+
+def test_invalidate_drops_only_that_documents_answers():
+    cache = ResponseCache(embed=embed, mode="semantic")
+    remember(cache, "How long do refunds take?", ["Five days."], pdf_uuid="doc")
+    remember(cache, "How long do refunds take?", ["Ten days."], pdf_uuid="other")
+    cache.invalidate("doc")
+    assert cached_answer(cache, "How long do refunds take?", pdf_uuid="doc") is None
+    assert cached_answer(cache, "How many days for a refund?", pdf_uuid="doc") is None
+    assert cached_answer(cache, "How long do refunds take?", pdf_uuid="other") == ["Ten days."]
+    assert cache.stats["invalidated"] == 1
+
+
+def test_reingesting_or_deleting_a_document_invalidates_its_answers(backend, monkeypatch):
+    cache = ResponseCache()
+    monkeypatch.setattr(backend, "get_response_cache", built(cache))
+    remember(cache, "Summary?", ["Old answer."], pdf_uuid="doc")
+
+    async def reingest():
+        async with backend.db_pool.acquire() as db:
+            assert await backend.register_document(db, "doc", "pdf_store/doc.pdf", "doc.pdf")
+
+    asyncio.run(reingest())
+    assert cached_answer(cache, "Summary?", pdf_uuid="doc") is None
+
+    backend.ingest_jobs["doc"]["status"] = "done"
+    backend.db_pool.connection.documents["doc"]["status"] = "done"
+    remember(cache, "Summary?", ["New answer."], pdf_uuid="doc")
+    backend.db_pool.connection.chats["chat"] = {"file_path": "chat_logs/chat.json", "pdf_path": "pdf_store/doc.pdf", "pdf_uuid": "doc"}
+
+    async def delete():
+        async with client(backend) as http:
+            return await http.post("/delete_chat/", json={"chat_id": "chat"})
+
+    assert asyncio.run(delete()).status_code == 200
+    assert cached_answer(cache, "Summary?", pdf_uuid="doc") is None
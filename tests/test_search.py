@@ -0,0 +1,6 @@
+def test_snippets_are_escaped_and_only_matches_are_marked(backend):
+    start, stop = backend.SNIPPET_START, backend.SNIPPET_STOP
+    snippet = f"run <script>alert('{start}x{stop}')</script> & {start}apple{stop}"
+    assert backend.highlight(snippet) == (
+        "run &lt;script&gt;alert(&#x27;<mark>x</mark>&#x27;)&lt;/script&gt; &amp; <mark>apple</mark>"
+    )
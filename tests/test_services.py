@@ -0,0 +1,41 @@
+import asyncio
+import threading
+import time
+
+from conftest import client
+
+
+def test_lazy_clients_are_built_once_off_the_event_loop(backend):
+    built_in = []
+
+    @backend.lazy
+    def get_client():
+        built_in.append(threading.get_ident())
+        time.sleep(0.05)
+        return object()
+
+    backend.lazy_services.remove(get_client)
+    assert get_client.peek() is None
+
+    async def main():
+        first, second = await asyncio.gather(get_client.aget(), get_client.aget())
+        return threading.get_ident(), first, second
+
+    loop_thread, first, second = asyncio.run(main())
+    assert first is second is get_client.peek()
+    assert len(built_in) == 1 and built_in[0] != loop_thread
+
+
+def test_metrics_scrape_does_not_build_clients(backend):
+    async def main():
+        async with client(backend) as http:
+            start = time.perf_counter()
+            response = await http.get("/metrics")
+            return response, time.perf_counter() - start
+
+    response, elapsed = asyncio.run(main())
+    assert response.status_code == 200
+    assert backend.get_rag_pipeline.peek() is None
+    assert backend.get_embedding_function.peek() is None
+    assert backend.get_response_cache.peek() is None
+    assert elapsed < 0.5
@@ -0,0 +1,133 @@
+import asyncio
+import json
+
+from admission import Lane
+from streaming import coalesce, stream_tokens
+
+
+class FakeTokens:
+    """Async iterator over (delay, text) pairs; ``closed`` is set once it is closed or cancelled."""
+
+    def __init__(self, script, fail_with=None):
+        self.script = script
+        self.fail_with = fail_with
+        self.closed = False
+
+    async def generate(self):
+        try:
+            for delay, text in self.script:
+                await asyncio.sleep(delay)
+                yield text
+            if self.fail_with:
+                raise self.fail_with
+        finally:
+            self.closed = True
+
+    def __aiter__(self):
+        return self.generate()
+
+
+async def collect(chunks):
+    return [chunk async for chunk in chunks]
+
+
+def body(response):
+    return asyncio.run(collect(response.body_iterator))
+
+
+def tokens(*texts):
+    return FakeTokens([(0, text) for text in texts])
+
+
+def test_coalesce_sends_the_first_token_alone_then_groups_to_max_chars():
+    pieces = asyncio.run(collect(coalesce(tokens("Hel", "lo", " w", "or", "ld", "!"), max_delay=10, max_chars=4)))
+    assert pieces == ["Hel", "lo w", "orld", "!"]
+
+
+def test_coalesce_flushes_held_text_after_max_delay():
+    upstream = FakeTokens([(0, "a"), (0, "b"), (0.3, "c")])
+    pieces = asyncio.run(collect(coalesce(upstream, max_delay=0.05, max_chars=100)))
+    # "b" is sent when it has been held for max_delay, not when "c" finally arrives
+    assert pieces == ["a", "b", "c"]
+    assert upstream.closed
+
+
+def test_coalesce_is_off_when_max_delay_is_zero():
+    pieces = asyncio.run(collect(coalesce(tokens("a", "b", "c"), max_delay=0, max_chars=100)))
+    assert pieces == ["a", "b", "c"]
+
+
+def parse_ndjson(payload):
+    # As chatbot.py reads the stream: one JSON frame per line
+    return [json.loads(line) for line in payload.splitlines() if line]
+
+
+def parse_sse(payload):
+    frames = []
+    for event in payload.split("\n\n"):
+        if event:
+            name, data = event.split("\n")
+            assert name.startswith("event: ") and data.startswith("data: ")
+            frames.append({"type": name[len("event: "):], **json.loads(data[len("data: "):])})
+    return frames
+
+
+def test_text_format_streams_raw_text():
+    response = stream_tokens(tokens("Hello", " wörld"), "text", {}, {}, max_delay=0, max_chars=1)
+    assert response.media_type == "text/plain; charset=utf-8"
+    assert "".join(body(response)) == "Hello wörld"
+
+
+def test_framed_formats_send_deltas_then_usage_and_timing():
+    for stream_format, parse, media_type in (
+        ("ndjson", parse_ndjson, "application/x-ndjson"),
+        ("sse", parse_sse, "text/event-stream"),
+    ):
+        timing = {"tokens": 3}
+        usage = {"total_tokens": 12}
+        response = stream_tokens(tokens("Café", " ☕", "\nok"), stream_format, timing, usage, max_delay=0, max_chars=1)
+        assert response.media_type == media_type
+        assert response.headers["x-accel-buffering"] == "no"
+        frames = parse("".join(body(response)))
+        assert [frame["text"] for frame in frames[:-1]] == ["Café", " ☕", "\nok"]
+        assert all(frame["type"] == "delta" for frame in frames[:-1])
+        assert frames[-1] == {"type": "done", "usage": usage, "timing": timing}
+
+
+def test_upstream_failure_ends_with_an_error_frame():
+    upstream = FakeTokens([(0, "partial")], fail_with=ConnectionError("upstream reset"))
+    frames = parse_ndjson("".join(body(stream_tokens(upstream, "ndjson", {}, {}, max_delay=0, max_chars=1))))
+    assert frames == [{"type": "delta", "text": "partial"}, {"type": "error", "detail": "upstream reset"}]
+
+
+def test_slot_is_released_and_upstream_closed_when_the_client_goes_away():
+    async def cancelled():
+        lane = Lane("test", 1, 0)
+        upstream = FakeTokens([(0, "first"), (10, "never sent")])
+        response = stream_tokens(upstream, "ndjson", {}, {}, max_delay=0.01, max_chars=100, slot=await lane.acquire())
+        received = []
+
+        async def send():
+            async for frame in response.body_iterator:
+                received.append(frame)
+
+        task = asyncio.create_task(send())
+        await asyncio.sleep(0.05)
+        assert lane.in_use == 1 and len(received) == 1
+        # What the server does to the response task when the client disconnects
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return lane, upstream
+
+    async def closed():
+        lane = Lane("test", 1, 0)
+        upstream = FakeTokens([(0, "first"), (10, "never sent")])
+        response = stream_tokens(upstream, "sse", {}, {}, max_delay=0.01, max_chars=100, slot=await lane.acquire())
+        assert parse_sse(await response.body_iterator.__anext__()) == [{"type": "delta", "text": "first"}]
+        await response.body_iterator.aclose()
+        return lane, upstream
+
+    for disconnect in (cancelled, closed):
+        lane, upstream = asyncio.run(disconnect())
+        assert lane.in_use == 0
+        assert upstream.closed
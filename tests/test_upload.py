@@ -0,0 +1,307 @@
+import asyncio
+import glob
+import hashlib
+import os
+import time
+import tracemalloc
+
+import pdf_processing
+from chunking import fingerprint
+from conftest import blob_path, client
+from local_blob import LocalBlobClient
+
+PARSE_SECONDS = 0.3
+
+
+def slow_count_pages(file_path):
+    time.sleep(PARSE_SECONDS)
+    return 3
+
+
+def slow_load_and_split_pages(file_path, start, stop):
+    # Blocks its thread the way pypdf does; the event loop must not notice
+    time.sleep(PARSE_SECONDS)
+    chunks = [(f"Page {page} of the test document, long enough to keep.", page, 0) for page in range(start, stop)]
+    return stop - start, [chunk + fingerprint(chunk[0]) for chunk in chunks], {"parse": PARSE_SECONDS, "split": 0.0}, 0
+
+
+class SlowBlobClient(LocalBlobClient):
+    # Each block takes a while to reach storage, as it would over the network
+    async def stage_block(self, block_id, data):
+        await asyncio.sleep(0.05)
+        await super().stage_block(block_id, data)
+
+
+def use_blob_client(backend, monkeypatch, blob_class):
+    get_blob_client = backend.get_blob_client
+
+    def get(path):
+        blob_client = get_blob_client(path)
+        blob_client.__class__ = blob_class
+        return blob_client
+
+    monkeypatch.setattr(backend, "get_blob_client", get)
+
+
+async def first_token_seconds(backend):
+    start = time.perf_counter()
+    response = await backend.chat(backend.ChatRequest(messages=[{"role": "user", "content": "Hello?"}]))
+    iterator = response.body_iterator.__aiter__()
+    await iterator.__anext__()
+    elapsed = time.perf_counter() - start
+    await iterator.aclose()
+    return elapsed
+
+
+async def wait_for_ingestion(backend):
+    while backend.ingest_tasks:
+        await asyncio.gather(*backend.ingest_tasks)
+
+
+def test_chat_first_token_is_not_delayed_by_an_upload(backend, monkeypatch):
+    use_blob_client(backend, monkeypatch, SlowBlobClient)
+    monkeypatch.setattr(pdf_processing, "count_pages", slow_count_pages)
+    monkeypatch.setattr(pdf_processing, "load_and_split_pages", slow_load_and_split_pages)
+    monkeypatch.setattr(backend, "PDF_PAGES_PER_TASK", 1)
+    monkeypatch.setattr(backend, "UPLOAD_CHUNK_SIZE", 64 * 1024)
+    data = b"%PDF-1.4\n" + os.urandom(2 * 1024 * 1024)
+
+    async def main():
+        idle = [await first_token_seconds(backend) for _ in range(3)]
+        async with client(backend) as http:
+            upload = asyncio.create_task(http.post("/upload_pdf/", files={"file": ("big.pdf", data, "application/pdf")}))
+            await asyncio.sleep(0.05)
+            during_upload, during_ingest = [], []
+            while not upload.done():
+                during_upload.append(await first_token_seconds(backend))
+            response = await upload
+            while backend.ingest_tasks:
+                during_ingest.append(await first_token_seconds(backend))
+            await wait_for_ingestion(backend)
+        return idle, during_upload, during_ingest, response
+
+    idle, during_upload, during_ingest, response = asyncio.run(main())
+    assert response.status_code == 200
+    assert during_upload and during_ingest
+    # Each parse blocks a thread for PARSE_SECONDS; on the event loop it would show up here
+    assert max(during_upload + during_ingest) < max(idle) + PARSE_SECONDS / 2
+    assert backend.ingest_jobs[response.json()["pdf_uuid"]]["status"] == "done"
+
+
+def test_upload_is_hashed_staged_and_spooled_in_one_pass(backend, monkeypatch):
+    monkeypatch.setattr(pdf_processing, "count_pages", lambda file_path: 2)
+    monkeypatch.setattr(pdf_processing, "load_and_split_pages", lambda file_path, start, stop: (stop - start, [], {"parse": 0.0, "split": 0.0}, 0))
+    monkeypatch.setattr(backend, "UPLOAD_CHUNK_SIZE", 1000)
+    data = b"%PDF-1.4\n" + os.urandom(10_500)
+
+    async def main():
+        async with client(backend) as http:
+            first = await http.post("/upload_pdf/", files={"file": ("doc.pdf", data, "application/pdf")})
+            await wait_for_ingestion(backend)
+            second = await http.post("/upload_pdf/", files={"file": ("again.pdf", data, "application/pdf")})
+        return first, second
+
+    first, second = asyncio.run(main())
+    assert first.status_code == 200
+    body = first.json()
+    assert body["pdf_uuid"] == hashlib.sha256(data).hexdigest()
+    assert not body["deduplicated"]
+    with open(blob_path(backend, body["pdf_path"]), "rb") as f:
+        assert f.read() == data
+    # The spool file is removed once ingestion is done, and the duplicate never leaves one
+    assert second.json()["deduplicated"] and second.json()["pdf_uuid"] == body["pdf_uuid"]
+    assert glob.glob(os.path.join(backend.PDF_SPOOL_DIR, "*")) == []
+
+
+def test_failed_upload_removes_its_spool_file(backend, monkeypatch):
+    class FailingBlobClient(LocalBlobClient):
+        async def stage_block(self, block_id, data):
+            raise OSError("storage unavailable")
+
+    use_blob_client(backend, monkeypatch, FailingBlobClient)
+
+    async def main():
+        async with client(backend) as http:
+            return await http.post("/upload_pdf/", files={"file": ("doc.pdf", b"%PDF-1.4\n" + os.urandom(5000), "application/pdf")})
+
+    response = asyncio.run(main())
+    assert response.status_code == 500
+    assert glob.glob(os.path.join(backend.PDF_SPOOL_DIR, "*")) == []
+
+
+def test_resumed_ingestion_skips_repeats_of_checkpointed_pages(backend, monkeypatch, tmp_path):
+    words = " ".join(f"word{i}" for i in range(60))
+    pages = {0: [words], 1: [words.replace("word59", "final"), "A different chunk about something else entirely."]}
+    failing = [True]
+
+    def load_and_split_pages(file_path, start, stop):
+        if start == 1 and failing[0]:
+            # Fails once page 0 has been checkpointed
+            time.sleep(0.2)
+            raise OSError("worker lost")
+        chunks = [(text, start, seq) + fingerprint(text) for seq, text in enumerate(pages[start])]
+        return stop - start, chunks, {"parse": 0.0, "split": 0.0}, 0
+
+    monkeypatch.setattr(pdf_processing, "count_pages", lambda file_path: 2)
+    monkeypatch.setattr(pdf_processing, "load_and_split_pages", load_and_split_pages)
+    monkeypatch.setattr(backend, "PDF_PAGES_PER_TASK", 1)
+    monkeypatch.setattr(backend, "INGEST_BATCH_SIZE", 1)
+    index = backend.get_document_index()
+
+    async def ingest():
+        path = tmp_path / "doc.pdf"
+        path.write_bytes(b"%PDF-1.4\n")
+        async with backend.db_pool.acquire() as db:
+            await backend.register_document(db, "doc", "pdfs/doc.pdf", "doc.pdf")
+        await backend.ingest_pdf("doc", str(path))
+        return backend.ingest_jobs["doc"]
+
+    assert asyncio.run(ingest())["status"] == "failed"
+    assert [chunk_id for chunk_id, _, _ in index.added] == ["doc-0-0"]
+    failing[0] = False
+    job = asyncio.run(ingest())
+    assert job["status"] == "done" and job["chunks_skipped"] == 1
+    # The near-duplicate of page 0 on page 1 is not embedded again
+    assert [chunk_id for chunk_id, _, _ in index.added] == ["doc-0-0", "doc-1-1"]
+
+
+def test_upload_holds_no_connection_while_it_streams(backend, monkeypatch):
+    in_use = []
+
+    class WatchedBlobClient(LocalBlobClient):
+        async def stage_block(self, block_id, data):
+            in_use.append(backend.db_pool.in_use)
+            await super().stage_block(block_id, data)
+
+    use_blob_client(backend, monkeypatch, WatchedBlobClient)
+    monkeypatch.setattr(pdf_processing, "count_pages", lambda file_path: 1)
+    monkeypatch.setattr(pdf_processing, "load_and_split_pages", lambda file_path, start, stop: (stop - start, [], {"parse": 0.0, "split": 0.0}, 0))
+    monkeypatch.setattr(backend, "UPLOAD_CHUNK_SIZE", 1000)
+
+    async def main():
+        async with client(backend) as http:
+            response = await http.post("/upload_pdf/", files={"file": ("doc.pdf", b"%PDF-1.4\n" + os.urandom(5000), "application/pdf")})
+            await wait_for_ingestion(backend)
+        return response
+
+    assert asyncio.run(main()).status_code == 200
+    assert len(in_use) == 6 and not any(in_use)
+    assert backend.db_pool.in_use == 0
+
+
+class StreamedBody:
+    # An UploadFile whose content is generated as it is read, so only the test's reads use memory
+    def __init__(self, size):
+        self.remaining = size
+
+    async def read(self, size):
+        size = min(size, self.remaining)
+        self.remaining -= size
+        return os.urandom(size)
+
+
+def test_spool_upload_memory_is_bounded_by_the_chunk_size(backend, monkeypatch, tmp_path):
+    chunk_size = 1024 * 1024
+    size = 48 * chunk_size
+    monkeypatch.setattr(backend, "UPLOAD_CHUNK_SIZE", chunk_size)
+
+    async def main():
+        # A small upload first, so lazy imports and worker threads are not counted
+        with open(tmp_path / "warmup.pdf", "wb") as spool:
+            async with backend.get_blob_client("pdf_store/warmup.pdf") as blob_client:
+                await backend.spool_upload(StreamedBody(2 * chunk_size), blob_client, spool)
+        with open(tmp_path / "spool.pdf", "wb") as spool:
+            async with backend.get_blob_client("pdf_store/streamed.pdf") as blob_client:
+                # Storage slower than the body arrives, so unbounded staging would pile up blocks
+                blob_client.__class__ = SlowBlobClient
+                tracemalloc.start()
+                try:
+                    _, block_ids = await backend.spool_upload(StreamedBody(size), blob_client, spool)
+                    return block_ids, tracemalloc.get_traced_memory()[1]
+                finally:
+                    tracemalloc.stop()
+
+    block_ids, peak = asyncio.run(main())
+    assert len(block_ids) == 48 and os.path.getsize(tmp_path / "spool.pdf") == size
+    # The blocks in flight, one being read, and some slack; nowhere near the 48 MB body
+    assert peak < (backend.UPLOAD_MAX_CONCURRENCY + 3) * chunk_size
+
+
+def stub_parsing(monkeypatch):
+    monkeypatch.setattr(pdf_processing, "count_pages", lambda file_path: 1)
+    monkeypatch.setattr(pdf_processing, "load_and_split_pages", lambda file_path, start, stop: (stop - start, [], {"parse": 0.0, "split": 0.0}, 0))
+
+
+def test_concurrent_uploads_of_the_same_pdf_index_it_once(backend, monkeypatch):
+    use_blob_client(backend, monkeypatch, SlowBlobClient)
+    stub_parsing(monkeypatch)
+    monkeypatch.setattr(backend, "UPLOAD_CHUNK_SIZE", 1000)
+    data = b"%PDF-1.4\n" + os.urandom(5000)
+    started = []
+    ingest_pdf = backend.ingest_pdf
+
+    async def counted_ingest(pdf_uuid, file_path):
+        started.append(pdf_uuid)
+        await ingest_pdf(pdf_uuid, file_path)
+
+    monkeypatch.setattr(backend, "ingest_pdf", counted_ingest)
+
+    async def main():
+        async with client(backend) as http:
+            responses = await asyncio.gather(*(
+                http.post("/upload_pdf/", files={"file": (f"copy{i}.pdf", data, "application/pdf")}) for i in range(2)
+            ))
+            await wait_for_ingestion(backend)
+        return [response.json() for response in responses]
+
+    bodies = asyncio.run(main())
+    assert sorted(body["deduplicated"] for body in bodies) == [False, True]
+    assert bodies[0]["pdf_path"] == bodies[1]["pdf_path"]
+    assert started == [hashlib.sha256(data).hexdigest()]
+    assert len(glob.glob(blob_path(backend, "pdf_store/*_copy*.pdf"))) == 1
+
+
+def test_upload_can_claim_a_document_again_after_a_failed_commit(backend, monkeypatch):
+    class FailingCommitBlobClient(LocalBlobClient):
+        async def commit_block_list(self, block_ids):
+            raise OSError("storage unavailable")
+
+    stub_parsing(monkeypatch)
+    data = b"%PDF-1.4\n" + os.urandom(5000)
+
+    async def upload(http):
+        return await http.post("/upload_pdf/", files={"file": ("doc.pdf", data, "application/pdf")})
+
+    async def main():
+        async with client(backend) as http:
+            with monkeypatch.context() as patch:
+                use_blob_client(backend, patch, FailingCommitBlobClient)
+                failed = await upload(http)
+            retried = await upload(http)
+            await wait_for_ingestion(backend)
+        return failed, retried
+
+    failed, retried = asyncio.run(main())
+    assert failed.status_code == 500
+    assert retried.status_code == 200 and not retried.json()["deduplicated"]
+    assert backend.db_pool.connection.documents[retried.json()["pdf_uuid"]]["status"] == "done"
+
+
+def test_an_abandoned_claim_is_taken_over(backend, monkeypatch):
+    stub_parsing(monkeypatch)
+    data = b"%PDF-1.4\n" + os.urandom(5000)
+    pdf_uuid = hashlib.sha256(data).hexdigest()
+    # Left processing by a worker that died
+    backend.db_pool.connection.documents[pdf_uuid] = {
+        "pdf_path": "pdf_store/lost.pdf", "status": "processing", "pages_indexed": [], "chunk_count": 0, "claimed_at": time.monotonic() - 5,
+    }
+
+    async def upload():
+        async with client(backend) as http:
+            response = await http.post("/upload_pdf/", files={"file": ("doc.pdf", data, "application/pdf")})
+            await wait_for_ingestion(backend)
+        return response.json()
+
+    assert asyncio.run(upload())["deduplicated"]
+    monkeypatch.setattr(backend, "INGEST_CLAIM_TIMEOUT", 1)
+    assert not asyncio.run(upload())["deduplicated"]